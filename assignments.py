@@ -0,0 +1,41 @@
+from collections import namedtuple
+
+from harvest import Harvest
+
+from index import normalize_email
+
+AssignmentDiff = namedtuple('AssignmentDiff', ['add', 'remove', 'unresolved'])
+
+
+def diff_assignments(wanted_emails, assigned, people_index):
+    """Compares the people who should be on a Harvest project with the
+    people assigned to it, by case-folded email
+
+    :param wanted_emails: Emails of the people assigned in Teamwork
+    :param assigned: Dictionary of assigned Harvest user ID to email
+    :param people_index: Harvest people by case-folded email, see
+        ``Harvest.get_people_index``
+    :return: Harvest user IDs to add and to remove, each mapped to their
+        email, and the wanted emails without a Harvest user
+    :rtype: AssignmentDiff
+    """
+    wanted = set(normalize_email(email) for email in wanted_emails)
+
+    current = set()
+    remove = {}
+    for user_id, email in assigned.items():
+        email = normalize_email(email)
+        current.add(email)
+        if email not in wanted:
+            remove[user_id] = email
+
+    add = {}
+    unresolved = set()
+    for email in wanted - current:
+        h_person = people_index.get(email)
+        if h_person is None:
+            unresolved.add(email)
+        else:
+            add[h_person[Harvest.USER][Harvest.ID]] = email
+
+    return AssignmentDiff(add, remove, unresolved)
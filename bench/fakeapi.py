@@ -0,0 +1,430 @@
+from bench import fixtures
+from bench.fixtures import TIMESTAMP_FMT
+
+from collections import defaultdict
+
+from requests.adapters import BaseAdapter
+from requests.structures import CaseInsensitiveDict
+
+from six.moves.socketserver import ThreadingMixIn
+
+from wsgiref.simple_server import make_server
+from wsgiref.simple_server import WSGIRequestHandler
+from wsgiref.simple_server import WSGIServer
+
+import argparse
+import datetime
+import hashlib
+import httplib
+import io
+import json
+import re
+import requests
+import threading
+import time
+import urlparse
+
+STATUS_LINES = {httplib.OK: '200 OK',
+                httplib.CREATED: '201 Created',
+                httplib.NOT_MODIFIED: '304 Not Modified',
+                httplib.NOT_FOUND: '404 Not Found'}
+
+
+class FakeAPI(object):
+    """WSGI application serving the Teamwork and Harvest endpoints used by
+    the integration from a set of fixtures.
+
+    Requests are routed to a service by their host (``teamwork.*`` or
+    ``harvest.*``) or by a ``/teamwork`` or ``/harvest`` path prefix, so the
+    application can be mounted in-process with ``WSGIAdapter`` or served over
+    HTTP. Every call sleeps for the injected latency first. GET responses
+    carry an ``ETag`` and honour ``If-None-Match``. Writes change the
+    fixtures, so later reads see them.
+    """
+
+    SERVICES = ('teamwork', 'harvest')
+
+    def __init__(self, fixtures, latency=0.0):
+        """Initializes the API.
+
+        :param fixtures: Fixtures to serve
+        :param latency: Seconds added to every call
+        """
+        self.fixtures = fixtures
+        self.latency = latency
+        self.calls = defaultdict(int)
+        self._lock = threading.Lock()
+        self.routes = dict((service, self.compile(getattr(self, service + '_routes')()))
+                           for service in FakeAPI.SERVICES)
+
+    def compile(self, routes):
+        return [(method, re.compile('^' + pattern + '$'), handler)
+                for method, pattern, handler in routes]
+
+    def teamwork_routes(self):
+        return [('GET', r'/projects\.json', self.tw_get_projects),
+                ('GET', r'/projects/(\d+)\.json', self.tw_get_project),
+                ('PUT', r'/projects/(\d+)\.json', self.tw_update_project),
+                ('GET', r'/projects/(\d+)/people\.json', self.tw_get_project_people),
+                ('POST', r'/projects/(\d+)/time_entries\.json', self.tw_add_time_entry),
+                ('GET', r'/companies\.json', self.tw_get_companies),
+                ('GET', r'/companies/(\d+)\.json', self.tw_get_company),
+                ('GET', r'/people\.json', self.tw_get_people)]
+
+    def harvest_routes(self):
+        return [('GET', r'/clients', self.h_get_clients),
+                ('POST', r'/clients', self.h_create_client),
+                ('PUT', r'/clients/(\d+)', self.h_update_client),
+                ('GET', r'/projects', self.h_get_projects),
+                ('POST', r'/projects', self.h_create_project),
+                ('GET', r'/projects/(\d+)', self.h_get_project),
+                ('PUT', r'/projects/(\d+)', self.h_update_project),
+                ('GET', r'/projects/(\d+)/user_assignments', self.h_get_assignments),
+                ('POST', r'/projects/(\d+)/user_assignments', self.h_add_assignment),
+                ('DELETE', r'/projects/(\d+)/user_assignments/(\d+)', self.h_remove_assignment),
+                ('GET', r'/projects/(\d+)/entries', self.h_get_entries),
+                ('GET', r'/people', self.h_get_people),
+                ('GET', r'/people/(\d+)', self.h_get_person)]
+
+    def __call__(self, environ, start_response):
+        if self.latency:
+            time.sleep(self.latency)
+
+        service, path = self.get_service(environ)
+        method = environ['REQUEST_METHOD']
+        with self._lock:
+            self.calls[(service, method)] += 1
+
+        handler, args = self.get_handler(service, method, path)
+        if handler is None:
+            status, headers, body = httplib.NOT_FOUND, {}, {'error': path}
+        else:
+            query = urlparse.parse_qs(environ.get('QUERY_STRING', ''))
+            length = int(environ.get('CONTENT_LENGTH') or 0)
+            data = json.loads(environ['wsgi.input'].read(length) or 'null')
+            with self._lock:
+                status, headers, body = handler(query, data, *args)
+
+        content = json.dumps(body).encode('utf-8') if body is not None else b''
+        headers = dict(headers)
+        if method == 'GET' and status == httplib.OK:
+            etag = '"' + hashlib.md5(content).hexdigest() + '"'
+            headers['ETag'] = etag
+            if environ.get('HTTP_IF_NONE_MATCH') == etag:
+                status, content = httplib.NOT_MODIFIED, b''
+        headers['Content-Type'] = 'application/json'
+        headers['Content-Length'] = str(len(content))
+
+        start_response(STATUS_LINES[status], [(str(name), str(value))
+                                              for name, value in headers.items()])
+        return [content]
+
+    def get_service(self, environ):
+        """Finds the service a request is made to
+
+        :param environ: WSGI environment
+        :return: Service name and the path within the service
+        :rtype: tuple
+        """
+        path = re.sub('/+', '/', environ.get('PATH_INFO') or '/')
+        for service in FakeAPI.SERVICES:
+            if path.startswith('/' + service + '/'):
+                return service, path[len(service) + 1:]
+        host = environ.get('HTTP_HOST') or environ.get('SERVER_NAME', '')
+        return host.split('.')[0], path
+
+    def get_handler(self, service, method, path):
+        for route_method, pattern, handler in self.routes.get(service, ()):
+            match = pattern.match(path)
+            if match and route_method == method:
+                return handler, match.groups()
+        return None, ()
+
+    def reset(self):
+        """Clears the call counts"""
+        with self._lock:
+            self.calls.clear()
+
+    def get_call_count(self):
+        """Counts the calls made since the last reset
+
+        :return: Calls per service and in total
+        :rtype: dict
+        """
+        with self._lock:
+            counts = dict((service, 0) for service in FakeAPI.SERVICES)
+            for (service, method), count in self.calls.items():
+                counts[service] = counts.get(service, 0) + count
+        counts['total'] = sum(counts.values())
+        return counts
+
+    def get_page(self, query, records):
+        """Slices one page of a paged Teamwork listing
+
+        :param query: Parsed query string
+        :param records: All records
+        :return: Records of the page and the X-Pages header
+        :rtype: tuple
+        """
+        page_size = self.fixtures.page_size
+        page = int(query.get('page', ['1'])[0])
+        pages = max((len(records) + page_size - 1) // page_size, 1)
+        return (records[(page - 1) * page_size:page * page_size],
+                {'X-Pages': pages, 'X-Page': page})
+
+    def tw_project(self, project_id, include_people=True):
+        project = dict(self.fixtures.tw_projects[project_id])
+        if include_people:
+            project['people'] = list(
+                self.fixtures.tw_project_people.get(project_id, []))
+        return project
+
+    def tw_get_projects(self, query, data):
+        include_people = query.get('includePeople') == ['true']
+        projects = [self.tw_project(project_id, include_people)
+                    for project_id in sorted(self.fixtures.tw_projects, key=int)]
+        page, headers = self.get_page(query, projects)
+        return httplib.OK, headers, {'projects': page}
+
+    def tw_get_project(self, query, data, project_id):
+        if project_id not in self.fixtures.tw_projects:
+            return httplib.NOT_FOUND, {}, None
+        return httplib.OK, {}, {'project': self.tw_project(project_id, False)}
+
+    def tw_update_project(self, query, data, project_id):
+        project = self.fixtures.tw_projects.get(project_id)
+        if project is None:
+            return httplib.NOT_FOUND, {}, None
+        project['name'] = data['project']['name']
+        project['last-changed-on'] = get_timestamp()
+        return httplib.OK, {}, {'STATUS': 'OK'}
+
+    def tw_get_project_people(self, query, data, project_id):
+        people = [self.fixtures.tw_people[person_id] for person_id in
+                  self.fixtures.tw_project_people.get(project_id, [])]
+        return httplib.OK, {}, {'people': people}
+
+    def tw_add_time_entry(self, query, data, project_id):
+        if project_id not in self.fixtures.tw_projects:
+            return httplib.NOT_FOUND, {}, None
+        return httplib.CREATED, {'id': self.fixtures.new_id()}, {'STATUS': 'OK'}
+
+    def tw_get_companies(self, query, data):
+        companies = [self.fixtures.tw_companies[company_id] for company_id in
+                     sorted(self.fixtures.tw_companies, key=int)]
+        return httplib.OK, {}, {'companies': companies}
+
+    def tw_get_company(self, query, data, company_id):
+        company = self.fixtures.tw_companies.get(company_id)
+        if company is None:
+            return httplib.NOT_FOUND, {}, None
+        return httplib.OK, {}, {'company': company}
+
+    def tw_get_people(self, query, data):
+        people = [self.fixtures.tw_people[person_id] for person_id in
+                  sorted(self.fixtures.tw_people, key=int)]
+        page, headers = self.get_page(query, people)
+        return httplib.OK, headers, {'people': page}
+
+    def h_get_clients(self, query, data):
+        return httplib.OK, {}, [{'client': self.fixtures.h_clients[client_id]}
+                                for client_id in sorted(self.fixtures.h_clients, key=int)]
+
+    def h_create_client(self, query, data):
+        client_id = self.fixtures.new_id()
+        self.fixtures.h_clients[str(client_id)] = {
+            'id': client_id, 'name': data['client']['name']}
+        return httplib.CREATED, {'Location': '/clients/' + str(client_id)}, None
+
+    def h_update_client(self, query, data, client_id):
+        client = self.fixtures.h_clients.get(client_id)
+        if client is None:
+            return httplib.NOT_FOUND, {}, None
+        client['name'] = data['client']['name']
+        return httplib.OK, {'Location': '/clients/' + client_id}, None
+
+    def h_get_projects(self, query, data):
+        client_id = query.get('client', [None])[0]
+        return httplib.OK, {}, [
+            {'project': project} for _, project in sorted(
+                self.fixtures.h_projects.items(), key=lambda item: int(item[0]))
+            if client_id is None or str(project['client_id']) == client_id]
+
+    def h_create_project(self, query, data):
+        project_id = self.fixtures.new_id()
+        self.fixtures.h_projects[str(project_id)] = {
+            'id': project_id,
+            'name': data['project']['name'],
+            'client_id': int(data['project']['client_id']),
+            'updated_at': get_timestamp()}
+        self.fixtures.h_assignments[str(project_id)] = []
+        return httplib.CREATED, {'Location': '/projects/' + str(project_id)}, None
+
+    def h_get_project(self, query, data, project_id):
+        project = self.fixtures.h_projects.get(project_id)
+        if project is None:
+            return httplib.NOT_FOUND, {}, None
+        return httplib.OK, {}, {'project': project}
+
+    def h_update_project(self, query, data, project_id):
+        project = self.fixtures.h_projects.get(project_id)
+        if project is None:
+            return httplib.NOT_FOUND, {}, None
+        project['name'] = data['project']['name']
+        project['client_id'] = int(data['project']['client_id'])
+        project['updated_at'] = get_timestamp()
+        return httplib.OK, {'Location': '/projects/' + project_id}, None
+
+    def h_get_assignments(self, query, data, project_id):
+        return httplib.OK, {}, [
+            {'user_assignment': {'user_id': user_id,
+                                 'project_id': int(project_id)}}
+            for user_id in self.fixtures.h_assignments.get(project_id, [])]
+
+    def h_add_assignment(self, query, data, project_id):
+        if project_id not in self.fixtures.h_projects:
+            return httplib.NOT_FOUND, {}, None
+        user_id = int(data['user']['id'])
+        assigned = self.fixtures.h_assignments.setdefault(project_id, [])
+        if user_id not in assigned:
+            assigned.append(user_id)
+        return httplib.CREATED, {'Location': '/projects/' + project_id +
+                                 '/user_assignments/' + str(user_id)}, None
+
+    def h_remove_assignment(self, query, data, project_id, user_id):
+        assigned = self.fixtures.h_assignments.get(project_id, [])
+        if int(user_id) not in assigned:
+            return httplib.NOT_FOUND, {}, None
+        assigned.remove(int(user_id))
+        return httplib.OK, {}, None
+
+    def h_get_entries(self, query, data, project_id):
+        return httplib.OK, {}, [{'day_entry': entry} for entry in
+                                self.fixtures.h_entries.get(project_id, [])]
+
+    def h_get_people(self, query, data):
+        return httplib.OK, {}, [{'user': self.fixtures.h_people[user_id]}
+                                for user_id in sorted(self.fixtures.h_people, key=int)]
+
+    def h_get_person(self, query, data, user_id):
+        user = self.fixtures.h_people.get(user_id)
+        if user is None:
+            return httplib.NOT_FOUND, {}, None
+        return httplib.OK, {}, {'user': user}
+
+
+class WSGIAdapter(BaseAdapter):
+    """Transport adapter handing requests to a WSGI application in-process,
+    so a ``requests.Session`` can talk to ``FakeAPI`` without sockets."""
+
+    def __init__(self, app):
+        super(WSGIAdapter, self).__init__()
+        self.app = app
+
+    def send(self, request, stream=False, timeout=None, verify=True,
+             cert=None, proxies=None):
+        parsed = urlparse.urlsplit(request.url)
+        body = request.body or b''
+        if not isinstance(body, bytes):
+            body = body.encode('utf-8')
+
+        environ = {'REQUEST_METHOD': request.method,
+                   'SCRIPT_NAME': '',
+                   'PATH_INFO': parsed.path,
+                   'QUERY_STRING': parsed.query,
+                   'SERVER_NAME': parsed.hostname,
+                   'SERVER_PORT': str(parsed.port or 80),
+                   'SERVER_PROTOCOL': 'HTTP/1.1',
+                   'CONTENT_LENGTH': str(len(body)),
+                   'wsgi.input': io.BytesIO(body),
+                   'wsgi.url_scheme': parsed.scheme,
+                   'wsgi.errors': io.BytesIO(),
+                   'wsgi.version': (1, 0),
+                   'wsgi.multithread': True,
+                   'wsgi.multiprocess': False,
+                   'wsgi.run_once': False}
+        for name, value in request.headers.items():
+            environ['HTTP_' + name.upper().replace('-', '_')] = value
+        environ['HTTP_HOST'] = parsed.netloc
+
+        started = []
+
+        def start_response(status, headers, exc_info=None):
+            started[:] = [status, headers]
+
+        content = b''.join(self.app(environ, start_response))
+        status, headers = started
+
+        response = requests.Response()
+        response.status_code = int(status.split(' ')[0])
+        response.reason = status.split(' ', 1)[1]
+        response.headers = CaseInsensitiveDict(headers)
+        response.encoding = 'utf-8'
+        response.url = request.url
+        response.request = request
+        response.connection = self
+        response.raw = io.BytesIO(content)
+        # The body is complete, so iter_content serves it from memory
+        response._content = content
+        response._content_consumed = True
+        return response
+
+    def close(self):
+        pass
+
+
+def install(api, session, base_urls):
+    """Routes the requests of a session to the fake API
+
+    :param api: FakeAPI
+    :param session: Session, e.g. ``connection.get_session()``
+    :param base_urls: Base URLs to route
+    """
+    adapter = WSGIAdapter(api)
+    for base_url in base_urls:
+        session.mount(base_url, adapter)
+
+
+class ThreadingWSGIServer(ThreadingMixIn, WSGIServer):
+
+    daemon_threads = True
+
+
+class QuietRequestHandler(WSGIRequestHandler):
+
+    def log_message(self, format, *args):
+        pass
+
+
+def serve(api, port):
+    """Serves the fake API over HTTP until interrupted
+
+    Point ``TEAMWORK_BASE_URL`` at ``http://host:port/teamwork`` and
+    ``HARVEST_BASE_URL`` at ``http://host:port/harvest``.
+
+    :param api: FakeAPI
+    :param port: Port to listen on
+    """
+    server = make_server('', port, api,
+                         server_class=ThreadingWSGIServer,
+                         handler_class=QuietRequestHandler)
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+
+
+def get_timestamp():
+    return datetime.datetime.utcnow().strftime(TIMESTAMP_FMT)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Serves a fake Teamwork/Harvest API')
+    parser.add_argument('--port', type=int, default=8001)
+    parser.add_argument('--projects', type=int, default=500)
+    parser.add_argument('--latency', type=float, default=0.05)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+    serve(FakeAPI(fixtures.generate(projects=args.projects, seed=args.seed),
+                  args.latency),
+          args.port)
@@ -0,0 +1,222 @@
+import datetime
+import json
+import random
+
+# Share of the webhook events of each type in a realistic burst
+EVENT_MIX = (('PROJECT.UPDATED', 0.45),
+             ('PROJECT.CREATED', 0.2),
+             ('PROJECT.COPIED', 0.05),
+             ('COMPANY.UPDATED', 0.2),
+             ('COMPANY.CREATED', 0.1))
+
+# Date part of the generated project codes
+PROJECT_DATE = '1601'
+
+TIMESTAMP_FMT = '%Y-%m-%dT%H:%M:%SZ'
+
+
+class Fixtures(object):
+    """State of a Teamwork account and a Harvest account served by the fake
+    API.
+
+    Records are stored in the shape the API clients read them, keyed by
+    their ID as a string, so a set of fixtures can be dumped to JSON and
+    loaded back, e.g. to replay recorded responses.
+    """
+
+    TABLES = ('tw_companies', 'tw_projects', 'tw_people', 'tw_project_people',
+              'h_clients', 'h_projects', 'h_people', 'h_assignments',
+              'h_entries')
+
+    def __init__(self, data=None, page_size=250):
+        """Initializes the fixtures.
+
+        :param data: Dictionary of table name to records by ID, see
+            ``Fixtures.TABLES``
+        :param page_size: Records per page of the paged Teamwork listings
+        """
+        data = data or {}
+        for table in Fixtures.TABLES:
+            setattr(self, table, dict(data.get(table) or {}))
+        self.page_size = page_size
+        self.next_id = max([int(key) for table in Fixtures.TABLES
+                            for key in getattr(self, table)] + [0]) + 1
+
+    def new_id(self):
+        """Allocates an ID for a record created through the fake API
+
+        :return: ID
+        :rtype: int
+        """
+        new_id = self.next_id
+        self.next_id += 1
+        return new_id
+
+    def to_dict(self):
+        data = dict((table, getattr(self, table)) for table in Fixtures.TABLES)
+        data['page_size'] = self.page_size
+        return data
+
+    def dump(self, path):
+        """Writes the fixtures to a JSON file
+
+        :param path: File path
+        """
+        with open(path, 'w') as f:
+            json.dump(self.to_dict(), f)
+
+    @staticmethod
+    def load(path):
+        """Reads fixtures written by ``Fixtures.dump``
+
+        :param path: File path
+        :return: Fixtures
+        :rtype: Fixtures
+        """
+        with open(path) as f:
+            data = json.load(f)
+        return Fixtures(data, data.get('page_size', 250))
+
+    def sample_events(self, count, mix=EVENT_MIX, seed=0):
+        """Draws webhook events over the fixtures
+
+        Project events target random Teamwork projects and company events
+        random Teamwork companies.
+
+        :param count: Number of events
+        :param mix: Sequence of (event type, weight)
+        :param seed: Random seed
+        :return: (event type, object ID) pairs
+        :rtype: list
+        """
+        rand = random.Random(seed)
+        project_ids = sorted(self.tw_projects, key=int)
+        company_ids = sorted(self.tw_companies, key=int)
+        total = float(sum(weight for _, weight in mix))
+
+        events = []
+        for _ in range(count):
+            pick = rand.random() * total
+            for event, weight in mix:
+                pick -= weight
+                if pick <= 0:
+                    break
+            ids = company_ids if event.startswith('COMPANY.') else project_ids
+            events.append((event, rand.choice(ids)))
+        return events
+
+
+def get_abbr(number):
+    """Builds a unique company abbreviation, e.g. CA, CB, ..., CBA
+
+    :param number: Company number
+    :return: Uppercase abbreviation
+    :rtype: str
+    """
+    letters = ''
+    while True:
+        letters = chr(ord('A') + number % 26) + letters
+        number //= 26
+        if not number:
+            return 'C' + letters
+
+
+def generate(projects=500, people=100, companies=25, prefixed=0.9,
+             people_per_project=5, entries_per_project=4, page_size=250,
+             seed=0):
+    """Generates synthetic fixtures
+
+    Prefixed Teamwork projects follow the project name scheme and have a
+    Harvest project of the same name under their company's client, with
+    some assignments out of sync. The other Teamwork projects still need a
+    project code. Harvest emails differ in case from Teamwork every few
+    people, and every Harvest project has time entries spent today by its
+    assigned people.
+
+    :param projects: Number of Teamwork projects
+    :param people: Number of people in both services
+    :param companies: Number of Teamwork companies
+    :param prefixed: Share of the projects following the name scheme
+    :param people_per_project: People assigned per project
+    :param entries_per_project: Harvest time entries per project
+    :param page_size: Records per page of the paged Teamwork listings
+    :param seed: Random seed
+    :return: Fixtures
+    :rtype: Fixtures
+    """
+    rand = random.Random(seed)
+    now = datetime.datetime.utcnow()
+    today = now.strftime('%Y-%m-%d')
+    fixtures = Fixtures(page_size=page_size)
+
+    company_ids = []
+    for number in range(companies):
+        company_id = str(100 + number)
+        abbr = get_abbr(number)
+        fixtures.tw_companies[company_id] = {
+            'id': company_id, 'name': 'Company ' + abbr, 'address_one': abbr}
+        client_id = 20000 + number
+        fixtures.h_clients[str(client_id)] = {'id': client_id, 'name': abbr}
+        company_ids.append((company_id, client_id, abbr))
+
+    users = {}
+    for number in range(people):
+        person_id = str(1000 + number)
+        user_id = 30000 + number
+        email = 'person' + str(number) + '@example.com'
+        fixtures.tw_people[person_id] = {'id': person_id,
+                                         'email-address': email}
+        fixtures.h_people[str(user_id)] = {
+            'id': user_id,
+            'email': email.capitalize() if number % 7 == 0 else email}
+        users[person_id] = user_id
+
+    job_ids = {}
+    entry_id = 900000
+    for number in range(projects):
+        project_id = str(100000 + number)
+        company_id, client_id, abbr = company_ids[number % companies]
+        assigned = rand.sample(sorted(fixtures.tw_people),
+                               min(people_per_project, people))
+        changed = now - datetime.timedelta(minutes=rand.randint(0, 60 * 24 * 30))
+
+        title = 'Project ' + str(number)
+        if rand.random() < prefixed:
+            job_ids[abbr] = job_ids.get(abbr, 0) + 1
+            name = PROJECT_DATE + '-' + abbr + '-' + \
+                '{0:03d}'.format(job_ids[abbr]) + ' ' + title
+        else:
+            name = title
+        fixtures.tw_projects[project_id] = {
+            'id': project_id,
+            'name': name,
+            'company': {'id': company_id, 'name': 'Company ' + abbr},
+            'status': 'active',
+            'last-changed-on': changed.strftime(TIMESTAMP_FMT)}
+        fixtures.tw_project_people[project_id] = assigned
+        if name == title:
+            continue
+
+        h_project_id = 40000 + number
+        fixtures.h_projects[str(h_project_id)] = {
+            'id': h_project_id,
+            'name': name,
+            'client_id': client_id,
+            'updated_at': changed.strftime(TIMESTAMP_FMT)}
+        # Leave a project out of sync now and then
+        h_assigned = assigned[1:] if number % 5 == 0 else assigned
+        fixtures.h_assignments[str(h_project_id)] = [
+            users[person_id] for person_id in h_assigned]
+        entries = []
+        for _ in range(entries_per_project):
+            entry_id += 1
+            entries.append({
+                'id': entry_id,
+                'user_id': users[rand.choice(assigned)],
+                'hours': rand.choice((0.25, 0.5, 1.0, 1.5, 2.0, 4.0)),
+                'spent_at': today,
+                'updated_at': now.strftime(TIMESTAMP_FMT)})
+        fixtures.h_entries[str(h_project_id)] = entries
+
+    fixtures.next_id = entry_id + 1
+    return fixtures
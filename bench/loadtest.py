@@ -0,0 +1,433 @@
+"""Load test of the webhook endpoint
+
+Posts a mix of webhook events at a target rate, either to the WSGI
+application running in a separate process against a fake Teamwork/Harvest
+API and a throwaway database, or to a deployment at a URL. Run it through
+``python manage.py loadtest``.
+
+Webhooks are only queued by the POST, so in-process runs also wait for the
+event workers to drain the queue and report how fast and how late the
+events were handled.
+"""
+from bench import fixtures
+from bench.run import configure
+
+from collections import OrderedDict
+
+from teamwork import Teamwork
+
+import json
+import logging
+import math
+import os
+import requests
+import settings
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+DEFAULTS = dict(url=None,
+                rate=50.0,
+                count=1000,
+                concurrency=16,
+                mix=None,
+                workers=2,
+                coalesce_window=5,
+                database=None,
+                projects=500,
+                latency=0.05,
+                drain_timeout=120,
+                seed=0)
+
+PERCENTILES = (50, 95, 99)
+
+# Label of the totals over every event type
+ALL = 'all'
+
+
+class LoadTest(object):
+    """Open-loop load generator.
+
+    Request ``n`` is due ``n / rate`` seconds after the start, whatever
+    happened to the earlier ones, and its latency is measured from that
+    time. A server that falls behind shows up as growing latency instead
+    of a lower sending rate.
+    """
+
+    def __init__(self, client_factory, events, rate, concurrency):
+        """Initializes the load test.
+
+        :param client_factory: Callable returning a callable that posts
+            (event type, object ID) and returns the status code; called
+            once per sending thread
+        :param events: (event type, object ID) pairs to post
+        :param rate: Target requests per second
+        :param concurrency: Sending threads, bounding the requests in flight
+        """
+        self.client_factory = client_factory
+        self.events = events
+        self.rate = float(rate)
+        self.concurrency = concurrency
+        self.samples = []
+        self._next = 0
+        self._lock = threading.Lock()
+
+    def run(self):
+        """Posts every event
+
+        :return: Summary, see ``summarize``
+        :rtype: dict
+        """
+        self.started = time.time()
+        threads = [threading.Thread(target=self.send)
+                   for _ in range(self.concurrency)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return summarize(self.samples, time.time() - self.started, self.rate)
+
+    def send(self):
+        post = self.client_factory()
+        while True:
+            with self._lock:
+                index = self._next
+                self._next += 1
+            if index >= len(self.events):
+                return
+
+            due = self.started + index / self.rate
+            delay = due - time.time()
+            if delay > 0:
+                time.sleep(delay)
+
+            event, object_id = self.events[index]
+            try:
+                status = post(event, object_id)
+            except requests.RequestException:
+                status = None
+            with self._lock:
+                self.samples.append((event, status, time.time() - due))
+
+
+def get_form(event, object_id):
+    return {Teamwork.EVENT: event, Teamwork.OBJECT_ID: object_id}
+
+
+def http_client(url):
+    """Builds a client posting to a deployment
+
+    :param url: Webhook URL
+    :return: Callable posting an event and returning the status code
+    """
+    session = requests.Session()
+
+    def post(event, object_id):
+        req = session.post(url, data=get_form(event, object_id))
+        req.close()
+        return req.status_code
+
+    return post
+
+
+def app_client(application):
+    """Builds a client calling the WSGI application in-process
+
+    :param application: Flask application
+    :return: Callable posting an event and returning the status code
+    """
+    client = application.test_client()
+
+    def post(event, object_id):
+        return client.post('/', data=get_form(event, object_id)).status_code
+
+    return post
+
+
+def summarize(samples, elapsed, rate):
+    """Computes the throughput, latency percentiles and error rate per
+    event type
+
+    :param samples: (event type, status code or None, latency) triples
+    :param elapsed: Seconds the test ran
+    :param rate: Target requests per second
+    :return: Totals and the statistics per event type, latencies in
+        milliseconds
+    :rtype: dict
+    """
+    by_event = {}
+    for event, status, latency in samples:
+        by_event.setdefault(event, []).append((status, latency))
+        by_event.setdefault(ALL, []).append((status, latency))
+
+    events = OrderedDict()
+    for event in sorted(by_event, key=lambda name: (name == ALL, name)):
+        results = by_event[event]
+        latencies = sorted(latency for _, latency in results)
+        errors = sum(1 for status, _ in results
+                     if status is None or status >= 400)
+        stats = dict(requests=len(results),
+                     errors=errors,
+                     error_rate=float(errors) / len(results),
+                     throughput=len(results) / elapsed if elapsed else 0.0)
+        for percentile in PERCENTILES:
+            stats['p' + str(percentile)] = \
+                get_percentile(latencies, percentile) * 1000
+        events[event] = stats
+    return dict(elapsed=elapsed, target_rate=rate, events=events)
+
+
+def summarize_processing(histogram, elapsed):
+    """Computes the processing throughput, failures and end-to-end
+    latency percentiles per event type from the event latency histogram
+
+    Percentiles are the upper bound of the bucket they fall in, None
+    beyond the last bucket.
+
+    :param histogram: ``metrics.event_latency_seconds``
+    :param elapsed: Seconds from the first POST until the queue drained
+    :return: Statistics per event type, latencies in milliseconds
+    :rtype: dict
+    """
+    by_event = {}
+    for labels, buckets, _, count in histogram.get_samples():
+        for event in (labels['event'], ALL):
+            totals = by_event.setdefault(event, dict(buckets=[0] * len(buckets),
+                                                     handled=0, failed=0))
+            totals['buckets'] = [a + b for a, b in zip(totals['buckets'], buckets)]
+            totals['handled'] += count
+            if labels['outcome'] == 'failed':
+                totals['failed'] += count
+
+    events = OrderedDict()
+    for event in sorted(by_event, key=lambda name: (name == ALL, name)):
+        totals = by_event[event]
+        stats = dict(handled=totals['handled'],
+                     failed=totals['failed'],
+                     throughput=totals['handled'] / elapsed if elapsed else 0.0)
+        for percentile in PERCENTILES:
+            bound = get_bucket_percentile(histogram.buckets, totals['buckets'],
+                                          totals['handled'], percentile)
+            stats['p' + str(percentile)] = None if bound is None else bound * 1000.0
+        events[event] = stats
+    return events
+
+
+def get_bucket_percentile(bounds, counts, total, percentile):
+    """Reads a nearest-rank percentile from histogram buckets
+
+    :param bounds: Upper bounds of the buckets
+    :param counts: Observations per bucket
+    :param total: Observations, including those beyond the last bucket
+    :param percentile: Percentile between 0 and 100
+    :return: Upper bound of the bucket, 0 without observations or None
+        beyond the last bucket
+    """
+    if not total:
+        return 0
+    rank = max(int(math.ceil(percentile / 100.0 * total)), 1)
+    cumulative = 0
+    for bound, count in zip(bounds, counts):
+        cumulative += count
+        if cumulative >= rank:
+            return bound
+    return None
+
+
+def get_percentile(values, percentile):
+    """Reads a nearest-rank percentile
+
+    :param values: Sorted values
+    :param percentile: Percentile between 0 and 100
+    :return: Value, 0 if there are none
+    """
+    if not values:
+        return 0
+    rank = int(math.ceil(percentile / 100.0 * len(values)))
+    return values[max(rank, 1) - 1]
+
+
+def parse_mix(mix):
+    """Parses an event mix, e.g. "PROJECT.UPDATED=3,COMPANY.CREATED=1"
+
+    :param mix: Comma separated event type=weight pairs, or None for the
+        default mix
+    :return: Sequence of (event type, weight)
+    :rtype: tuple
+    """
+    if not mix:
+        return fixtures.EVENT_MIX
+
+    parsed = []
+    for part in mix.split(','):
+        event, _, weight = part.partition('=')
+        event = event.strip()
+        if event not in Teamwork.EVENTS:
+            raise ValueError('unknown webhook event ' + event)
+        parsed.append((event, float(weight or 1)))
+    return tuple(parsed)
+
+
+def get_events(data, options):
+    """Draws the events to post
+
+    :param data: Fixtures
+    :param options: Options, see ``DEFAULTS``
+    :return: (event type, object ID) pairs
+    :rtype: list
+    """
+    return data.sample_events(options['count'], parse_mix(options['mix']),
+                              options['seed'])
+
+
+def run(options):
+    """Runs a load test
+
+    Without a URL the application runs in a separate process, whose
+    settings point at the fake API and a throwaway database, with
+    ``workers`` event workers draining the queue while events arrive.
+
+    :param options: Options, see ``DEFAULTS``
+    :return: Summary, see ``summarize``, when testing in-process with the
+        processing statistics, see ``summarize_processing``, the seconds
+        until the queue drained, the events left in it and the API calls
+        made, or None if the test process failed
+    :rtype: dict
+    """
+    options = dict(DEFAULTS, **dict((key, value) for key, value in options.items()
+                                    if value is not None))
+    data = fixtures.generate(projects=options['projects'], seed=options['seed'])
+    if options['url']:
+        return LoadTest(lambda: http_client(options['url']),
+                        get_events(data, options),
+                        options['rate'], options['concurrency']).run()
+
+    workdir = tempfile.mkdtemp(prefix='loadtest-')
+    try:
+        options['fixtures'] = os.path.join(workdir, 'fixtures.json')
+        options['log'] = os.path.join(workdir, 'loadtest.log')
+        if not options['database']:
+            options['database'] = 'sqlite:///' + os.path.join(workdir, 'loadtest.sqlite')
+        data.dump(options['fixtures'])
+
+        process = subprocess.Popen([sys.executable, '-m', 'bench.loadtest',
+                                    json.dumps(options)],
+                                   stdout=subprocess.PIPE,
+                                   stderr=subprocess.PIPE)
+        output, errors = process.communicate()
+        if process.returncode != 0:
+            logging.error('The load test failed:\n' + errors.decode('utf-8')[-2000:])
+            return None
+        return json.loads(output.decode('utf-8').strip().splitlines()[-1])
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+def run_child(options):
+    """Runs the in-process load test and writes its summary as JSON to
+    stdout
+
+    :param options: Options, see ``run``
+    """
+    configure(options)
+    settings.WEBHOOK_WORKERS = options['workers']
+    settings.WEBHOOK_COALESCE_WINDOW = options['coalesce_window']
+    # The application modules read the settings configured above
+    from bench import scenarios
+    from jobs.models import TWEvent
+    from webhook import application
+    from webhook import event_workers
+    from webhook import session_factory
+    import metrics
+
+    api = scenarios.install(options)
+    database = scenarios.Scenario(api, options)
+    database.setup()
+    database.backfill()
+    api.reset()
+
+    def get_backlog():
+        session = session_factory()
+        try:
+            return session.query(TWEvent).count()
+        finally:
+            session.close()
+
+    test = LoadTest(lambda: app_client(application),
+                    get_events(api.fixtures, options),
+                    options['rate'], options['concurrency'])
+    result = test.run()
+
+    # Retried events may stay queued for minutes, hence the timeout
+    deadline = time.time() + options['drain_timeout']
+    backlog = get_backlog()
+    while backlog and time.time() < deadline:
+        time.sleep(0.1)
+        backlog = get_backlog()
+    event_workers.stop()
+
+    result['drain_seconds'] = time.time() - test.started
+    result['backlog'] = backlog
+    result['api_calls'] = api.get_call_count()['total']
+    result['processing'] = summarize_processing(metrics.event_latency_seconds,
+                                                result['drain_seconds'])
+    sys.stdout.write(json.dumps(result) + '\n')
+
+
+def report(result):
+    """Writes the summary as a table
+
+    :param result: Summary, see ``run``
+    """
+    sys.stdout.write('{0} request(s) in {1:.1f}s, target {2:.1f}/s\n'.format(
+        result['events'][ALL]['requests'] if result['events'] else 0,
+        result['elapsed'], result['target_rate']))
+    write_table(result['events'],
+                ['requests', 'throughput', 'errors', 'error_rate'] +
+                ['p' + str(percentile) for percentile in PERCENTILES])
+    sys.stdout.write('POST latencies in ms, throughput in requests/s\n')
+    if 'processing' not in result:
+        return
+
+    sys.stdout.write('\nevents handled by the workers in {0:.1f}s\n'.format(
+        result['drain_seconds']))
+    write_table(result['processing'],
+                ['handled', 'throughput', 'failed'] +
+                ['p' + str(percentile) for percentile in PERCENTILES])
+    sys.stdout.write('end-to-end latencies in ms from queueing to done, '
+                     'rounded up to the histogram buckets, throughput in '
+                     'events/s\n')
+    sys.stdout.write('events left in the queue: ' + str(result['backlog']) +
+                     ', API calls: ' + str(result['api_calls']) + '\n')
+
+
+def write_table(events, columns):
+    """Writes statistics per event type as a table
+
+    :param events: Statistics per event type
+    :param columns: Statistics to write
+    """
+    sys.stdout.write('{0:<18}'.format('event') +
+                     ''.join('{0:>12}'.format(column) for column in columns) +
+                     '\n')
+    for event, stats in events.items():
+        cells = []
+        for column in columns:
+            value = stats[column]
+            if value is None:
+                text = '-'
+            elif column == 'error_rate':
+                text = '{0:.2%}'.format(value)
+            elif isinstance(value, float):
+                text = '{0:.1f}'.format(value)
+            else:
+                text = str(value)
+            cells.append('{0:>12}'.format(text))
+        sys.stdout.write('{0:<18}'.format(event) + ''.join(cells) + '\n')
+
+
+if __name__ == '__main__':
+    run_child(json.loads(sys.argv[1]))
@@ -0,0 +1,283 @@
+"""Runs the offline benchmarks
+
+Every scenario runs in a fresh process against a fake Teamwork/Harvest API
+and a throwaway SQLite database, e.g.::
+
+    $ python -m bench.run --projects 2000 --latency 0.05
+    $ python -m bench.run webhook_burst --events 1000 --save-baseline
+"""
+from bench import fixtures
+
+from sqlalchemy.engine.url import make_url
+
+import argparse
+import json
+import logging
+import os
+import settings
+import shutil
+import subprocess
+import sys
+import tempfile
+
+# Base URLs of the fake API, routed in-process by bench.fakeapi.install
+TEAMWORK_URL = 'http://teamwork.bench'
+HARVEST_URL = 'http://harvest.bench'
+
+# Names of bench.scenarios.SCENARIOS, which cannot be imported before the
+# settings are configured
+SCENARIO_NAMES = ('single_webhook', 'project_update', 'webhook_burst',
+                  'setup_db', 'time_entries')
+
+# Options the results depend on, stored with the baseline
+PARAMETERS = ('projects', 'people', 'companies', 'prefixed',
+              'people_per_project', 'entries_per_project', 'page_size',
+              'latency', 'events', 'workers', 'seed', 'fixtures')
+
+# Measurements compared against the baseline, and whether any increase
+# is a regression (counts) or only one beyond the tolerance (timings)
+COMPARED = (('wall_seconds', False),
+            ('api_calls', True),
+            ('db_queries', True),
+            ('peak_rss_kb', False))
+
+DEFAULT_BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                'baseline.json')
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(description='Offline benchmarks')
+    parser.add_argument('scenarios', nargs='*',
+                        help='scenarios to run, all by default: ' +
+                             ', '.join(SCENARIO_NAMES))
+    parser.add_argument('--projects', type=int, default=500)
+    parser.add_argument('--people', type=int, default=100)
+    parser.add_argument('--companies', type=int, default=25)
+    parser.add_argument('--prefixed', type=float, default=0.9,
+                        help='share of projects already having a project code')
+    parser.add_argument('--people-per-project', type=int, default=5)
+    parser.add_argument('--entries-per-project', type=int, default=4)
+    parser.add_argument('--page-size', type=int, default=250,
+                        help='records per page of the Teamwork listings')
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help='seconds added to every API call')
+    parser.add_argument('--events', type=int, default=1000,
+                        help='webhook events of the burst scenario')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='event workers draining the burst')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--database',
+                        help='SQLAlchemy URL of a scratch database, its tables '
+                             'are dropped; a temporary SQLite file by default')
+    parser.add_argument('--fixtures',
+                        help='JSON fixtures to serve instead of synthetic ones')
+    parser.add_argument('--save-fixtures',
+                        help='write the synthetic fixtures to this file')
+    parser.add_argument('--baseline', default=DEFAULT_BASELINE,
+                        help='baseline results to compare against')
+    parser.add_argument('--save-baseline', action='store_true',
+                        help='store the results as the new baseline')
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help='relative slowdown or memory growth reported '
+                             'as a regression')
+    parser.add_argument('--child', help=argparse.SUPPRESS)
+    return parser
+
+
+def configure(options):
+    """Points the settings at the fake API and the benchmark database
+
+    Must run before the application modules are imported, as they read
+    the settings at import time.
+
+    :param options: Benchmark options
+    """
+    url = make_url(options['database'])
+    settings.DATABASE = dict(drivername=url.drivername,
+                             host=url.host,
+                             port=url.port,
+                             username=url.username,
+                             password=url.password,
+                             database=url.database)
+    settings.DEBUG = False
+    settings.LOG_LOCATION = options['log']
+    settings.TEAMWORK_BASE_URL = TEAMWORK_URL
+    settings.HARVEST_BASE_URL = HARVEST_URL
+    # Only the injected latency should pace the calls
+    settings.API_RATE_LIMIT = (1000000, 1000000)
+    settings.API_HOST_RATE_LIMITS = {}
+    settings.HTTP_VALIDATOR_CACHE_DIR = None
+    settings.WEBHOOK_WORKERS = 0
+    settings.WEBHOOK_COALESCE_WINDOW = 0
+    settings.TRACE_MAX_CALLS = None
+    settings.TRACE_MAX_BYTES = None
+
+
+def run_child(options):
+    """Runs one scenario in this process and writes its measurements as
+    JSON to stdout
+
+    :param options: Benchmark options
+    """
+    configure(options)
+    # The application modules read the settings configured above
+    from bench import scenarios
+    result = scenarios.run(options['scenario'], options)
+    sys.stdout.write(json.dumps(result) + '\n')
+
+
+def run_scenario(name, options, workdir):
+    """Runs one scenario in a new process
+
+    :param name: Scenario name
+    :param options: Benchmark options
+    :param workdir: Directory for the database and the log
+    :return: Measurements, or None if the scenario failed
+    :rtype: dict
+    """
+    options = dict(options,
+                   scenario=name,
+                   log=os.path.join(workdir, name + '.log'))
+    if not options['database']:
+        options['database'] = 'sqlite:///' + os.path.join(workdir, name + '.sqlite')
+    process = subprocess.Popen([sys.executable, '-m', 'bench.run',
+                                '--child', json.dumps(options)],
+                               stdout=subprocess.PIPE,
+                               stderr=subprocess.PIPE)
+    output, errors = process.communicate()
+    if process.returncode != 0:
+        logging.error('Scenario ' + name + ' failed, see ' + options['log'] +
+                      '\n' + errors.decode('utf-8')[-2000:])
+        return None
+    return json.loads(output.decode('utf-8').strip().splitlines()[-1])
+
+
+def compare(results, baseline, tolerance):
+    """Compares the results with a baseline
+
+    :param results: Measurements per scenario
+    :param baseline: Baseline measurements per scenario
+    :param tolerance: Allowed relative growth of timings and memory
+    :return: Regressions as (scenario, measurement, baseline, result)
+    :rtype: list
+    """
+    regressions = []
+    for name, result in sorted(results.items()):
+        before = baseline.get(name)
+        if result is None or before is None:
+            continue
+        for key, strict in COMPARED:
+            limit = before[key] if strict else before[key] * (1 + tolerance)
+            if result[key] > limit:
+                regressions.append((name, key, before[key], result[key]))
+    return regressions
+
+
+def format_change(value, before):
+    if before is None:
+        return ''
+    if not before:
+        return ' (=)' if value == before else ' (new)'
+    return ' ({0:+.1f}%)'.format((value - before) * 100.0 / before)
+
+
+def report(results, baseline):
+    """Writes a table of the results, with the change from the baseline
+
+    :param results: Measurements per scenario
+    :param baseline: Baseline measurements per scenario
+    """
+    columns = [key for key, _ in COMPARED]
+    sys.stdout.write('{0:<16}'.format('scenario') +
+                     ''.join('{0:>24}'.format(key) for key in columns) + '\n')
+    for name in SCENARIO_NAMES:
+        if name not in results:
+            continue
+        result = results[name]
+        if result is None:
+            sys.stdout.write('{0:<16}failed'.format(name) + '\n')
+            continue
+        before = baseline.get(name) or {}
+        cells = []
+        for key in columns:
+            value = result[key]
+            text = '{0:.3f}'.format(value) if isinstance(value, float) else str(value)
+            cells.append('{0:>24}'.format(text + format_change(value, before.get(key))))
+        sys.stdout.write('{0:<16}'.format(name) + ''.join(cells) + '\n')
+
+
+def main(argv=None):
+    parser = get_parser()
+    args = parser.parse_args(argv)
+    if args.child:
+        run_child(json.loads(args.child))
+        return 0
+
+    unknown = set(args.scenarios) - set(SCENARIO_NAMES)
+    if unknown:
+        parser.error('unknown scenario(s): ' + ', '.join(sorted(unknown)))
+    parameters = dict((key, getattr(args, key)) for key in PARAMETERS)
+
+    options = dict(database=args.database,
+                   latency=args.latency,
+                   events=args.events,
+                   workers=args.workers,
+                   seed=args.seed)
+    workdir = tempfile.mkdtemp(prefix='bench-')
+    results = {}
+    try:
+        if args.fixtures:
+            data = fixtures.Fixtures.load(args.fixtures)
+        else:
+            data = fixtures.generate(projects=args.projects,
+                                     people=args.people,
+                                     companies=args.companies,
+                                     prefixed=args.prefixed,
+                                     people_per_project=args.people_per_project,
+                                     entries_per_project=args.entries_per_project,
+                                     page_size=args.page_size,
+                                     seed=args.seed)
+        if args.save_fixtures:
+            data.dump(args.save_fixtures)
+        options['fixtures'] = os.path.join(workdir, 'fixtures.json')
+        data.dump(options['fixtures'])
+
+        for name in args.scenarios or SCENARIO_NAMES:
+            results[name] = run_scenario(name, options, workdir)
+    finally:
+        failed = any(result is None for result in results.values())
+        # Keep the logs of failed scenarios
+        if not failed:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    baseline = {}
+    if os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            stored = json.load(f)
+        if stored['parameters'] == parameters:
+            baseline = stored['results']
+        else:
+            logging.warning('Not comparing with the baseline, it was measured '
+                            'with other options: ' +
+                            json.dumps(stored['parameters'], sort_keys=True))
+
+    report(results, baseline)
+    regressions = compare(results, baseline, args.tolerance)
+    for name, key, before, after in regressions:
+        sys.stdout.write('regression: ' + name + ' ' + key + ' ' +
+                         str(before) + ' -> ' + str(after) + '\n')
+
+    if args.save_baseline:
+        stored = dict(baseline)
+        stored.update((name, result) for name, result in results.items()
+                      if result is not None)
+        with open(args.baseline, 'w') as f:
+            json.dump({'parameters': parameters, 'results': stored}, f,
+                      indent=2, sort_keys=True)
+        sys.stdout.write('baseline saved to ' + args.baseline + '\n')
+
+    return 1 if regressions or failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,238 @@
+from collections import OrderedDict
+
+from bench import fakeapi
+from bench.fixtures import Fixtures
+
+from jobs.models import Base
+from jobs.models import TWProject
+from jobs.process import TWProjectPipeline
+
+from sqlalchemy import event
+from sqlalchemy.engine import Engine as EngineClass
+
+from teamwork import Teamwork
+
+from timeentry import TimeImport
+
+from webhook import Engine
+from webhook import event_queue
+from webhook import event_workers
+from webhook import handle_event
+from webhook import Session
+
+import connection
+import projectname
+import resource
+import settings
+import sys
+import threading
+import time
+
+
+class Scenario(object):
+    """A benchmarked workload.
+
+    ``setup`` prepares the database and is not measured, ``run`` is.
+    """
+
+    name = None
+    description = None
+
+    def __init__(self, api, options):
+        """Initializes the scenario.
+
+        :param api: FakeAPI the integration talks to
+        :param options: Benchmark options, see ``bench.run``
+        """
+        self.api = api
+        self.fixtures = api.fixtures
+        self.options = options
+
+    def setup(self):
+        Base.metadata.drop_all(Engine)
+        Base.metadata.create_all(Engine)
+
+    def run(self):
+        raise NotImplementedError
+
+    def backfill(self):
+        """Loads tw_project the way ``manage.py setup_db`` does"""
+        session = Session()
+        try:
+            TWProjectPipeline().insert_projects(session)
+        finally:
+            Session.remove()
+
+
+class SingleWebhook(Scenario):
+
+    name = 'single_webhook'
+    description = 'PROJECT.CREATED for a project without a project code'
+
+    def setup(self):
+        super(SingleWebhook, self).setup()
+        self.backfill()
+        self.project_id = None
+        for project_id in sorted(self.fixtures.tw_projects, key=int):
+            if not projectname.matches(self.fixtures.tw_projects[project_id]['name']):
+                self.project_id = project_id
+                break
+        if self.project_id is None:
+            raise ValueError('every project already has a project code')
+
+    def run(self):
+        handle_event(Teamwork.PROJECT_CREATED, self.project_id)
+        return {'events': 1}
+
+
+class ProjectUpdate(SingleWebhook):
+
+    name = 'project_update'
+    description = 'PROJECT.UPDATED for a known project without a project code'
+
+    def setup(self):
+        super(ProjectUpdate, self).setup()
+        project = self.fixtures.tw_projects[self.project_id]
+        company = self.fixtures.tw_companies[project['company']['id']]
+        session = Session()
+        try:
+            session.add(TWProject(tw_project_id=self.project_id,
+                                  company_abbr=company['address_one']))
+            session.commit()
+        finally:
+            Session.remove()
+
+    def run(self):
+        handle_event(Teamwork.PROJECT_UPDATED, self.project_id)
+        # The project code must reach Teamwork, not only Harvest
+        name = self.fixtures.tw_projects[self.project_id]['name']
+        if not projectname.matches(name):
+            raise ValueError('Teamwork project ' + self.project_id +
+                             ' was not renamed: ' + name)
+        return {'events': 1}
+
+
+class WebhookBurst(Scenario):
+
+    name = 'webhook_burst'
+    description = 'Queue a mix of webhook events and drain it with workers'
+
+    def setup(self):
+        super(WebhookBurst, self).setup()
+        self.backfill()
+        self.events = self.fixtures.sample_events(self.options['events'],
+                                                  seed=self.options['seed'])
+
+    def run(self):
+        for event_type, object_id in self.events:
+            event_queue.enqueue(event_type, object_id)
+
+        handled = [0] * self.options['workers']
+
+        def drain(worker):
+            while event_workers.run_once():
+                handled[worker] += 1
+
+        threads = [threading.Thread(target=drain, args=(worker,))
+                   for worker in range(self.options['workers'])]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return {'events': len(self.events), 'handled': sum(handled)}
+
+
+class SetupDB(Scenario):
+
+    name = 'setup_db'
+    description = 'Backfill tw_project from every Teamwork project'
+
+    def run(self):
+        self.backfill()
+        return {'projects': len(self.fixtures.tw_projects)}
+
+
+class TimeEntries(Scenario):
+
+    name = 'time_entries'
+    description = 'Push a day of Harvest time entries to Teamwork'
+
+    def run(self):
+        result = TimeImport().run() or {}
+        return {'entries': result.get('entries', 0)}
+
+
+SCENARIOS = OrderedDict((scenario.name, scenario) for scenario in
+                        (SingleWebhook, ProjectUpdate, WebhookBurst, SetupDB,
+                         TimeEntries))
+
+
+def measure(scenario):
+    """Runs a scenario and measures it
+
+    Peak memory is the resident set size of the whole process, which is
+    why every scenario runs in a process of its own.
+
+    :param scenario: Scenario
+    :return: Wall time, API calls, DB queries, peak memory and the
+        scenario's own counts
+    :rtype: dict
+    """
+    scenario.setup()
+
+    queries = [0]
+    lock = threading.Lock()
+
+    def count(*args, **kwargs):
+        with lock:
+            queries[0] += 1
+
+    scenario.api.reset()
+    event.listen(EngineClass, 'before_cursor_execute', count)
+    started = time.time()
+    try:
+        details = scenario.run()
+    finally:
+        wall = time.time() - started
+        event.remove(EngineClass, 'before_cursor_execute', count)
+
+    calls = scenario.api.get_call_count()
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and in kilobytes elsewhere
+    if sys.platform == 'darwin':
+        peak //= 1024
+    return dict(wall_seconds=wall,
+                api_calls=calls['total'],
+                teamwork_calls=calls['teamwork'],
+                harvest_calls=calls['harvest'],
+                db_queries=queries[0],
+                peak_rss_kb=peak,
+                details=details)
+
+
+def install(options):
+    """Points the integration at a fake API serving the benchmark fixtures
+
+    The settings must point at the fake API and the benchmark database
+    before the application modules are imported, see ``bench.run``.
+
+    :param options: Benchmark options
+    :return: Fake API
+    :rtype: bench.fakeapi.FakeAPI
+    """
+    api = fakeapi.FakeAPI(Fixtures.load(options['fixtures']),
+                          options['latency'])
+    fakeapi.install(api, connection.get_session(),
+                    (settings.TEAMWORK_BASE_URL, settings.HARVEST_BASE_URL))
+    return api
+
+
+def run(name, options):
+    """Runs one scenario against the fake API
+
+    :param name: Scenario name
+    :param options: Benchmark options
+    :return: Measurements, see ``measure``
+    :rtype: dict
+    """
+    return measure(SCENARIOS[name](install(options), options))
@@ -0,0 +1,127 @@
+from collections import OrderedDict
+
+import threading
+import time
+
+
+class TTLCache(object):
+    """Thread-safe LRU cache whose entries expire after a per-resource TTL.
+
+    Keys are tuples whose first element names the resource (e.g.
+    ``('projects', client_id)``), which selects the TTL and lets every
+    entry of a resource be invalidated at once.
+    """
+
+    def __init__(self, max_size, ttls, default_ttl=60):
+        """Initializes the cache.
+
+        :param max_size: Maximum number of entries kept
+        :param ttls: Dictionary of resource name to TTL in seconds
+        :param default_ttl: TTL for resources missing from ``ttls``
+        """
+        self.max_size = max_size
+        self.ttls = dict(ttls)
+        self.default_ttl = default_ttl
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self._entries = OrderedDict()
+        self._refreshed = {}
+        self._lock = threading.RLock()
+
+    def get(self, key, default=None):
+        """Retrieves a live entry and marks it as recently used
+
+        :param key: Entry key
+        :param default: Value returned on a miss
+        :return: Cached value
+        """
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is not None:
+                expires, value = entry
+                if expires > time.time():
+                    self._entries[key] = entry
+                    self.hits += 1
+                    return value
+                self.expirations += 1
+            self.misses += 1
+            return default
+
+    def set(self, key, value):
+        """Stores an entry, evicting the least recently used ones if full
+
+        :param key: Entry key
+        :param value: Value to cache
+        """
+        ttl = self.ttls.get(key[0], self.default_ttl)
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = (time.time() + ttl, value)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def get_or_load(self, key, loader):
+        """Read-through lookup; ``None`` results are not cached
+
+        :param key: Entry key
+        :param loader: Callable returning the value on a miss
+        :return: Cached or loaded value
+        """
+        value = self.get(key)
+        if value is None:
+            value = loader()
+            if value is not None:
+                self.set(key, value)
+        return value
+
+    def invalidate(self, resource, *args):
+        """Drops every entry whose key starts with ``(resource,) + args``,
+        so derived entries such as indexes go together with their listing
+
+        :param resource: Resource name
+        """
+        prefix = (resource,) + args
+        with self._lock:
+            for key in list(self._entries):
+                if key[:len(prefix)] == prefix:
+                    del self._entries[key]
+
+    def refresh(self, resource, min_interval):
+        """Invalidates a resource unless that was done less than
+        ``min_interval`` seconds ago, so repeated misses of something that
+        does not exist do not reload it every time
+
+        :param resource: Resource name
+        :param min_interval: Seconds between two refreshes
+        :return: True if the resource was invalidated
+        :rtype: bool
+        """
+        now = time.time()
+        with self._lock:
+            if now - self._refreshed.get(resource, 0) < min_interval:
+                return False
+            self._refreshed[resource] = now
+            self.invalidate(resource)
+            return True
+
+    def clear(self):
+        """Drops every entry"""
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        """Retrieves the cache counters
+
+        :return: Counters and current size
+        :rtype: dict
+        """
+        with self._lock:
+            return {'hits': self.hits,
+                    'misses': self.misses,
+                    'evictions': self.evictions,
+                    'expirations': self.expirations,
+                    'size': len(self._entries),
+                    'max_size': self.max_size}
@@ -0,0 +1,287 @@
+from email.utils import mktime_tz
+from email.utils import parsedate_tz
+
+from requests.adapters import HTTPAdapter
+
+import httplib
+import logging
+import metrics
+import os
+import random
+import requests
+import settings
+import threading
+import time
+import tracing
+import urlparse
+
+_lock = threading.Lock()
+_session = None
+_session_pid = None
+
+
+class TokenBucket(object):
+    """Token bucket pacing the requests made to one API host.
+
+    Callers take one token per request and sleep when the bucket is empty
+    or the host asked us to back off.
+    """
+
+    def __init__(self, rate, burst):
+        """Initializes the bucket.
+
+        :param rate: Tokens added per second
+        :param burst: Maximum number of tokens
+        """
+        self.rate = float(rate)
+        self.burst = float(burst)
+        self.tokens = float(burst)
+        self.updated = time.time()
+        self.paused_until = 0
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """Takes a token, sleeping until one is available"""
+        with self._lock:
+            now = time.time()
+            self.tokens = min(self.burst,
+                              self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= 1
+            wait = max(self.paused_until - now, -self.tokens / self.rate, 0)
+        if wait > 0:
+            time.sleep(wait)
+
+    def pause(self, seconds):
+        """Holds every request to the host for the given time
+
+        :param seconds: Seconds to wait
+        """
+        with self._lock:
+            self.paused_until = max(self.paused_until, time.time() + seconds)
+
+    def update(self, headers):
+        """Follows the rate limit headers of a response
+
+        :param headers: Response headers
+        """
+        remaining = headers.get('X-RateLimit-Remaining')
+        reset = headers.get('X-RateLimit-Reset')
+        if remaining is None or reset is None:
+            return
+        try:
+            remaining = int(remaining)
+            reset = float(reset)
+        except ValueError:
+            return
+        if remaining <= 0:
+            # The reset is either a delay or an epoch timestamp
+            self.pause(reset - time.time() if reset > 1e9 else reset)
+
+
+class PooledSession(requests.Session):
+    """A ``requests.Session`` that keeps sized, keep-alive connection pools
+    for the Teamwork and Harvest hosts, applies a default timeout and caps
+    the number of concurrent requests per host.
+
+    Requests are paced by a token bucket per host. Rate limited responses
+    (429/503) pause the host for ``Retry-After`` seconds, and idempotent
+    requests are retried with jittered exponential backoff.
+    """
+
+    # httplib has no constant for 429 Too Many Requests
+    RETRY_STATUSES = (429, httplib.SERVICE_UNAVAILABLE)
+    IDEMPOTENT_METHODS = ('GET', 'HEAD')
+
+    def __init__(self, pool_connections, pool_maxsize, timeout,
+                 host_concurrency, rate_limit, host_rate_limits,
+                 retry_attempts, retry_backoff):
+        """Initializes the session.
+
+        :param pool_connections: Number of per-host pools to keep
+        :param pool_maxsize: Number of keep-alive connections per host
+        :param timeout: Default (connect, read) timeout in seconds
+        :param host_concurrency: Maximum concurrent requests per host
+        :param rate_limit: Default (requests per second, burst) per host
+        :param host_rate_limits: Dictionary of host to (rate, burst)
+        :param retry_attempts: Retries of idempotent requests
+        :param retry_backoff: Base retry delay in seconds
+        """
+        super(PooledSession, self).__init__()
+        self.timeout = timeout
+        self.host_concurrency = host_concurrency
+        self.rate_limit = rate_limit
+        self.host_rate_limits = host_rate_limits
+        self.retry_attempts = retry_attempts
+        self.retry_backoff = retry_backoff
+        self._host_slots = {}
+        self._buckets = {}
+        self._host_lock = threading.Lock()
+        adapter = HTTPAdapter(pool_connections=pool_connections,
+                              pool_maxsize=pool_maxsize)
+        self.mount('https://', adapter)
+        self.mount('http://', adapter)
+
+    def host_slots(self, url):
+        """Retrieves the semaphore bounding concurrent requests to a host
+
+        :param url: Request URL
+        :return: Host semaphore
+        :rtype: threading.BoundedSemaphore
+        """
+        host = urlparse.urlparse(url).netloc
+        with self._host_lock:
+            slots = self._host_slots.get(host)
+            if slots is None:
+                slots = threading.BoundedSemaphore(self.host_concurrency)
+                self._host_slots[host] = slots
+        return slots
+
+    def bucket(self, url):
+        """Retrieves the token bucket pacing requests to a host
+
+        :param url: Request URL
+        :return: Host token bucket
+        :rtype: TokenBucket
+        """
+        host = urlparse.urlparse(url).netloc
+        with self._host_lock:
+            bucket = self._buckets.get(host)
+            if bucket is None:
+                rate, burst = self.host_rate_limits.get(host, self.rate_limit)
+                bucket = TokenBucket(rate, burst)
+                self._buckets[host] = bucket
+        return bucket
+
+    def request(self, method, url, **kwargs):
+        """Performs the request, using the default timeout if none is given
+        """
+        kwargs.setdefault('timeout', self.timeout)
+        bucket = self.bucket(url)
+        retries = self.retry_attempts if method.upper() in \
+            PooledSession.IDEMPOTENT_METHODS else 0
+
+        attempt = 0
+        while True:
+            bucket.acquire()
+            try:
+                with self.host_slots(url):
+                    started = time.time()
+                    req = super(PooledSession, self).request(
+                        method, url, **kwargs)
+            except (requests.ConnectionError, requests.Timeout):
+                self.record(method, url, 'error', started)
+                if attempt >= retries:
+                    raise
+                delay = self.get_backoff(attempt)
+                logging.warning('Retrying ' + method + ' ' + url +
+                                ' in {0:.1f} second(s) after a connection error'.format(delay))
+                time.sleep(delay)
+                attempt += 1
+                continue
+
+            self.record(method, url, req.status_code, started,
+                        self.get_size(req, kwargs.get('stream')))
+            bucket.update(req.headers)
+            if req.status_code not in PooledSession.RETRY_STATUSES:
+                return req
+
+            delay = self.get_retry_after(req)
+            if delay is None:
+                delay = self.get_backoff(attempt)
+            bucket.pause(delay)
+            if attempt >= retries:
+                return req
+
+            logging.warning('Rate limited by ' + url + ', retrying in ' +
+                            '{0:.1f} second(s)'.format(delay))
+            req.close()
+            attempt += 1
+
+    def record(self, method, url, status, started, size=0):
+        """Records the metrics of one API call and adds it to the trace of
+        the current thread
+
+        :param method: HTTP method
+        :param url: Request URL
+        :param status: Response status code, or 'error'
+        :param started: Start time of the call
+        :param size: Response size in bytes
+        """
+        seconds = time.time() - started
+        service, endpoint = metrics.get_endpoint(url)
+        metrics.api_calls.inc(service=service, method=method.upper(),
+                              endpoint=endpoint, status=status)
+        metrics.api_seconds.observe(seconds, service=service,
+                                    method=method.upper(), endpoint=endpoint)
+        tracing.record(method, url, status, seconds, size)
+
+    def get_size(self, req, stream=False):
+        """Reads the size of a response without consuming a streamed body
+
+        :param req: Response
+        :param stream: True if the body is streamed
+        :return: Size in bytes, 0 if unknown
+        :rtype: int
+        """
+        length = req.headers.get('Content-Length')
+        if length is not None and length.isdigit():
+            return int(length)
+        if stream:
+            return 0
+        return len(req.content)
+
+    def get_backoff(self, attempt):
+        """Computes a jittered exponential backoff delay
+
+        :param attempt: Zero-based retry attempt
+        :return: Delay in seconds
+        :rtype: float
+        """
+        delay = self.retry_backoff * (2 ** attempt)
+        return delay / 2.0 + random.uniform(0, delay / 2.0)
+
+    def get_retry_after(self, req):
+        """Reads the Retry-After header as seconds or an HTTP date
+
+        :param req: Response
+        :return: Delay in seconds or None if missing
+        :rtype: float
+        """
+        value = req.headers.get('Retry-After')
+        if value is None:
+            return None
+        try:
+            return max(float(value), 0)
+        except ValueError:
+            parsed = parsedate_tz(value)
+            if parsed is None:
+                return None
+            return max(mktime_tz(parsed) - time.time(), 0)
+
+
+def get_session():
+    """Retrieves the process-wide pooled session
+
+    The session is created lazily and re-created after a fork, so every
+    gunicorn worker owns its own pool.
+
+    :return: Shared session
+    :rtype: PooledSession
+    """
+    global _session, _session_pid
+
+    pid = os.getpid()
+    if _session is None or _session_pid != pid:
+        with _lock:
+            if _session is None or _session_pid != pid:
+                _session = PooledSession(settings.HTTP_POOL_CONNECTIONS,
+                                         settings.HTTP_POOL_MAXSIZE,
+                                         settings.HTTP_TIMEOUT,
+                                         settings.HTTP_HOST_CONCURRENCY,
+                                         settings.API_RATE_LIMIT,
+                                         settings.API_HOST_RATE_LIMITS,
+                                         settings.API_RETRY_ATTEMPTS,
+                                         settings.API_RETRY_BACKOFF)
+                _session_pid = pid
+    return _session
@@ -1,9 +1,16 @@
+from cache import TTLCache
+import connection
 import datetime
+import httpcache
 import httplib
+from index import build_index
+from index import normalize_email
+from index import PrefixIndex
+from jsonstream import iter_array
 import json
 from requests.auth import HTTPBasicAuth
 import logging
-import requests
+import settings
 
 
 class Harvest(object):
@@ -33,11 +40,29 @@ class Harvest(object):
     ENTRIES_URL = '/entries'
     DAY_ENTRY = 'day_entry'
     HOURS = 'hours'
+    SPENT_AT = 'spent_at'
+    UPDATED_AT = 'updated_at'
 
     BILL_BY = 'bill_by'
     TASKS = 'Tasks'
     PEOPLE = 'People'
 
+    # Cached resources
+    CLIENTS_CACHE = 'clients'
+    PEOPLE_CACHE = 'people'
+    PROJECTS_CACHE = 'projects'
+
+    # Size of the chunks streamed listings are parsed in
+    STREAM_CHUNK_SIZE = 64 * 1024
+
+    # Index suffixes of cached resources
+    BY_NAME = 'by_name'
+    BY_EMAIL = 'by_email'
+    BY_PREFIX = 'by_prefix'
+
+    # Process-wide read-through cache shared by every instance
+    cache = TTLCache(settings.HARVEST_CACHE_SIZE, settings.HARVEST_CACHE_TTL)
+
     def __init__(self, base_url, username, password):
         """Initializes the handler.
 
@@ -49,6 +74,8 @@ class Harvest(object):
         self.auth = HTTPBasicAuth(username, password)
         self.headers = {'Content-Type': 'application/json',
                         'Accept': 'application/json'}
+        self.session = connection.get_session()
+        self.validators = httpcache.get_cache()
 
     def get_clients(self):
         """Retrieves all the clients
@@ -56,22 +83,51 @@ class Harvest(object):
         :return: dictionary of clients
         :rtype: dict
         """
-        return self.get_request(self.base_url + Harvest.CLIENTS_URL)
+        return Harvest.cache.get_or_load(
+            (Harvest.CLIENTS_CACHE,),
+            lambda: self.get_list_request(self.base_url + Harvest.CLIENTS_URL))
+
+    def iter_clients(self):
+        """Iterates over all the clients without holding the whole list
+
+        :return: Clients
+        :rtype: generator
+        """
+        return self.iter_cached((Harvest.CLIENTS_CACHE,),
+                                self.base_url + Harvest.CLIENTS_URL)
 
     def get_client_by_name(self, name):
         """Retrieves client by name
 
+        A miss reloads the cached clients, since another process may have
+        created the client after they were cached, at most once per
+        ``settings.HARVEST_CACHE_REFRESH_INTERVAL``.
+
         :param name: name of client
         :return: client
         :rtype: dict
         """
-        clients = self.get_clients()
-        if not hasattr(clients, '__iter__'):
+        client = self.find_client(name)
+        if client is None and Harvest.cache.refresh(
+                Harvest.CLIENTS_CACHE, settings.HARVEST_CACHE_REFRESH_INTERVAL):
+            client = self.find_client(name)
+        return client
+
+    def find_client(self, name):
+        """Looks a client up in the cached clients
+
+        :param name: name of client
+        :return: client
+        :rtype: dict
+        """
+        index = self.get_index((Harvest.CLIENTS_CACHE,), self.get_clients,
+                               lambda clients: build_index(
+                                   clients,
+                                   lambda client: client[Harvest.CLIENT][Harvest.NAME]),
+                               Harvest.BY_NAME)
+        if index is None:
             return None
-        for client in clients:
-            if client[Harvest.CLIENT][Harvest.NAME] == name:
-                return client
-        return None
+        return index.get(name)
 
     def create_client(self, name):
         """Creates a client
@@ -82,6 +138,7 @@ class Harvest(object):
         """
         data = {Harvest.CLIENT: {Harvest.NAME: name}}
         location = self.post_request(self.base_url + Harvest.CLIENTS_URL, data)
+        Harvest.cache.invalidate(Harvest.CLIENTS_CACHE)
 
         if location is None:
             return location
@@ -98,6 +155,7 @@ class Harvest(object):
         data = {Harvest.CLIENT: {Harvest.NAME: name}}
         location = self.put_request(
             self.base_url + Harvest.CLIENT_URL + '/' + id, data)
+        Harvest.cache.invalidate(Harvest.CLIENTS_CACHE)
 
         if location is None:
             return location
@@ -109,11 +167,31 @@ class Harvest(object):
         :return: Projects
         :rtype: dict
         """
+        return Harvest.cache.get_or_load(
+            (Harvest.PROJECTS_CACHE, client_id),
+            lambda: self.get_list_request(self.get_projects_url(client_id)))
+
+    def iter_projects(self, client_id=None):
+        """Iterates over all projects without holding the whole list
+
+        :param client_id: Optional client ID to filter by
+        :return: Projects
+        :rtype: generator
+        """
+        return self.iter_cached((Harvest.PROJECTS_CACHE, client_id),
+                                self.get_projects_url(client_id))
+
+    def get_projects_url(self, client_id=None):
+        """Builds the projects URL, optionally filtered by client
+
+        :param client_id: Optional client ID
+        :return: URL
+        :rtype: str
+        """
         if client_id is None:
-            return self.get_request(self.base_url + Harvest.PROJECTS_URL)
-        else:
-            return self.get_request(self.base_url + Harvest.PROJECTS_URL +
-                                    '?client=' + str(client_id))
+            return self.base_url + Harvest.PROJECTS_URL
+        return self.base_url + Harvest.PROJECTS_URL + \
+            '?client=' + str(client_id)
 
     def get_project(self, project_id):
         """Retrieves project by ID
@@ -133,11 +211,15 @@ class Harvest(object):
         :rtype: dict
         """
         client = self.get_client_by_name(client_name)
-        projects = self.get_projects(client[Harvest.CLIENT][Harvest.ID])
-        if projects:
-            for project in projects:
-                if project[Harvest.PROJECT][Harvest.NAME] == name:
-                    return project
+        client_id = client[Harvest.CLIENT][Harvest.ID]
+        index = self.get_index((Harvest.PROJECTS_CACHE, client_id),
+                               lambda: self.get_projects(client_id),
+                               lambda projects: build_index(
+                                   projects,
+                                   lambda project: project[Harvest.PROJECT][Harvest.NAME]),
+                               Harvest.BY_NAME)
+        if index:
+            return index.get(name)
         return None
 
     def get_project_by_prefix(self, prefix, client_name):
@@ -150,12 +232,15 @@ class Harvest(object):
         """
         client = self.get_client_by_name(client_name)
         if client:
-            projects = self.get_projects(client[Harvest.CLIENT][Harvest.ID])
-            if projects:
-                for project in projects:
-                    if project[Harvest.PROJECT][Harvest.NAME].startswith(
-                            prefix):
-                        return project
+            client_id = client[Harvest.CLIENT][Harvest.ID]
+            index = self.get_index((Harvest.PROJECTS_CACHE, client_id),
+                                   lambda: self.get_projects(client_id),
+                                   lambda projects: PrefixIndex(
+                                       projects,
+                                       lambda project: project[Harvest.PROJECT][Harvest.NAME]),
+                                   Harvest.BY_PREFIX)
+            if index:
+                return index.find(prefix)
             else:
                 return None
         else:
@@ -171,6 +256,16 @@ class Harvest(object):
         return self.get_request(self.base_url + Harvest.PROJECTS_URL + '?updated_since=' +
                                 now.strftime("%Y-%m-%d+00:01"))
 
+    def get_updated_projects(self, updated_since):
+        """Retrieves projects that have been updated since the given time.
+
+        :param updated_since: UTC time
+        :return: Projects
+        :rtype: dict
+        """
+        return self.get_request(self.base_url + Harvest.PROJECTS_URL + '?updated_since=' +
+                                updated_since.strftime("%Y-%m-%d+%H:%M"))
+
     def update_project(self, project_id, name, client_id):
         """Updates a project using the project ID
 
@@ -190,6 +285,8 @@ class Harvest(object):
             '/' +
             str(project_id),
             data)
+        # The project may have moved between clients
+        Harvest.cache.invalidate(Harvest.PROJECTS_CACHE)
 
         if location is None:
             return location
@@ -210,6 +307,8 @@ class Harvest(object):
                 Harvest.BILL_BY: Harvest.TASKS}}
         location = self.post_request(
             self.base_url + Harvest.PROJECTS_URL, data)
+        Harvest.cache.invalidate(Harvest.PROJECTS_CACHE, client_id)
+        Harvest.cache.invalidate(Harvest.PROJECTS_CACHE, None)
 
         if location is None:
             return location
@@ -234,8 +333,11 @@ class Harvest(object):
         :rtype: str
         """
         data = {Harvest.USER: {Harvest.ID: user_id}}
-        return self.post_request(self.base_url + Harvest.PROJECTS_URL + '/' + str(project_id) +
-                                 Harvest.USER_ASSIGNMENTS_URL, data)
+        location = self.post_request(self.base_url + Harvest.PROJECTS_URL + '/' + str(project_id) +
+                                     Harvest.USER_ASSIGNMENTS_URL, data)
+        # Assignments bump the project's updated_at in the cached listings
+        Harvest.cache.invalidate(Harvest.PROJECTS_CACHE)
+        return location
 
     def remove_user_assignment(self, project_id, user_id):
         """Remove a user from the project
@@ -245,8 +347,10 @@ class Harvest(object):
         :return: Assignment location
         :rtype: str
         """
-        return self.delete_request(self.base_url + Harvest.PROJECTS_URL + '/' + str(project_id) +
-                                   Harvest.USER_ASSIGNMENTS_URL + '/' + str(user_id))
+        headers = self.delete_request(self.base_url + Harvest.PROJECTS_URL + '/' + str(project_id) +
+                                      Harvest.USER_ASSIGNMENTS_URL + '/' + str(user_id))
+        Harvest.cache.invalidate(Harvest.PROJECTS_CACHE)
+        return headers
 
     def get_people(self):
         """Retrieve all people
@@ -254,7 +358,28 @@ class Harvest(object):
         :return: People
         :rtype: dict
         """
-        return self.get_request(self.base_url + Harvest.PEOPLE_URL)
+        return Harvest.cache.get_or_load(
+            (Harvest.PEOPLE_CACHE,),
+            lambda: self.get_list_request(self.base_url + Harvest.PEOPLE_URL))
+
+    def iter_people(self):
+        """Iterate over all people without holding the whole list
+
+        :return: People
+        :rtype: generator
+        """
+        return self.iter_cached((Harvest.PEOPLE_CACHE,),
+                                self.base_url + Harvest.PEOPLE_URL)
+
+    def get_updated_people(self, updated_since):
+        """Retrieve people updated since the given time
+
+        :param updated_since: UTC time
+        :return: People
+        :rtype: list
+        """
+        return self.get_list_request(self.base_url + Harvest.PEOPLE_URL + '?updated_since=' +
+                                     updated_since.strftime("%Y-%m-%d+%H:%M"))
 
     def get_person(self, id):
         """Retrieve a person
@@ -273,12 +398,52 @@ class Harvest(object):
         :return: Person
         :rtype: dict
         """
-        people = self.get_people()
-        for person in people:
-            if person[Harvest.USER][Harvest.EMAIL].lower() == email.lower():
-                return person
+        index = self.get_people_index()
+        if index is not None and normalize_email(email) not in index:
+            # The person may have been added after the people were cached
+            index = self.get_people_index(refresh=True)
+        if index is None:
+            return None
+        return index.get(normalize_email(email))
 
-        return None
+    def get_people_index(self, refresh=False):
+        """Retrieve all people indexed by their case-folded email
+
+        :param refresh: Reload the cached people first, unless they were
+            reloaded less than ``settings.HARVEST_CACHE_REFRESH_INTERVAL``
+            seconds ago
+        :return: People by email
+        :rtype: dict
+        """
+        if refresh:
+            Harvest.cache.refresh(Harvest.PEOPLE_CACHE,
+                                  settings.HARVEST_CACHE_REFRESH_INTERVAL)
+        return self.get_index((Harvest.PEOPLE_CACHE,), self.get_people,
+                              lambda people: build_index(
+                                  people,
+                                  lambda person: normalize_email(
+                                      person[Harvest.USER][Harvest.EMAIL])),
+                              Harvest.BY_EMAIL)
+
+    def get_index(self, key, loader, builder, name):
+        """Retrieves an index over a cached listing, building it on a miss
+
+        The index is cached next to the listing it was built from and is
+        invalidated together with it.
+
+        :param key: Cache key of the listing
+        :param loader: Callable returning the listing
+        :param builder: Callable building the index from the listing
+        :param name: Index name
+        :return: Index
+        """
+        def build():
+            items = loader()
+            if not hasattr(items, '__iter__'):
+                return None
+            return builder(items)
+
+        return Harvest.cache.get_or_load(key + (name,), build)
 
     def get_todays_proj_time_entries(self, project_id):
         """Retrieves all of today's time entries for a project.
@@ -292,16 +457,36 @@ class Harvest(object):
                                 '?from=' + now.strftime("%Y%m%d") + '&' +
                                 'to=' + now.strftime("%Y%m%d"))
 
+    def get_updated_proj_time_entries(self, project_id, start, end,
+                                      updated_since):
+        """Retrieves a project's time entries spent between two dates that
+        have been updated since the given time.
+
+        :param project_id: Project ID
+        :param start: First day of the entries
+        :param end: Last day of the entries
+        :param updated_since: UTC time
+        :return: Time entries
+        :rtype: dict
+        """
+        return self.get_request(self.base_url + Harvest.PROJECTS_URL + '/' + str(project_id) + Harvest.ENTRIES_URL +
+                                '?from=' + start.strftime("%Y%m%d") + '&' +
+                                'to=' + end.strftime("%Y%m%d") + '&' +
+                                'updated_since=' + updated_since.strftime("%Y-%m-%d+%H:%M"))
+
     def get_request(self, url):
-        """Performs a GET request with the given url
+        """Performs a conditional GET request with the given url
+
+        An unchanged resource is served from the validator cache.
 
         :param url: URL to make the request against
         :return: Response
         :rtype: dict
         """
-        req = requests.get(url=url,
-                           auth=self.auth,
-                           headers=self.headers)
+        req = self.validators.get(self.session,
+                                  url,
+                                  auth=self.auth,
+                                  headers=self.headers)
 
         if req.status_code != httplib.OK:
             logging.error('Could not make GET request using url ' + url +
@@ -310,6 +495,97 @@ class Harvest(object):
 
         return req.json()
 
+    def iter_cached(self, key, url):
+        """Iterates over a cached listing, or streams it when not cached
+
+        :param key: Cache key of the listing
+        :param url: URL of the listing
+        :return: Records
+        :rtype: generator
+        """
+        items = Harvest.cache.get(key)
+        if items is not None:
+            return iter(items)
+        return self.iter_request(url)
+
+    def iter_request(self, url):
+        """Performs a GET request and yields the records of the returned
+        JSON array as they are parsed
+
+        Records of an unchanged cached list are yielded from the validator
+        cache. Streamed lists are not added to it, so memory stays bounded.
+
+        :param url: URL to make the request against
+        :return: Records
+        :rtype: generator
+        """
+        entry = self.validators.lookup(url)
+        req = self.open_stream(url, entry)
+        if req is None:
+            return iter(())
+        if req.status_code == httplib.NOT_MODIFIED:
+            return iter(self.validators.reuse(req, entry))
+        return self.iter_response(req)
+
+    def get_list_request(self, url):
+        """Performs a conditional GET request and parses the returned JSON
+        array in chunks
+
+        An unchanged list is served from the validator cache.
+
+        :param url: URL to make the request against
+        :return: Records or None if the request failed
+        :rtype: list
+        """
+        entry = self.validators.lookup(url)
+        req = self.open_stream(url, entry)
+        if req is None:
+            return None
+        if req.status_code == httplib.NOT_MODIFIED:
+            return self.validators.reuse(req, entry)
+
+        records = list(self.iter_response(req))
+        self.validators.store(url, req.headers, records)
+        return records
+
+    def open_stream(self, url, entry=None):
+        """Performs a GET request without reading the body
+
+        :param url: URL to make the request against
+        :param entry: Validator cache entry to make the request conditional
+        :return: Response, which is a 304 if the cached entry is still
+            valid, or None if the request failed
+        :rtype: requests.Response
+        """
+        req = self.session.get(url=url,
+                               auth=self.auth,
+                               headers=self.validators.get_headers(
+                                   entry, self.headers),
+                               stream=True)
+
+        if req.status_code == httplib.NOT_MODIFIED and entry is not None:
+            return req
+        if req.status_code != httplib.OK:
+            logging.error('Could not make GET request using url ' + url +
+                          ' Response headers: ' + str(req.headers))
+            req.close()
+            return None
+
+        return req
+
+    def iter_response(self, req):
+        """Yields the records of a streamed JSON array response
+
+        :param req: Streamed response
+        :return: Records
+        :rtype: generator
+        """
+        try:
+            for record in iter_array(req.iter_content(Harvest.STREAM_CHUNK_SIZE)):
+                yield record
+        finally:
+            req.close()
+
     def post_request(self, url, data):
         """Performs a POST request with the given url and data
 
@@ -318,10 +594,10 @@ class Harvest(object):
         :return: Response location
         :rtype: str
         """
-        req = requests.post(url=url,
-                            auth=self.auth,
-                            data=json.dumps(data),
-                            headers=self.headers)
+        req = self.session.post(url=url,
+                                auth=self.auth,
+                                data=json.dumps(data),
+                                headers=self.headers)
 
         if req.status_code != httplib.CREATED:
             logging.error('Could not make POST request using url ' + url + ' with data ' + json.dumps(data) +
@@ -338,10 +614,10 @@ class Harvest(object):
         :return: Response location
         :rtype: str
         """
-        req = requests.put(url=url,
-                           auth=self.auth,
-                           data=json.dumps(data),
-                           headers=self.headers)
+        req = self.session.put(url=url,
+                               auth=self.auth,
+                               data=json.dumps(data),
+                               headers=self.headers)
 
         if req.status_code != httplib.OK:
             logging.error('Could not make PUT request using url ' + url + ' with data ' + json.dumps(data) +
@@ -357,9 +633,9 @@ class Harvest(object):
         :return: Response
         :rtype: str
         """
-        req = requests.delete(url=url,
-                              auth=self.auth,
-                              headers=self.headers)
+        req = self.session.delete(url=url,
+                                  auth=self.auth,
+                                  headers=self.headers)
 
         if req.status_code != httplib.OK:
             logging.error('Could not make DELETE request using url ' + url +
@@ -0,0 +1,245 @@
+from collections import OrderedDict
+
+from requests.structures import CaseInsensitiveDict
+
+import hashlib
+import httplib
+import json
+import logging
+import os
+import requests
+import settings
+import tempfile
+import threading
+
+_lock = threading.Lock()
+_cache = None
+_cache_pid = None
+
+
+class CachedResponse(object):
+    """A successful GET response whose JSON body was parsed once.
+
+    The body may be shared with the validator cache and other callers, so
+    it must be treated as read-only.
+    """
+
+    def __init__(self, url, status_code, headers, body):
+        self.url = url
+        self.status_code = status_code
+        self.headers = headers
+        self.body = body
+
+    def json(self):
+        return self.body
+
+
+class ValidatorCache(object):
+    """Bounded LRU of parsed GET responses keyed by URL, stored with their
+    ``ETag`` and ``Last-Modified`` validators.
+
+    Requests for a cached URL are made conditional, and a ``304 Not
+    Modified`` reuses the cached body instead of downloading and parsing it
+    again. Entries can also be written to a directory, one file per URL, so
+    they survive worker restarts and are shared between workers.
+    """
+
+    def __init__(self, max_size, directory=None):
+        """Initializes the cache.
+
+        :param max_size: Maximum number of entries kept in memory
+        :param directory: Optional directory to persist entries in
+        """
+        self.max_size = max_size
+        self.directory = directory
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def get(self, session, url, **kwargs):
+        """Performs a conditional GET request
+
+        :param session: Session to use
+        :param url: URL to make the request against
+        :param kwargs: Arguments of ``session.get``
+        :return: The cached response on 200 and 304, otherwise the raw
+            response
+        :rtype: CachedResponse
+        """
+        key = requests.Request('GET', url, params=kwargs.get('params')).prepare().url
+        entry = self.lookup(key)
+        kwargs['headers'] = self.get_headers(entry, kwargs.get('headers'))
+        req = session.get(url, **kwargs)
+
+        if req.status_code == httplib.NOT_MODIFIED and entry is not None:
+            headers = CaseInsensitiveDict(entry['headers'])
+            headers.update(req.headers)
+            return CachedResponse(req.url, httplib.OK, headers,
+                                  self.reuse(req, entry))
+        if req.status_code != httplib.OK:
+            return req
+
+        body = req.json()
+        self.store(key, req.headers, body)
+        return CachedResponse(req.url, req.status_code, req.headers, body)
+
+    def lookup(self, url):
+        """Retrieves the entry of a URL, loading it from disk on a miss
+
+        :param url: Full request URL
+        :return: Entry with the validators, headers and body, or None
+        :rtype: dict
+        """
+        with self._lock:
+            entry = self._entries.pop(url, None)
+            if entry is not None:
+                self._entries[url] = entry
+                return entry
+
+        entry = self._load(url)
+        if entry is not None:
+            self._remember(url, entry)
+        return entry
+
+    def get_headers(self, entry, headers=None):
+        """Adds the validators of an entry to the request headers
+
+        :param entry: Entry or None
+        :param headers: Request headers
+        :return: New request headers
+        :rtype: dict
+        """
+        headers = dict(headers or {})
+        if entry is not None:
+            if entry['etag']:
+                headers['If-None-Match'] = entry['etag']
+            if entry['last_modified']:
+                headers['If-Modified-Since'] = entry['last_modified']
+        return headers
+
+    def reuse(self, req, entry):
+        """Serves the body of an entry for a ``304 Not Modified`` response
+
+        :param req: 304 response, closed by this call
+        :param entry: Cached entry
+        :return: Cached body
+        """
+        req.close()
+        with self._lock:
+            self.hits += 1
+        return entry['body']
+
+    def store(self, url, headers, body):
+        """Caches a parsed body if the response carries validators
+
+        :param url: Full request URL
+        :param headers: Response headers
+        :param body: Parsed body
+        """
+        with self._lock:
+            self.misses += 1
+        etag = headers.get('ETag')
+        last_modified = headers.get('Last-Modified')
+        if not etag and not last_modified:
+            self.discard(url)
+            return
+
+        entry = dict(etag=etag,
+                     last_modified=last_modified,
+                     headers=dict(headers),
+                     body=body)
+        self._remember(url, entry)
+        self._save(url, entry)
+
+    def discard(self, url):
+        """Drops the entry of a URL
+
+        :param url: Full request URL
+        """
+        with self._lock:
+            self._entries.pop(url, None)
+        self._remove(url)
+
+    def stats(self):
+        """Retrieves the cache statistics
+
+        :return: Hits (304 responses), misses, evictions and size
+        :rtype: dict
+        """
+        with self._lock:
+            return dict(hits=self.hits,
+                        misses=self.misses,
+                        evictions=self.evictions,
+                        size=len(self._entries),
+                        max_size=self.max_size)
+
+    def _remember(self, url, entry):
+        evicted = []
+        with self._lock:
+            self._entries.pop(url, None)
+            self._entries[url] = entry
+            while len(self._entries) > self.max_size:
+                evicted.append(self._entries.popitem(last=False)[0])
+                self.evictions += 1
+        # Evicted entries leave the disk too, keeping the store bounded
+        for evicted_url in evicted:
+            self._remove(evicted_url)
+
+    def _path(self, url):
+        return os.path.join(self.directory,
+                            hashlib.sha1(url.encode('utf-8')).hexdigest() + '.json')
+
+    def _load(self, url):
+        if not self.directory:
+            return None
+        try:
+            with open(self._path(url)) as f:
+                stored = json.load(f)
+        except (IOError, ValueError):
+            return None
+        if stored.get('url') != url:
+            return None
+        return stored['entry']
+
+    def _save(self, url, entry):
+        if not self.directory:
+            return
+        try:
+            fd, path = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+            with os.fdopen(fd, 'w') as f:
+                json.dump(dict(url=url, entry=entry), f)
+            # Atomic, so concurrent workers never read a partial entry
+            os.rename(path, self._path(url))
+        except (IOError, OSError, TypeError, ValueError) as error:
+            logging.warning('Could not persist the cached response of ' +
+                            url + ': ' + str(error))
+
+    def _remove(self, url):
+        if not self.directory:
+            return
+        try:
+            os.remove(self._path(url))
+        except OSError:
+            pass
+
+
+def get_cache():
+    """Retrieves the process-wide validator cache
+
+    :return: Shared validator cache
+    :rtype: ValidatorCache
+    """
+    global _cache, _cache_pid
+
+    pid = os.getpid()
+    if _cache is None or _cache_pid != pid:
+        with _lock:
+            if _cache is None or _cache_pid != pid:
+                _cache = ValidatorCache(settings.HTTP_VALIDATOR_CACHE_SIZE,
+                                        settings.HTTP_VALIDATOR_CACHE_DIR)
+                _cache_pid = pid
+    return _cache
@@ -0,0 +1,74 @@
+import bisect
+
+
+def normalize_email(email):
+    """Normalizes an email address for case-insensitive comparison
+
+    :param email: Email address
+    :return: Case-folded email address
+    :rtype: str
+    """
+    if email is None:
+        return None
+    return email.strip().lower()
+
+
+def build_index(items, key):
+    """Builds a dictionary index over a list of records
+
+    The first record wins when several records share a key, matching a
+    linear scan over the same list.
+
+    :param items: Records to index
+    :param key: Callable returning the index key of a record
+    :return: Index of key to record
+    :rtype: dict
+    """
+    index = {}
+    for item in items:
+        index.setdefault(key(item), item)
+    return index
+
+
+class PrefixIndex(object):
+    """Sorted index answering prefix lookups with a binary search."""
+
+    def __init__(self, items, key):
+        """Initializes the index.
+
+        :param items: Records to index
+        :param key: Callable returning the string key of a record
+        """
+        pairs = sorted(((key(item), position, item)
+                        for position, item in enumerate(items)),
+                       key=lambda pair: (pair[0], pair[1]))
+        self.keys = [pair[0] for pair in pairs]
+        self.items = [pair[2] for pair in pairs]
+
+    def find(self, prefix):
+        """Retrieves the record with the smallest key starting with prefix
+
+        :param prefix: Key prefix
+        :return: Record or None
+        """
+        position = bisect.bisect_left(self.keys, prefix)
+        if position < len(self.keys) and self.keys[position].startswith(prefix):
+            return self.items[position]
+        return None
+
+    def find_all(self, prefix):
+        """Retrieves every record whose key starts with prefix
+
+        :param prefix: Key prefix
+        :return: Records in key order
+        :rtype: list
+        """
+        position = bisect.bisect_left(self.keys, prefix)
+        matches = []
+        while position < len(self.keys) and self.keys[position].startswith(prefix):
+            matches.append(self.items[position])
+            position += 1
+        return matches
+
+    def __len__(self):
+        return len(self.keys)
@@ -0,0 +1,403 @@
+from jobs.models import TWDeadEvent
+from jobs.models import TWEvent
+from jobs.models import TWEventEcho
+
+from sqlalchemy.exc import SQLAlchemyError
+
+import datetime
+import logging
+import metrics
+import os
+import random
+import threading
+import traceback
+
+
+class EventQueue(object):
+    """Durable queue of Teamwork webhook events stored in ``tw_event``.
+
+    Events are claimed with a conditional UPDATE so that workers in several
+    gunicorn processes can drain the same table. Failed events are retried
+    with exponential backoff and moved to ``tw_event_dead`` once they run
+    out of attempts.
+
+    Events for the same (event type, object ID) arriving within the
+    coalescing window collapse into the pending one. Events of an object
+    with an expected echo of our own write are queued apart instead, so
+    the handler can drop the one whose fetched state is what we wrote, see
+    ``consume_echo``.
+    """
+
+    PENDING = 'pending'
+    RUNNING = 'running'
+
+    def __init__(self, session_factory, max_attempts, backoff,
+                 stale_after, coalesce_window=0, echo_ttl=0, logger=None):
+        """Initializes the queue.
+
+        :param session_factory: Callable returning a SQLAlchemy session
+        :param max_attempts: Attempts before an event is dead-lettered
+        :param backoff: Base retry delay in seconds, doubled per attempt
+        :param stale_after: Seconds after which a running event is
+            considered abandoned by a dead worker and released
+        :param coalesce_window: Seconds a new event waits for duplicates
+        :param echo_ttl: Seconds an expected echo event stays registered
+        :param logger: Logger to report failures to
+        """
+        self.session_factory = session_factory
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.stale_after = stale_after
+        self.coalesce_window = coalesce_window
+        self.echo_ttl = echo_ttl
+        self.logger = logger or logging.getLogger(__name__)
+
+    def enqueue(self, event, object_id):
+        """Persists an event for the workers
+
+        :param event: Webhook event type
+        :param object_id: Teamwork object ID
+        :return: Queued event ID
+        :rtype: int
+        """
+        session = self.session_factory()
+        try:
+            now = datetime.datetime.utcnow()
+            due = now + datetime.timedelta(seconds=self.coalesce_window)
+            record = None
+            # A user's event merged with our echo would be dropped with it
+            echo = session.query(TWEventEcho.id).filter(
+                TWEventEcho.event == event,
+                TWEventEcho.object_id == object_id,
+                TWEventEcho.expires_at > now).first()
+            if echo is None:
+                record = session.query(TWEvent).filter(
+                    TWEvent.event == event,
+                    TWEvent.object_id == object_id,
+                    TWEvent.status == EventQueue.PENDING).order_by(
+                    TWEvent.id).first()
+            if record is not None:
+                record.coalesced += 1
+                if record.next_attempt_at > due:
+                    record.next_attempt_at = due
+                self.logger.debug(
+                    'Coalesced event ' + event + ' ' + object_id)
+            else:
+                record = TWEvent(event=event,
+                                 object_id=object_id,
+                                 status=EventQueue.PENDING,
+                                 attempts=0,
+                                 coalesced=0,
+                                 created_at=now,
+                                 next_attempt_at=due)
+                session.add(record)
+            session.commit()
+            return record.id
+        except SQLAlchemyError:
+            session.rollback()
+            raise
+        finally:
+            session.close()
+
+    def expect_echo(self, event, object_id, fingerprint):
+        """Registers the webhook event our own write is about to trigger
+
+        :param event: Webhook event type
+        :param object_id: Teamwork object ID
+        :param fingerprint: What the write sets, e.g. the new project name
+        :return: Echo ID
+        :rtype: int
+        """
+        session = self.session_factory()
+        try:
+            echo = TWEventEcho(event=event,
+                               object_id=object_id,
+                               fingerprint=fingerprint,
+                               expires_at=datetime.datetime.utcnow() +
+                               datetime.timedelta(seconds=self.echo_ttl))
+            session.add(echo)
+            session.commit()
+            return echo.id
+        except SQLAlchemyError:
+            session.rollback()
+            raise
+        finally:
+            session.close()
+
+    def discard_echo(self, echo_id):
+        """Removes an expected echo whose write did not happen
+
+        :param echo_id: Echo ID
+        """
+        session = self.session_factory()
+        try:
+            session.query(TWEventEcho).filter(
+                TWEventEcho.id == echo_id).delete(synchronize_session=False)
+            session.commit()
+        except SQLAlchemyError:
+            session.rollback()
+            raise
+        finally:
+            session.close()
+
+    def consume_echo(self, event, object_id, fingerprint):
+        """Removes one live expected echo of the event if the object is in
+        the state our write left it in
+
+        A user's change of anything the fingerprint does not cover may
+        still be taken for the echo, but each echo is consumed once, so the
+        other of the two events is handled and sees the user's change.
+
+        :param event: Webhook event type
+        :param object_id: Teamwork object ID
+        :param fingerprint: Fetched state of the object, see ``expect_echo``
+        :return: True if the event was an expected echo
+        :rtype: bool
+        """
+        session = self.session_factory()
+        try:
+            echoes = session.query(TWEventEcho.id).filter(
+                TWEventEcho.event == event,
+                TWEventEcho.object_id == object_id,
+                TWEventEcho.fingerprint == fingerprint,
+                TWEventEcho.expires_at > datetime.datetime.utcnow()).order_by(
+                TWEventEcho.id).all()
+            for (echo_id,) in echoes:
+                deleted = session.query(TWEventEcho).filter(
+                    TWEventEcho.id == echo_id).delete(synchronize_session=False)
+                session.commit()
+                if deleted == 1:
+                    return True
+            return False
+        except SQLAlchemyError:
+            session.rollback()
+            raise
+        finally:
+            session.close()
+
+    def claim(self):
+        """Claims the next due event
+
+        :return: The claimed event, detached from its session
+        :rtype: TWEvent
+        """
+        session = self.session_factory()
+        try:
+            now = datetime.datetime.utcnow()
+            candidates = session.query(TWEvent.id).filter(
+                TWEvent.status == EventQueue.PENDING,
+                TWEvent.next_attempt_at <= now).order_by(
+                TWEvent.next_attempt_at).limit(10).all()
+
+            for (event_id,) in candidates:
+                claimed = session.query(TWEvent).filter(
+                    TWEvent.id == event_id,
+                    TWEvent.status == EventQueue.PENDING).update(
+                    {TWEvent.status: EventQueue.RUNNING,
+                     TWEvent.claimed_at: now},
+                    synchronize_session=False)
+                session.commit()
+                if claimed == 1:
+                    record = session.query(TWEvent).get(event_id)
+                    session.expunge(record)
+                    return record
+            return None
+        except SQLAlchemyError:
+            session.rollback()
+            raise
+        finally:
+            session.close()
+
+    def complete(self, record):
+        """Removes a successfully handled event
+
+        :param record: Claimed event
+        """
+        session = self.session_factory()
+        try:
+            session.query(TWEvent).filter(
+                TWEvent.id == record.id).delete(synchronize_session=False)
+            session.commit()
+        except SQLAlchemyError:
+            session.rollback()
+            raise
+        finally:
+            session.close()
+
+    def fail(self, record, error):
+        """Schedules a retry for a failed event or dead-letters it
+
+        :param record: Claimed event
+        :param error: Description of the failure
+        """
+        attempts = record.attempts + 1
+        session = self.session_factory()
+        try:
+            if attempts >= self.max_attempts:
+                session.add(TWDeadEvent(id=record.id,
+                                        event=record.event,
+                                        object_id=record.object_id,
+                                        attempts=attempts,
+                                        created_at=record.created_at,
+                                        last_error=error))
+                session.query(TWEvent).filter(
+                    TWEvent.id == record.id).delete(synchronize_session=False)
+                self.logger.error(
+                    'Event {0} for object {1} failed {2} time(s), moved to dead letters'.format(
+                        record.event, record.object_id, attempts))
+            else:
+                delay = self.backoff * (2 ** (attempts - 1))
+                delay += random.uniform(0, delay / 2.0)
+                session.query(TWEvent).filter(
+                    TWEvent.id == record.id).update(
+                    {TWEvent.status: EventQueue.PENDING,
+                     TWEvent.attempts: attempts,
+                     TWEvent.claimed_at: None,
+                     TWEvent.last_error: error,
+                     TWEvent.next_attempt_at: datetime.datetime.utcnow() +
+                     datetime.timedelta(seconds=delay)},
+                    synchronize_session=False)
+                self.logger.warning(
+                    'Event {0} for object {1} failed, retrying in {2:.0f} second(s)'.format(
+                        record.event, record.object_id, delay))
+            session.commit()
+        except SQLAlchemyError:
+            session.rollback()
+            raise
+        finally:
+            session.close()
+
+    def release_stale(self):
+        """Returns events claimed by workers that died back to the queue and
+        drops expired echoes
+
+        An abandoned claim counts as a failed attempt, so an event that
+        crashes or hangs its worker is retried with backoff and
+        dead-lettered like one whose handler raises.
+
+        :return: Number of released events
+        :rtype: int
+        """
+        session = self.session_factory()
+        try:
+            now = datetime.datetime.utcnow()
+            cutoff = now - datetime.timedelta(seconds=self.stale_after)
+            stale = session.query(TWEvent).filter(
+                TWEvent.status == EventQueue.RUNNING,
+                TWEvent.claimed_at < cutoff).all()
+
+            released = 0
+            for record in stale:
+                # Renewing the claim lets a single process release the event
+                claimed = session.query(TWEvent).filter(
+                    TWEvent.id == record.id,
+                    TWEvent.status == EventQueue.RUNNING,
+                    TWEvent.claimed_at < cutoff).update(
+                    {TWEvent.claimed_at: now},
+                    synchronize_session=False)
+                session.commit()
+                if claimed == 1:
+                    self.fail(record, 'Abandoned by its worker for more than '
+                                      '{0} second(s)'.format(self.stale_after))
+                    released += 1
+
+            session.query(TWEventEcho).filter(
+                TWEventEcho.expires_at <= now).delete(
+                synchronize_session=False)
+            session.commit()
+            return released
+        except SQLAlchemyError:
+            session.rollback()
+            raise
+        finally:
+            session.close()
+
+
+class EventWorkerPool(object):
+    """Background threads draining an ``EventQueue``."""
+
+    def __init__(self, queue, handler, workers, poll_interval, logger=None):
+        """Initializes the pool.
+
+        :param queue: Queue to drain
+        :param handler: Callable taking (event, object_id)
+        :param workers: Number of worker threads
+        :param poll_interval: Seconds to wait when the queue is empty
+        :param logger: Logger to report failures to
+        """
+        self.queue = queue
+        self.handler = handler
+        self.workers = workers
+        self.poll_interval = poll_interval
+        self.logger = logger or logging.getLogger(__name__)
+        self._wakeup = threading.Event()
+        self._stopped = threading.Event()
+        self._threads = []
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def start(self):
+        """Starts the worker threads once per process"""
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            self._stopped.clear()
+            self._threads = []
+            for number in range(self.workers):
+                thread = threading.Thread(target=self.run,
+                                          name='event-worker-%d' % number)
+                thread.daemon = True
+                thread.start()
+                self._threads.append(thread)
+
+    def stop(self):
+        """Stops the worker threads after their current event"""
+        self._stopped.set()
+        self._wakeup.set()
+        for thread in self._threads:
+            thread.join()
+
+    def notify(self):
+        """Wakes idle workers after an event was queued"""
+        self._wakeup.set()
+
+    def run(self):
+        """Worker loop"""
+        while not self._stopped.is_set():
+            try:
+                if not self.run_once():
+                    self.queue.release_stale()
+                    self._wakeup.wait(self.poll_interval)
+                    self._wakeup.clear()
+            except SQLAlchemyError:
+                self.logger.exception('Could not read the event queue')
+                self._stopped.wait(self.poll_interval)
+
+    def run_once(self):
+        """Handles the next due event
+
+        :return: True if an event was handled
+        :rtype: bool
+        """
+        record = self.queue.claim()
+        if record is None:
+            return False
+
+        try:
+            self.handler(record.event, record.object_id)
+        except Exception:
+            self.logger.exception(
+                'Could not handle event {0} for object {1}'.format(
+                    record.event, record.object_id))
+            self.queue.fail(record, traceback.format_exc())
+            outcome = 'failed'
+        else:
+            self.queue.complete(record)
+            outcome = 'done'
+
+        latency = datetime.datetime.utcnow() - record.created_at
+        metrics.event_latency_seconds.observe(latency.total_seconds(),
+                                              event=record.event,
+                                              outcome=outcome)
+        return True
@@ -0,0 +1,127 @@
+from harvest import Harvest
+
+from index import normalize_email
+
+from jobs.models import PersonIdentity
+from jobs.models import SyncWatermark
+
+from teamwork import Teamwork
+
+import datetime
+import logging
+
+
+class IdentityMap(object):
+    """Maps people across Harvest and Teamwork by case-folded email.
+
+    The map is persisted in ``person_identity``. Harvest people are
+    refreshed incrementally from the ``identities`` sync watermark and the
+    Teamwork people list is diffed against the stored rows, so only changed
+    identities are written.
+    """
+
+    WATERMARK = 'identities'
+
+    def __init__(self, teamwork, harvest):
+        """Initializes the map.
+
+        :param teamwork: Teamwork client
+        :param harvest: Harvest client
+        """
+        self.teamwork = teamwork
+        self.harvest = harvest
+        self.by_email = {}
+        self.by_h_user = {}
+
+    def load(self, session):
+        """Loads the stored identities
+
+        :param session: Database session
+        """
+        self.by_email = {}
+        self.by_h_user = {}
+        for identity in session.query(PersonIdentity):
+            self.remember(identity.email, identity.h_user_id,
+                          identity.tw_person_id)
+
+    def refresh(self, session):
+        """Loads the stored identities and merges the people changed in
+        Harvest and Teamwork since the last refresh
+
+        :param session: Database session
+        """
+        self.load(session)
+        started = datetime.datetime.utcnow()
+
+        watermark = session.query(SyncWatermark).get(IdentityMap.WATERMARK)
+        if watermark is None:
+            h_people = self.harvest.get_people()
+        else:
+            h_people = self.harvest.get_updated_people(watermark.synced_until)
+        tw_people = self.teamwork.get_people()
+        if h_people is None or tw_people is None:
+            logging.error('Could not refresh the people identity map')
+            return
+
+        changed = {}
+
+        def lookup(email):
+            return changed.get(email, self.by_email.get(email, (None, None)))
+
+        for person in h_people:
+            email = normalize_email(person[Harvest.USER][Harvest.EMAIL])
+            h_user_id = str(person[Harvest.USER][Harvest.ID])
+            previous_email = self.by_h_user.get(h_user_id)
+            if previous_email is not None and previous_email != email:
+                # The user's email changed, release the old identity
+                changed[previous_email] = (None, lookup(previous_email)[1])
+            if lookup(email)[0] != h_user_id:
+                changed[email] = (h_user_id, lookup(email)[1])
+        for person in tw_people[Teamwork.PEOPLE]:
+            email = normalize_email(person[Teamwork.EMAIL_DASH_ADDRESS])
+            tw_person_id = str(person[Teamwork.ID])
+            h_user_id, known_tw_person_id = lookup(email)
+            if known_tw_person_id != tw_person_id:
+                changed[email] = (h_user_id, tw_person_id)
+
+        for email, (h_user_id, tw_person_id) in changed.items():
+            session.merge(PersonIdentity(email=email,
+                                         h_user_id=h_user_id,
+                                         tw_person_id=tw_person_id))
+            self.remember(email, h_user_id, tw_person_id)
+        session.merge(SyncWatermark(name=IdentityMap.WATERMARK,
+                                    synced_until=started))
+        session.commit()
+        logging.debug('Updated {0} people identities'.format(len(changed)))
+
+    def remember(self, email, h_user_id, tw_person_id):
+        """Adds an identity to the in-memory indexes
+
+        :param email: Case-folded email
+        :param h_user_id: Harvest user ID
+        :param tw_person_id: Teamwork person ID
+        """
+        self.by_email[email] = (h_user_id, tw_person_id)
+        if h_user_id is not None:
+            self.by_h_user[h_user_id] = email
+
+    def get_tw_person_id(self, h_user_id):
+        """Resolves the Teamwork person of a Harvest user
+
+        Users missing from the map (e.g. created after the last refresh) are
+        looked up in Harvest once and remembered.
+
+        :param h_user_id: Harvest user ID
+        :return: Teamwork person ID or None
+        :rtype: str
+        """
+        h_user_id = str(h_user_id)
+        email = self.by_h_user.get(h_user_id)
+        if email is None:
+            h_user = self.harvest.get_person(h_user_id)
+            if h_user is None:
+                return None
+            email = normalize_email(h_user[Harvest.USER][Harvest.EMAIL])
+            self.remember(email, h_user_id,
+                          self.by_email.get(email, (None, None))[1])
+        return self.by_email[email][1]
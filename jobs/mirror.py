@@ -0,0 +1,81 @@
+from jobs.models import TWProject
+
+import logging
+import os
+import threading
+
+
+class TWProjectMirror(object):
+    """In-process read-through copy of ``tw_project``.
+
+    Maps tw_project_id to (company_abbr, company_job_id). The table is small
+    and only written by this service, so every process loads it with one
+    SELECT on first use, reads rows it has not seen yet (e.g. written by
+    another worker) through to the database, and records its own writes
+    once they are committed.
+
+    Rows are never removed, so a hit reliably tells that a project is
+    known, but its abbreviation and number may have been changed by
+    another process since; writes must read the row from the database.
+    """
+
+    def __init__(self):
+        self._projects = {}
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def warm(self, session):
+        """Loads every project with a single query
+
+        :param session: Database session
+        """
+        rows = session.query(TWProject.tw_project_id,
+                             TWProject.company_abbr,
+                             TWProject.company_job_id).all()
+        projects = dict((tw_project_id, (company_abbr, company_job_id))
+                        for tw_project_id, company_abbr, company_job_id in rows)
+        with self._lock:
+            self._projects = projects
+            self._pid = os.getpid()
+        logging.debug('Loaded {0} TW projects'.format(len(projects)))
+
+    def get(self, session, tw_project_id):
+        """Looks up a project, reading it from the database on a miss
+
+        :param session: Database session
+        :param tw_project_id: Project ID
+        :return: (company_abbr, company_job_id) or None if the project is
+            not in tw_project
+        :rtype: tuple
+        """
+        tw_project_id = str(tw_project_id)
+        if self._pid != os.getpid():
+            # Projects loaded before a fork may be stale in the child
+            self.warm(session)
+
+        project = self._projects.get(tw_project_id)
+        if project is None:
+            row = session.query(TWProject.company_abbr,
+                                TWProject.company_job_id).filter(
+                TWProject.tw_project_id == tw_project_id).first()
+            if row is not None:
+                project = tuple(row)
+                self.put(tw_project_id, *project)
+        return project
+
+    def put(self, tw_project_id, company_abbr, company_job_id):
+        """Records a committed project
+
+        :param tw_project_id: Project ID
+        :param company_abbr: Company abbreviation
+        :param company_job_id: Company job ID
+        """
+        with self._lock:
+            self._projects[str(tw_project_id)] = (company_abbr,
+                                                  int(company_job_id))
+
+    def clear(self):
+        """Drops every project, the next lookup reloads the table"""
+        with self._lock:
+            self._projects = {}
+            self._pid = None
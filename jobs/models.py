@@ -1,8 +1,11 @@
 from sqlalchemy import Column
+from sqlalchemy import DateTime
+from sqlalchemy import Index
 from sqlalchemy import Integer
 from sqlalchemy import String
 from sqlalchemy import Sequence
 from sqlalchemy import Table
+from sqlalchemy import Text
 
 from sqlalchemy import create_engine
 from sqlalchemy import UniqueConstraint
@@ -10,33 +13,247 @@ from sqlalchemy import sql
 
 from sqlalchemy.engine.url import URL
 
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.exc import TimeoutError
+
+from sqlalchemy.pool import QueuePool
+
 from sqlalchemy.ext.declarative import declarative_base
 
+import datetime
+import os
 import settings
+import threading
+import time
 
 Base = declarative_base()
 
+# Keys of ``settings.DATABASE`` passed to the connection pool, not the URL
+POOL_OPTIONS = ('pool_size', 'max_overflow', 'pool_timeout', 'pool_recycle',
+                'pool_pre_ping')
+
+
+class JobIdAllocator(object):
+    """Allocates company_job_id values from the ``tw_company_seq`` table.
+
+    Every process reserves blocks of IDs per company with an atomic,
+    row-locked increment committed in its own short transaction and hands
+    them out from memory, so concurrent workers never pick the same number
+    and most allocations need no round-trip. A block is only shared once
+    its reservation has committed. Reservations of a company are serialized
+    per process, but the lock guarding the blocks is never held across a
+    database round-trip, so a reservation waiting for the row lock only
+    stalls the allocations of its company. IDs left in a block when a
+    process exits or a row is rolled back are skipped.
+    """
+
+    def __init__(self, block_size):
+        """Initializes the allocator.
+
+        :param block_size: Number of IDs reserved per round-trip
+        """
+        self.block_size = block_size
+        self._blocks = {}
+        self._reserving = {}
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def allocate(self, engine, company_abbr):
+        """Allocates the next company_job_id of a company
+
+        :param engine: Engine to reserve blocks with
+        :param company_abbr: Company abbreviation
+        :return: Job ID
+        :rtype: int
+        """
+        with self._lock:
+            if self._pid != os.getpid():
+                # Blocks reserved before a fork belong to the parent
+                self._blocks = {}
+                self._reserving = {}
+                self._pid = os.getpid()
+
+            job_id = self.take(company_abbr)
+            if job_id is not None:
+                return job_id
+            reserving = self._reserving.setdefault(company_abbr,
+                                                   threading.Lock())
+
+        with reserving:
+            with self._lock:
+                # Another thread may have reserved a block meanwhile
+                job_id = self.take(company_abbr)
+            if job_id is not None:
+                return job_id
+
+            start = self.reserve(engine, company_abbr, self.block_size)
+            with self._lock:
+                self._blocks[company_abbr] = [start + 1, start + self.block_size]
+            return start
+
+    def take(self, company_abbr):
+        """Takes the next ID of a company's block, the lock must be held
+
+        :param company_abbr: Company abbreviation
+        :return: Job ID, or None if the block is missing or used up
+        :rtype: int
+        """
+        block = self._blocks.get(company_abbr)
+        if block is None or block[0] >= block[1]:
+            return None
+        job_id = block[0]
+        block[0] += 1
+        return job_id
+
+    def reserve(self, engine, company_abbr, count):
+        """Reserves a block of IDs in a separate transaction
+
+        The block never starts below the highest company_job_id in
+        tw_project, so rows written with explicit IDs (e.g. by the backfill)
+        are skipped.
+
+        :param engine: Engine to use
+        :param company_abbr: Company abbreviation
+        :param count: Number of IDs to reserve
+        :return: First reserved ID
+        :rtype: int
+        """
+        sequence = TWCompanySequence.__table__
+        while True:
+            try:
+                with engine.begin() as connection:
+                    next_job_id = connection.execute(
+                        sql.select([sequence.c.next_job_id]).where(
+                            sequence.c.company_abbr == company_abbr
+                        ).with_for_update()
+                    ).scalar()
+                    max_job_id = connection.execute(
+                        sql.select(
+                            [sql.func.coalesce(sql.func.max(TWProject.company_job_id), 99)]
+                        ).where(
+                            TWProject.company_abbr == company_abbr
+                        )
+                    ).scalar()
+                    start = max(next_job_id or 0, max_job_id + 1)
+
+                    if next_job_id is None:
+                        connection.execute(sequence.insert().values(
+                            company_abbr=company_abbr,
+                            next_job_id=start + count))
+                    else:
+                        connection.execute(sequence.update().where(
+                            sequence.c.company_abbr == company_abbr
+                        ).values(next_job_id=start + count))
+                    return start
+            except IntegrityError:
+                # Another worker created the company's sequence first
+                continue
+
+
+job_ids = JobIdAllocator(settings.COMPANY_JOB_ID_BLOCK_SIZE)
+
 
 def default_company_job_id(context):
-    return context.connection.execute(
-        sql.select(
-            [sql.func.ifnull(sql.func.max(TWProject.company_job_id), 99) + 1]
-        ).where(
-            TWProject.company_abbr == context.current_parameters[
-                'company_abbr']
-        )
-    ).scalar()
+    return job_ids.allocate(context.connection.engine,
+                            context.current_parameters['company_abbr'])
+
+
+class TimedQueuePool(QueuePool):
+    """A ``QueuePool`` that keeps checkout statistics.
+
+    The time spent in a checkout covers waiting for a free connection and
+    opening a new one when the pool may still grow.
+    """
+
+    def __init__(self, creator, **kw):
+        super(TimedQueuePool, self).__init__(creator, **kw)
+        self._stats_lock = threading.Lock()
+        self.checkouts = 0
+        self.timeouts = 0
+        self.wait_seconds = 0.0
+        self.max_wait_seconds = 0.0
+
+    def _do_get(self):
+        started = time.time()
+        try:
+            connection = super(TimedQueuePool, self)._do_get()
+        except TimeoutError:
+            with self._stats_lock:
+                self.timeouts += 1
+            raise
+        finally:
+            waited = time.time() - started
+            with self._stats_lock:
+                self.wait_seconds += waited
+                self.max_wait_seconds = max(self.max_wait_seconds, waited)
+        with self._stats_lock:
+            self.checkouts += 1
+        return connection
+
+    def stats(self):
+        """Retrieves the pool statistics
+
+        :return: Pool size, connections in use and overflow, and the number,
+            timeouts and total and maximum wait time of checkouts
+        :rtype: dict
+        """
+        with self._stats_lock:
+            return dict(size=self.size(),
+                        checked_out=self.checkedout(),
+                        overflow=max(self.overflow(), 0),
+                        checkouts=self.checkouts,
+                        timeouts=self.timeouts,
+                        wait_seconds=self.wait_seconds,
+                        max_wait_seconds=self.max_wait_seconds)
 
 
 def connect_to_database():
     """
     Creates an instance of ``Engine`` (sqlalchemy.engine.base.Engine)
 
+    The pool is configured from the ``POOL_OPTIONS`` keys of
+    ``settings.DATABASE``. SQLite databases keep SQLAlchemy's default pool,
+    which cannot be sized.
+
     Example:
         >>> from jobs.models import *
         >>> engine = connect_to_database()
     """
-    return create_engine(URL(**settings.DATABASE), echo=settings.DEBUG)
+    database = dict(settings.DATABASE)
+    options = dict((key, database.pop(key))
+                   for key in POOL_OPTIONS if key in database)
+    url = URL(**database)
+
+    if url.get_backend_name() == 'sqlite':
+        options = dict((key, value) for key, value in options.items()
+                       if key in ('pool_recycle', 'pool_pre_ping'))
+    else:
+        options['poolclass'] = TimedQueuePool
+    return create_engine(url, echo=settings.DEBUG, **options)
+
+
+def get_pool_stats(engine):
+    """Retrieves the connection pool statistics of an engine
+
+    :param engine: Engine
+    :return: Pool statistics, see ``TimedQueuePool.stats``, or None if the
+        pool does not keep any
+    :rtype: dict
+    """
+    if isinstance(engine.pool, TimedQueuePool):
+        return engine.pool.stats()
+    return None
+
+
+class TWCompanySequence(Base):
+
+    __table__ = Table('tw_company_seq', Base.metadata,
+                      Column('company_abbr', String(16), primary_key=True),
+                      Column('next_job_id', Integer, nullable=False))
+
+    def __repr__(self):
+        return 'company_abbr = {0}, next_job_id = {1}'.format(
+            self.company_abbr, self.next_job_id)
 
 
 class TWProject(Base):
@@ -58,3 +275,104 @@ class TWProject(Base):
     def __repr__(self):
         return 'tw_project_id = {0}, company_abbr = {1}, company_job_id = {2}'.format(
             self.tw_project_id, self.company_abbr, self.company_job_id)
+
+
+class SyncWatermark(Base):
+
+    __table__ = Table('sync_watermark', Base.metadata,
+                      Column('name', String(32), primary_key=True),
+                      Column('synced_until', DateTime, nullable=False))
+
+    def __repr__(self):
+        return 'name = {0}, synced_until = {1}'.format(
+            self.name, self.synced_until)
+
+
+class HSyncedEntry(Base):
+
+    __table__ = Table('h_synced_entry', Base.metadata,
+                      Column('h_entry_id', String(16), primary_key=True),
+                      Column('tw_entry_id', String(16)),
+                      Column('synced_at',
+                             DateTime,
+                             nullable=False,
+                             default=datetime.datetime.utcnow))
+
+    def __repr__(self):
+        return 'h_entry_id = {0}, tw_entry_id = {1}, synced_at = {2}'.format(
+            self.h_entry_id, self.tw_entry_id, self.synced_at)
+
+
+class PersonIdentity(Base):
+
+    __table__ = Table('person_identity', Base.metadata,
+                      Column('email', String(255), primary_key=True),
+                      Column('h_user_id', String(16), index=True),
+                      Column('tw_person_id', String(16)),
+                      Column('updated_at',
+                             DateTime,
+                             nullable=False,
+                             default=datetime.datetime.utcnow,
+                             onupdate=datetime.datetime.utcnow))
+
+    def __repr__(self):
+        return 'email = {0}, h_user_id = {1}, tw_person_id = {2}'.format(
+            self.email, self.h_user_id, self.tw_person_id)
+
+
+class TWEvent(Base):
+
+    __table__ = Table('tw_event', Base.metadata,
+                      Column('id', Integer, primary_key=True),
+                      Column('event', String(32), nullable=False),
+                      Column('object_id', String(16), nullable=False),
+                      Column('status', String(16), nullable=False),
+                      Column('attempts', Integer, nullable=False, default=0),
+                      Column('coalesced', Integer, nullable=False, default=0),
+                      Column('created_at',
+                             DateTime,
+                             nullable=False,
+                             default=datetime.datetime.utcnow),
+                      Column('next_attempt_at', DateTime, nullable=False),
+                      Column('claimed_at', DateTime),
+                      Column('last_error', Text),
+                      Index('tw_event_due_ix', 'status', 'next_attempt_at'),
+                      Index('tw_event_object_ix', 'event', 'object_id', 'status'))
+
+    def __repr__(self):
+        return 'id = {0}, event = {1}, object_id = {2}, status = {3}, attempts = {4}'.format(
+            self.id, self.event, self.object_id, self.status, self.attempts)
+
+
+class TWDeadEvent(Base):
+
+    __table__ = Table('tw_event_dead', Base.metadata,
+                      Column('id', Integer, primary_key=True),
+                      Column('event', String(32), nullable=False),
+                      Column('object_id', String(16), nullable=False),
+                      Column('attempts', Integer, nullable=False),
+                      Column('created_at', DateTime, nullable=False),
+                      Column('failed_at',
+                             DateTime,
+                             nullable=False,
+                             default=datetime.datetime.utcnow),
+                      Column('last_error', Text))
+
+    def __repr__(self):
+        return 'id = {0}, event = {1}, object_id = {2}, attempts = {3}'.format(
+            self.id, self.event, self.object_id, self.attempts)
+
+
+class TWEventEcho(Base):
+
+    __table__ = Table('tw_event_echo', Base.metadata,
+                      Column('id', Integer, primary_key=True),
+                      Column('event', String(32), nullable=False),
+                      Column('object_id', String(16), nullable=False),
+                      Column('fingerprint', String(255), nullable=False),
+                      Column('expires_at', DateTime, nullable=False),
+                      Index('tw_event_echo_object_ix', 'event', 'object_id'))
+
+    def __repr__(self):
+        return 'id = {0}, event = {1}, object_id = {2}, fingerprint = {3}, expires_at = {4}'.format(
+            self.id, self.event, self.object_id, self.fingerprint, self.expires_at)
@@ -3,13 +3,17 @@ from flask import Flask
 
 from jobs.models import TWProject
 
+from sqlalchemy.dialects import mysql
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.dialects import sqlite
 from sqlalchemy.exc import SQLAlchemyError
 
+from teamwork import IncompleteListingError
 from teamwork import Teamwork
 
 from webhook import application
 
-import re
+import projectname
 import settings
 
 
@@ -34,32 +38,78 @@ class TWProjectPipeline(object):
         finally:
             session.close()
 
-    def insert_projects(self, session):
-        projects = self.teamwork.get_projects()
-        if projects:
-            for project in projects[Teamwork.PROJECTS]:
-                name = project[Teamwork.NAME]
-                tw_project_id = project[Teamwork.ID]
-
-                if re.match(settings.TEAMWORK_PROJECT_NAME_SCHEME,
-                            name) is not None:
-                    temp_company_abbr = re.sub('^[0-9]{4}-', '', name)
-                    temp_company_abbr = re.sub(
-                        '-[0-9]+ .*$', '', temp_company_abbr)
-
-                    temp_company_job_id = re.sub('^[0-9]{4}-[A-Z]+-', '', name)
-                    temp_company_job_id = re.search(
-                        '^[0-9]+', temp_company_job_id).group(0)
-
-                    data = dict(tw_project_id=tw_project_id,
-                                company_abbr=temp_company_abbr,
-                                company_job_id=int(temp_company_job_id))
-
-                    self.process_project(data, session)
-
-            project_count = int(session.query(TWProject).count())
-            application.logger.debug(
-                'Done. Added {0} project(s) to database'.format(project_count))
-        else:
-            application.logger.critical('Could not retrieve project(s) from Teamwork.')
+    def insert_projects(self, session, bulk=True, chunk_size=None):
+        """Inserts the Teamwork projects following the project name scheme
+
+        In bulk mode every name is parsed first and the rows are written in
+        one transaction with batched inserts that skip existing projects in
+        the database. Otherwise every project is committed on its own.
+
+        :param session: Database session
+        :param bulk: Use batched inserts in a single transaction
+        :param chunk_size: Rows per batched insert, defaults to
+            ``settings.PROJECT_BACKFILL_CHUNK_SIZE``
+        """
+        rows = []
+        try:
+            for projects in self.teamwork.iter_project_pages():
+                for project, name in projectname.parse_many(
+                        projects, lambda project: project[Teamwork.NAME]):
+                    data = dict(tw_project_id=project[Teamwork.ID],
+                                company_abbr=name.abbr,
+                                company_job_id=name.job_id)
+
+                    if bulk:
+                        rows.append(data)
+                    else:
+                        self.process_project(data, session)
+        except IncompleteListingError as error:
+            application.logger.critical(
+                'Could not retrieve project(s) from Teamwork: {0}'.format(str(error)))
             abort(404)
+
+        if bulk:
+            self.bulk_insert_projects(
+                rows, session, chunk_size or settings.PROJECT_BACKFILL_CHUNK_SIZE)
+
+        project_count = int(session.query(TWProject).count())
+        application.logger.debug(
+            'Done. Added {0} project(s) to database'.format(project_count))
+
+    def bulk_insert_projects(self, rows, session, chunk_size):
+        """Writes project rows in one transaction, ignoring rows that
+        conflict with existing projects
+
+        :param rows: Project rows
+        :param session: Database session
+        :param chunk_size: Rows per batched insert
+        """
+        statement = self.get_insert_ignore(session.get_bind().dialect.name)
+        try:
+            for offset in range(0, len(rows), chunk_size):
+                session.execute(statement, rows[offset:offset + chunk_size])
+            session.commit()
+        except SQLAlchemyError as error:
+            application.logger.critical(
+                'Failed to commit Teamwork projects to database: {0}'.format(
+                    str(error)))
+            session.rollback()
+            raise
+
+    def get_insert_ignore(self, dialect):
+        """Builds an INSERT into tw_project that skips conflicting rows
+
+        :param dialect: Database dialect name
+        :return: Insert statement
+        """
+        table = TWProject.__table__
+        if dialect == 'mysql':
+            # Assigning the column to itself is a no-op, so the existing row
+            # wins on either unique key like the other dialects
+            return mysql.insert(table).on_duplicate_key_update(
+                tw_project_id=table.c.tw_project_id)
+        if dialect == 'postgresql':
+            return postgresql.insert(table).on_conflict_do_nothing()
+        if dialect == 'sqlite':
+            return sqlite.insert(table).on_conflict_do_nothing()
+        return table.insert()
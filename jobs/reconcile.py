@@ -0,0 +1,438 @@
+from assignments import diff_assignments
+
+from collections import namedtuple
+
+from harvest import Harvest
+
+from index import build_index
+from index import normalize_email
+
+from parallel import parallel_map
+from parallel import run_parallel
+
+from teamwork import Teamwork
+
+from webhook import application
+from webhook import event_queue
+
+import projectname
+import settings
+import threading
+
+Change = namedtuple('Change', ['action', 'args', 'description'])
+
+Snapshot = namedtuple('Snapshot', ['tw_projects', 'tw_companies', 'tw_people',
+                                   'h_clients', 'h_projects', 'h_people'])
+
+
+class CallBudget(object):
+    """Counts the API calls of a reconciliation run against a fixed budget.
+
+    The budget is installed as a response hook of the shared HTTP session,
+    so every page of a listing and every retry is counted.
+    """
+
+    def __init__(self, limit):
+        """Initializes the budget.
+
+        :param limit: Maximum number of API calls
+        """
+        self.limit = limit
+        self.used = 0
+        self._lock = threading.Lock()
+
+    def count(self, response, *args, **kwargs):
+        """Response hook counting one call"""
+        with self._lock:
+            self.used += 1
+
+    def remaining(self):
+        """Retrieves the number of calls left
+
+        :return: Calls left
+        :rtype: int
+        """
+        with self._lock:
+            return max(self.limit - self.used, 0)
+
+
+class Reconciler(object):
+    """Repairs the Harvest side of the integration in bulk.
+
+    Full snapshots of both services are joined in memory on project prefix,
+    company abbreviation and email to find:
+
+    * Teamwork companies without a Harvest client
+    * Active Teamwork projects without a prefix or with a stale company
+      abbreviation, which need a job ID and are replayed through the
+      webhook event queue
+    * Harvest projects missing, misnamed or under the wrong client
+    * Harvest assignments differing from the Teamwork project people
+
+    Changes are applied in batches of concurrent calls. Assignments are read
+    per project, most recently changed projects first, until the API-call
+    budget runs out; the rest are checked by a later run.
+    """
+
+    CREATE_CLIENT = 'create_client'
+    REPLAY_EVENT = 'replay_event'
+    CREATE_PROJECT = 'create_project'
+    UPDATE_PROJECT = 'update_project'
+    ADD_USER = 'add_user'
+    REMOVE_USER = 'remove_user'
+
+    # Most API calls an action makes. Creating or updating a project looks
+    # its client up first, which may load the clients and reload them once
+    # on a miss.
+    COSTS = {CREATE_CLIENT: 1,
+             REPLAY_EVENT: 0,
+             CREATE_PROJECT: 3,
+             UPDATE_PROJECT: 3,
+             ADD_USER: 1,
+             REMOVE_USER: 1}
+
+    def __init__(self, budget=None, batch_size=None, dry_run=False):
+        """Initializes the reconciler.
+
+        :param budget: Maximum number of API calls, defaults to
+            ``settings.RECONCILE_API_BUDGET``
+        :param batch_size: Calls per concurrent batch, defaults to
+            ``settings.RECONCILE_BATCH_SIZE``
+        :param dry_run: Only report the changes
+        """
+        self.teamwork = Teamwork(settings.TEAMWORK_BASE_URL,
+                                 settings.TEAMWORK_USER,
+                                 settings.TEAMWORK_PASS)
+        self.harvest = Harvest(settings.HARVEST_BASE_URL,
+                               settings.HARVEST_USER,
+                               settings.HARVEST_PASS)
+        self.budget = CallBudget(budget or settings.RECONCILE_API_BUDGET)
+        self.batch_size = batch_size or settings.RECONCILE_BATCH_SIZE
+        self.dry_run = dry_run
+        self.changes = []
+        self.stats = dict(checked=0, skipped=0, unresolved=0, failed=0)
+
+    def run(self):
+        """Reconciles Teamwork and Harvest
+
+        :return: Number of changes per action, projects whose assignments
+            were checked or skipped, unresolved people, failed calls and API
+            calls used, or None if a snapshot could not be taken
+        :rtype: dict
+        """
+        hooks = self.harvest.session.hooks['response']
+        hooks.append(self.budget.count)
+        try:
+            snapshot = self.snapshot()
+            if snapshot is None:
+                application.logger.error(
+                    'Could not take the Teamwork and Harvest snapshots')
+                return None
+            self.reconcile(snapshot)
+        finally:
+            hooks.remove(self.budget.count)
+
+        summary = dict(self.stats, calls=self.budget.used)
+        for change in self.changes:
+            summary[change.action] = summary.get(change.action, 0) + 1
+        return summary
+
+    def snapshot(self):
+        """Fetches every listing the reconciliation joins, concurrently
+
+        :return: Snapshot or None if a listing failed
+        :rtype: Snapshot
+        """
+        tw_projects, tw_companies, tw_people, h_clients, h_projects, h_people = run_parallel([
+            (self.teamwork.get_projects, (True,)),
+            (self.teamwork.get_companies, ()),
+            (self.teamwork.get_people, ()),
+            (self.harvest.get_clients, ()),
+            (self.harvest.get_projects, ()),
+            (self.harvest.get_people, ())])
+        if None in (tw_projects, tw_companies, tw_people,
+                    h_clients, h_projects, h_people):
+            return None
+        return Snapshot(tw_projects[Teamwork.PROJECTS],
+                        tw_companies[Teamwork.COMPANIES],
+                        tw_people[Teamwork.PEOPLE],
+                        h_clients, h_projects, h_people)
+
+    def reconcile(self, snapshot):
+        """Computes and applies the change set of a snapshot
+
+        :param snapshot: Snapshot
+        """
+        abbrs = {}
+        for company in snapshot.tw_companies:
+            abbr = (company.get(Teamwork.COMPANY_ABBR) or '').strip()
+            if abbr:
+                abbrs[str(company[Teamwork.ID])] = abbr
+
+        clients = self.get_client_index(snapshot.h_clients)
+        missing = sorted(set(abbrs.values()) - set(clients))
+        self.apply([Change(Reconciler.CREATE_CLIENT, (abbr,),
+                           'create Harvest client ' + abbr)
+                    for abbr in missing])
+        if missing and not self.dry_run:
+            clients = self.get_client_index(self.harvest.get_clients() or [])
+
+        changes, matched = self.diff_projects(
+            snapshot.tw_projects, abbrs, clients, snapshot.h_projects)
+        self.apply(changes)
+        self.reconcile_assignments(matched, snapshot.tw_people,
+                                   snapshot.h_people)
+
+    def get_client_index(self, h_clients):
+        """Indexes Harvest clients by name
+
+        :param h_clients: Harvest clients
+        :return: Clients by name
+        :rtype: dict
+        """
+        return build_index(h_clients,
+                           lambda client: client[Harvest.CLIENT][Harvest.NAME])
+
+    def diff_projects(self, tw_projects, abbrs, clients, h_projects):
+        """Joins Teamwork and Harvest projects on the project prefix
+
+        :param tw_projects: Teamwork projects
+        :param abbrs: Company abbreviations by Teamwork company ID
+        :param clients: Harvest clients by name
+        :param h_projects: Harvest projects
+        :return: Project changes, and the (Teamwork project, Harvest project)
+            pairs that exist on both sides
+        :rtype: tuple
+        """
+        by_prefix = build_index(
+            projectname.parse_many(
+                h_projects,
+                lambda h_project: h_project[Harvest.PROJECT][Harvest.NAME]),
+            lambda pair: projectname.format_prefix(
+                pair[1].date, pair[1].abbr, pair[1].job_id))
+
+        changes = []
+        matched = []
+        for tw_project in tw_projects:
+            tw_project_id = str(tw_project[Teamwork.ID])
+            name = tw_project[Teamwork.NAME]
+            abbr = abbrs.get(str(tw_project[Teamwork.COMPANY][Teamwork.ID]))
+            if abbr is None:
+                # Projects of companies without an abbreviation are left alone
+                continue
+
+            parsed_name = projectname.parse(name)
+            if parsed_name is None or parsed_name.abbr != abbr:
+                # The listing includes archived and completed projects,
+                # which are not renamed
+                if tw_project.get(Teamwork.STATUS) != Teamwork.ACTIVE:
+                    continue
+                changes.append(Change(
+                    Reconciler.REPLAY_EVENT, (tw_project_id,),
+                    'replay ' + Teamwork.PROJECT_UPDATED +
+                    ' for Teamwork project "' + name + '"'))
+                continue
+
+            pair = by_prefix.get(projectname.format_prefix(
+                parsed_name.date, parsed_name.abbr, parsed_name.job_id))
+            if pair is None:
+                changes.append(Change(
+                    Reconciler.CREATE_PROJECT, (name, abbr),
+                    'create Harvest project "' + name + '" for client ' + abbr))
+                continue
+
+            h_project = pair[0][Harvest.PROJECT]
+            client = clients.get(abbr)
+            moved = client is not None and \
+                h_project[Harvest.CLIENT_ID] != client[Harvest.CLIENT][Harvest.ID]
+            if h_project[Harvest.NAME] != name or moved:
+                changes.append(Change(
+                    Reconciler.UPDATE_PROJECT, (h_project[Harvest.ID], name, abbr),
+                    'update Harvest project "' + h_project[Harvest.NAME] +
+                    '" to "' + name + '" for client ' + abbr))
+            matched.append((tw_project, h_project))
+
+        return changes, matched
+
+    def reconcile_assignments(self, matched, tw_people, h_people):
+        """Compares the people of the matched projects batch by batch
+
+        :param matched: (Teamwork project, Harvest project) pairs
+        :param tw_people: Teamwork people
+        :param h_people: Harvest people
+        """
+        tw_emails = dict((str(person[Teamwork.ID]),
+                          normalize_email(person[Teamwork.EMAIL_DASH_ADDRESS]))
+                         for person in tw_people)
+        h_emails = dict((str(person[Harvest.USER][Harvest.ID]),
+                         normalize_email(person[Harvest.USER][Harvest.EMAIL]))
+                        for person in h_people)
+        h_people_index = build_index(
+            h_people,
+            lambda person: normalize_email(person[Harvest.USER][Harvest.EMAIL]))
+
+        # A project listed without its people would look empty and lose
+        # every assignment, so it is not compared at all
+        complete = []
+        for tw_project, h_project in matched:
+            if tw_project.get(Teamwork.PEOPLE) is not None:
+                complete.append((tw_project, h_project))
+            else:
+                self.stats['failed'] += 1
+                application.logger.error(
+                    'Teamwork project "' + tw_project[Teamwork.NAME] +
+                    '" was listed without its people')
+        matched = complete
+
+        # Spend the budget on the projects most likely to have drifted
+        matched = sorted(
+            matched,
+            key=lambda pair: pair[0].get(Teamwork.LAST_CHANGED_ON) or '',
+            reverse=True)
+
+        start = 0
+        while start < len(matched):
+            count = min(self.batch_size, self.budget.remaining())
+            if count == 0:
+                self.stats['skipped'] += len(matched) - start
+                application.logger.warning(
+                    'API call budget exhausted, skipped the assignments of ' +
+                    str(len(matched) - start) + ' project(s)')
+                return
+            batch = matched[start:start + count]
+            start += count
+
+            assignments = parallel_map(
+                lambda pair: self.harvest.get_project_people(
+                    pair[1][Harvest.ID]),
+                batch)
+            changes = []
+            for (tw_project, h_project), assigned in zip(batch, assignments):
+                if assigned is None:
+                    self.stats['failed'] += 1
+                    continue
+                self.stats['checked'] += 1
+                changes.extend(self.diff_project_people(
+                    tw_project, h_project, assigned,
+                    tw_emails, h_emails, h_people_index))
+            self.apply(changes)
+
+    def diff_project_people(self, tw_project, h_project, assigned,
+                            tw_emails, h_emails, h_people_index):
+        """Compares the people of a project by case-folded email
+
+        :param tw_project: Teamwork project including its people IDs,
+            which must be present
+        :param h_project: Harvest project
+        :param assigned: Harvest user assignments of the project
+        :param tw_emails: Case-folded emails by Teamwork person ID
+        :param h_emails: Case-folded emails by Harvest user ID
+        :param h_people_index: Harvest people by case-folded email
+        :return: Assignment changes
+        :rtype: list
+        """
+        name = h_project[Harvest.NAME]
+        wanted = [tw_emails[str(person_id)]
+                  for person_id in tw_project[Teamwork.PEOPLE]
+                  if str(person_id) in tw_emails]
+        current = {}
+        for assignment in assigned:
+            user_id = str(assignment[Harvest.USER_ASSIGNMENT][Harvest.USER_ID])
+            # Assignments of unknown Harvest people are left alone
+            if user_id in h_emails:
+                current[user_id] = h_emails[user_id]
+
+        diff = diff_assignments(wanted, current, h_people_index)
+        for email in sorted(diff.unresolved):
+            self.stats['unresolved'] += 1
+            application.logger.warning(
+                'No user with this email "' + email + '" exists in Harvest.')
+
+        changes = []
+        for user_id, email in sorted(diff.remove.items()):
+            changes.append(Change(
+                Reconciler.REMOVE_USER, (h_project[Harvest.ID], user_id),
+                'remove ' + email + ' from Harvest project "' + name + '"'))
+        for user_id, email in sorted(diff.add.items()):
+            changes.append(Change(
+                Reconciler.ADD_USER, (h_project[Harvest.ID], user_id),
+                'assign ' + email + ' to Harvest project "' + name + '"'))
+        return changes
+
+    def apply(self, changes):
+        """Applies changes in batches of concurrent calls within the budget
+
+        A batch only takes the changes whose most API calls, see
+        ``Reconciler.COSTS``, fit in what is left of the budget. In dry-run
+        mode the changes are only recorded.
+
+        :param changes: Changes
+        """
+        if not changes:
+            return
+        if self.dry_run:
+            self.changes.extend(changes)
+            return
+
+        for start in range(0, len(changes), self.batch_size):
+            batch = changes[start:start + self.batch_size]
+            remaining = self.budget.remaining()
+            count = 0
+            for change in batch:
+                remaining -= Reconciler.COSTS[change.action]
+                if remaining < 0:
+                    break
+                count += 1
+            exhausted = count < len(batch)
+            if exhausted:
+                self.stats['skipped'] += len(changes) - start - count
+                application.logger.warning(
+                    'API call budget exhausted, skipped ' +
+                    str(len(changes) - start - count) + ' change(s)')
+                batch = batch[:count]
+
+            results = parallel_map(self.apply_change, batch)
+            for change, result in zip(batch, results):
+                if result is None:
+                    self.stats['failed'] += 1
+                    application.logger.error('Failed to ' + change.description)
+                else:
+                    self.changes.append(change)
+            if exhausted:
+                return
+
+    def apply_change(self, change):
+        """Applies one change
+
+        :param change: Change
+        :return: None if the change failed
+        """
+        application.logger.debug('Reconciling: ' + change.description)
+        return getattr(self, change.action)(*change.args)
+
+    def create_client(self, company_abbr):
+        return self.harvest.create_client(company_abbr)
+
+    def replay_event(self, tw_project_id):
+        event_queue.enqueue(Teamwork.PROJECT_UPDATED, tw_project_id)
+        return tw_project_id
+
+    def create_project(self, project_name, company_abbr):
+        h_client = self.harvest.get_client_by_name(company_abbr)
+        if h_client is None:
+            return None
+        return self.harvest.create_project(project_name,
+                                           h_client[Harvest.CLIENT][Harvest.ID])
+
+    def update_project(self, h_project_id, project_name, company_abbr):
+        h_client = self.harvest.get_client_by_name(company_abbr)
+        if h_client is None:
+            return None
+        return self.harvest.update_project(h_project_id, project_name,
+                                           h_client[Harvest.CLIENT][Harvest.ID])
+
+    def add_user(self, h_project_id, user_id):
+        return self.harvest.add_user_assignment(h_project_id, user_id)
+
+    def remove_user(self, h_project_id, user_id):
+        return self.harvest.remove_user_assignment(h_project_id, user_id)
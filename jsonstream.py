@@ -0,0 +1,70 @@
+import codecs
+import json
+import six
+
+_decoder = json.JSONDecoder()
+_whitespace = ' \t\n\r'
+
+
+def iter_array(chunks):
+    """Incrementally parses a top-level JSON array from text or byte chunks
+
+    Only the unparsed tail of the body is buffered, so memory stays bounded
+    by the largest element rather than by the whole response.
+
+    :param chunks: Iterable of response body chunks
+    :return: Elements of the array
+    :rtype: generator
+    """
+    utf8 = codecs.getincrementaldecoder('utf-8')()
+    buffer = u''
+    started = False
+    finished = False
+
+    for chunk in chunks:
+        if not isinstance(chunk, six.text_type):
+            chunk = utf8.decode(chunk)
+        buffer += chunk
+        position = 0
+
+        while not finished:
+            while position < len(buffer) and buffer[position] in _whitespace:
+                position += 1
+            if position == len(buffer):
+                break
+
+            if not started:
+                if buffer[position] != '[':
+                    raise ValueError('Expected a JSON array')
+                started = True
+                position += 1
+                continue
+
+            if buffer[position] == ',':
+                position += 1
+                continue
+            if buffer[position] == ']':
+                finished = True
+                break
+
+            try:
+                element, end = _decoder.raw_decode(buffer, position)
+            except ValueError:
+                # Element continues in the next chunk
+                break
+            if not isinstance(element, (dict, list)):
+                # A number may be cut off at the chunk boundary, e.g. "2."
+                # decodes as 2, so a scalar is only complete once the next
+                # separator is in the buffer
+                following = end
+                while following < len(buffer) and buffer[following] in _whitespace:
+                    following += 1
+                if following == len(buffer) or buffer[following] not in ',]':
+                    break
+            yield element
+            position = end
+
+        buffer = buffer[position:]
+
+    if not finished:
+        raise ValueError('Unterminated JSON array')
@@ -1,17 +1,24 @@
+from bench import loadtest as load_test
+
 from flask_script import Manager
 
 from jobs.models import Base
 
 from jobs.process import TWProjectPipeline
+from jobs.reconcile import Reconciler
 
 from sqlalchemy.engine import reflection
 from sqlalchemy_utils import database_exists
 
 from webhook import application
 from webhook import Engine as engine
+from webhook import event_queue
+from webhook import event_workers
 from webhook import Session
 
+import settings
 import sys
+import time
 
 manager = Manager(application)
 
@@ -50,7 +57,7 @@ def create_tables(recreate):
 
 
 @manager.command
-def setup_db(recreate=False):
+def setup_db(recreate=False, row_by_row=False, chunk_size=None):
     """
     Setup the Teamwork database with records
     """
@@ -58,7 +65,10 @@ def setup_db(recreate=False):
     try:
         create_tables(recreate)
         teamwork_pipeline = TWProjectPipeline()
-        teamwork_pipeline.insert_projects(session)
+        teamwork_pipeline.insert_projects(
+            session,
+            bulk=not row_by_row,
+            chunk_size=int(chunk_size) if chunk_size else None)
         session.close()
     except Exception as error:
         print 'Error: {0}'.format(error)
@@ -67,5 +77,62 @@ def setup_db(recreate=False):
         session.close()
 
 
+@manager.command
+def process_events():
+    """
+    Handle queued webhook events in the foreground
+    """
+    sys.stdout.write('processing webhook events...' + '\n')
+    while True:
+        if not event_workers.run_once():
+            event_queue.release_stale()
+            time.sleep(settings.WEBHOOK_POLL_INTERVAL)
+
+
+@manager.command
+def reconcile(dry_run=False, budget=None, batch_size=None):
+    """
+    Repair Harvest clients, projects and assignments from Teamwork
+    """
+    reconciler = Reconciler(budget=int(budget) if budget else None,
+                            batch_size=int(batch_size) if batch_size else None,
+                            dry_run=dry_run)
+    summary = reconciler.run()
+    if summary is None:
+        sys.stdout.write('reconciliation aborted, see the log' + '\n')
+        return
+
+    for change in reconciler.changes:
+        sys.stdout.write(change.description + '\n')
+    sys.stdout.write(('planned' if dry_run else 'applied') + ' ' +
+                     str(len(reconciler.changes)) + ' change(s)' + '\n')
+    for key in sorted(summary):
+        sys.stdout.write('  ' + key + ': ' + str(summary[key]) + '\n')
+
+
+@manager.command
+def loadtest(url=None, rate=None, count=None, concurrency=None, mix=None,
+             workers=None, database=None, projects=None, latency=None,
+             drain_timeout=None):
+    """
+    Post webhook events at a target rate and report latency per event type
+    """
+    result = load_test.run(dict(
+        url=url,
+        rate=float(rate) if rate else None,
+        count=int(count) if count else None,
+        concurrency=int(concurrency) if concurrency else None,
+        mix=mix,
+        workers=int(workers) if workers else None,
+        database=database,
+        projects=int(projects) if projects else None,
+        latency=float(latency) if latency else None,
+        drain_timeout=float(drain_timeout) if drain_timeout else None))
+    if result is None:
+        sys.stdout.write('load test aborted, see the log' + '\n')
+        return
+    load_test.report(result)
+
+
 if __name__ == '__main__':
     manager.run()
@@ -0,0 +1,249 @@
+from contextlib import contextmanager
+
+import re
+import settings
+import threading
+import time
+import urlparse
+
+# Latency buckets in seconds
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10,
+                   30, 60)
+
+# Path segments holding IDs, replaced to group calls by endpoint
+_ID_SEGMENT = re.compile(r'/[0-9]+(?=/|\.|$)')
+
+
+class Metric(object):
+    """Base class of the metrics, holding one value per label set."""
+
+    kind = None
+
+    def __init__(self, name, help, labels=()):
+        """Initializes the metric.
+
+        :param name: Metric name
+        :param help: Description
+        :param labels: Label names
+        """
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def get_key(self, labels):
+        return tuple(str(labels.get(label, '')) for label in self.labels)
+
+    def format_labels(self, key, extra=()):
+        return format_labels(list(zip(self.labels, key)) + list(extra))
+
+    def render(self):
+        lines = ['# HELP ' + self.name + ' ' + self.help,
+                 '# TYPE ' + self.name + ' ' + self.kind]
+        with self._lock:
+            items = sorted(self._values.items())
+            lines.extend(self.render_samples(items))
+        return lines
+
+
+class Counter(Metric):
+    """Monotonically increasing count."""
+
+    kind = 'counter'
+
+    def inc(self, value=1, **labels):
+        """Increments the counter
+
+        :param value: Increment
+        :param labels: Label values
+        """
+        key = self.get_key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + value
+
+    def render_samples(self, items):
+        return [self.name + self.format_labels(key) + ' ' + format_value(value)
+                for key, value in items]
+
+
+class Histogram(Metric):
+    """Distribution of observations over fixed buckets."""
+
+    kind = 'histogram'
+
+    def __init__(self, name, help, labels=(), buckets=DEFAULT_BUCKETS):
+        super(Histogram, self).__init__(name, help, labels)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        """Records an observation
+
+        :param value: Observed value
+        :param labels: Label values
+        """
+        key = self.get_key(labels)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                # Per-bucket counts followed by the sum and the count
+                state = [0] * len(self.buckets) + [0.0, 0]
+                self._values[key] = state
+            for position, bound in enumerate(self.buckets):
+                if value <= bound:
+                    state[position] += 1
+                    break
+            state[-2] += value
+            state[-1] += 1
+
+    def get_samples(self):
+        """Reads the observations of every label set
+
+        :return: (label values by name, per-bucket counts, sum, count)
+            tuples
+        :rtype: list
+        """
+        with self._lock:
+            return [(dict(zip(self.labels, key)), list(state[:-2]),
+                     state[-2], state[-1])
+                    for key, state in self._values.items()]
+
+    def render_samples(self, items):
+        lines = []
+        for key, state in items:
+            cumulative = 0
+            for position, bound in enumerate(self.buckets):
+                cumulative += state[position]
+                lines.append(self.name + '_bucket' +
+                             self.format_labels(key, [('le', format_value(bound))]) +
+                             ' ' + str(cumulative))
+            lines.append(self.name + '_bucket' +
+                         self.format_labels(key, [('le', '+Inf')]) +
+                         ' ' + str(state[-1]))
+            lines.append(self.name + '_sum' + self.format_labels(key) + ' ' +
+                         format_value(state[-2]))
+            lines.append(self.name + '_count' + self.format_labels(key) + ' ' +
+                         str(state[-1]))
+        return lines
+
+
+class Registry(object):
+    """Process-wide set of metrics and collectors.
+
+    Collectors are callables returning ``(name, help, {label: value},
+    value)`` gauge samples, read when the metrics are rendered, e.g. from
+    the pool and cache statistics.
+    """
+
+    def __init__(self):
+        self.metrics = []
+        self.collectors = []
+
+    def counter(self, name, help, labels=()):
+        metric = Counter(name, help, labels)
+        self.metrics.append(metric)
+        return metric
+
+    def histogram(self, name, help, labels=(), buckets=DEFAULT_BUCKETS):
+        metric = Histogram(name, help, labels, buckets)
+        self.metrics.append(metric)
+        return metric
+
+    def register(self, collector):
+        """Adds a collector
+
+        :param collector: Callable returning gauge samples
+        """
+        self.collectors.append(collector)
+
+    def render(self):
+        """Renders every metric in the Prometheus text format
+
+        :return: Metrics
+        :rtype: str
+        """
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+
+        gauges = {}
+        for collector in self.collectors:
+            for name, help, labels, value in collector():
+                gauges.setdefault(name, (help, []))[1].append((labels, value))
+        for name in sorted(gauges):
+            help, samples = gauges[name]
+            lines.append('# HELP ' + name + ' ' + help)
+            lines.append('# TYPE ' + name + ' gauge')
+            for labels, value in samples:
+                lines.append(name + format_labels(sorted(labels.items())) +
+                             ' ' + format_value(value))
+        return '\n'.join(lines) + '\n'
+
+
+def format_labels(pairs):
+    if not pairs:
+        return ''
+    return '{' + ','.join(name + '="' + escape(str(value)) + '"'
+                          for name, value in pairs) + '}'
+
+
+def escape(value):
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def format_value(value):
+    if isinstance(value, float):
+        return repr(value)
+    return str(value)
+
+
+def get_endpoint(url):
+    """Reduces a URL to its host and path template
+
+    IDs in the path are replaced by ``{id}`` and the query is dropped, so
+    calls to the same endpoint share their metrics.
+
+    :param url: Request URL
+    :return: Service name (teamwork, harvest or the host) and path template
+    :rtype: tuple
+    """
+    parsed = urlparse.urlparse(url)
+    return (SERVICES.get(parsed.netloc, parsed.netloc),
+            _ID_SEGMENT.sub('/{id}', parsed.path) or '/')
+
+
+@contextmanager
+def timed(histogram, **labels):
+    """Observes the duration of a block
+
+    :param histogram: Histogram
+    :param labels: Label values
+    """
+    started = time.time()
+    try:
+        yield
+    finally:
+        histogram.observe(time.time() - started, **labels)
+
+
+SERVICES = {urlparse.urlparse(settings.TEAMWORK_BASE_URL).netloc: 'teamwork',
+            urlparse.urlparse(settings.HARVEST_BASE_URL).netloc: 'harvest'}
+
+registry = Registry()
+
+api_calls = registry.counter(
+    'api_calls_total', 'Teamwork and Harvest API calls by endpoint and status',
+    ('service', 'method', 'endpoint', 'status'))
+api_seconds = registry.histogram(
+    'api_call_seconds', 'Teamwork and Harvest API call latency',
+    ('service', 'method', 'endpoint'))
+event_seconds = registry.histogram(
+    'webhook_event_seconds', 'Time spent handling a webhook event',
+    ('event',))
+event_latency_seconds = registry.histogram(
+    'webhook_event_latency_seconds',
+    'Time from receiving a webhook event to finishing it',
+    ('event', 'outcome'))
+db_seconds = registry.histogram(
+    'db_seconds', 'Database time of webhook handler operations',
+    ('operation',))
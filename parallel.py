@@ -0,0 +1,67 @@
+from collections import deque
+
+import settings
+import six
+import sys
+import threading
+import tracing
+
+
+def run_parallel(calls, max_workers=None):
+    """Runs independent calls on a bounded number of threads
+
+    Outbound requests made by the calls are additionally capped per host by
+    the shared HTTP session (see ``connection.PooledSession``), and recorded
+    in the trace of the calling thread.
+
+    :param calls: List of (callable, args) pairs
+    :param max_workers: Maximum number of threads, defaults to
+        ``settings.API_MAX_WORKERS``
+    :return: Results in the order of the calls
+    :rtype: list
+    """
+    calls = list(calls)
+    if max_workers is None:
+        max_workers = settings.API_MAX_WORKERS
+    if len(calls) <= 1 or max_workers <= 1:
+        return [func(*args) for func, args in calls]
+
+    pending = deque(enumerate(calls))
+    results = [None] * len(calls)
+    errors = []
+    context = tracing.current()
+
+    def work():
+        tracing.attach(context)
+        while not errors:
+            try:
+                position, (func, args) = pending.popleft()
+            except IndexError:
+                return
+            try:
+                results[position] = func(*args)
+            except Exception:
+                errors.append(sys.exc_info())
+
+    threads = [threading.Thread(target=work)
+               for _ in range(min(max_workers, len(calls)))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    if errors:
+        six.reraise(*errors[0])
+    return results
+
+
+def parallel_map(func, items, max_workers=None):
+    """Applies a callable to every item using ``run_parallel``
+
+    :param func: Callable taking one item
+    :param items: Items
+    :param max_workers: Maximum number of threads
+    :return: Results in the order of the items
+    :rtype: list
+    """
+    return run_parallel([(func, (item,)) for item in items], max_workers)
@@ -0,0 +1,85 @@
+from collections import namedtuple
+
+import re
+import settings
+
+ProjectName = namedtuple('ProjectName', ['date', 'abbr', 'job_id', 'title'])
+
+# Decomposes "YYMM-ABBR-NNN title" names
+PARTS = re.compile(
+    r'^(?P<date>[0-9]{4})-(?P<abbr>[A-Z]+)-(?P<job_id>[0-9]+) (?P<title>.*)$')
+
+SCHEME = re.compile(settings.TEAMWORK_PROJECT_NAME_SCHEME)
+
+# A scheme with the named groups decomposes names in the same match
+if set(ProjectName._fields) <= set(SCHEME.groupindex):
+    PARTS = SCHEME
+
+
+def matches(name):
+    """Checks a project name against the project name scheme
+
+    :param name: Project name
+    :return: True if the name follows the scheme
+    :rtype: bool
+    """
+    return SCHEME.match(name) is not None
+
+
+def parse(name):
+    """Decomposes a project name following the scheme
+
+    :param name: Project name
+    :return: Date, company abbreviation, job ID and title, or None if the
+        name does not follow the scheme
+    :rtype: ProjectName
+    """
+    match = PARTS.match(name)
+    if match is None or (PARTS is not SCHEME and not SCHEME.match(name)):
+        return None
+    return ProjectName(match.group('date'),
+                       match.group('abbr'),
+                       int(match.group('job_id')),
+                       match.group('title'))
+
+
+def parse_many(projects, key):
+    """Decomposes the names of many projects in one pass
+
+    :param projects: Projects, e.g. a page of ``Teamwork.get_projects()``
+    :param key: Callable returning the name of a project
+    :return: (project, ProjectName) pairs of the projects whose name
+        follows the scheme, in their original order
+    :rtype: list
+    """
+    parsed = []
+    for project in projects:
+        name = parse(key(project))
+        if name is not None:
+            parsed.append((project, name))
+    return parsed
+
+
+def format_prefix(date, abbr, job_id):
+    """Builds the "YYMM-ABBR-NNN" project prefix
+
+    :param date: Project creation date as YYMM
+    :param abbr: Company abbreviation
+    :param job_id: Company job ID
+    :return: Project prefix
+    :rtype: str
+    """
+    return date + '-' + abbr + '-' + str(job_id)
+
+
+def format_name(date, abbr, job_id, title):
+    """Builds a project name following the scheme
+
+    :param date: Project creation date as YYMM
+    :param abbr: Company abbreviation
+    :param job_id: Company job ID
+    :param title: Project title
+    :return: Project name
+    :rtype: str
+    """
+    return format_prefix(date, abbr, job_id) + ' ' + title
@@ -21,8 +21,102 @@ HARVEST_BASE_URL = 'https://foo.harvestapp.com/'
 HARVEST_USER = ''
 HARVEST_PASS = ''
 
-# Teamwork project name format
-TEAMWORK_PROJECT_NAME_SCHEME = '^[0-9]{4}-[A-Z]+-[0-9]+ .*$'
+# outbound HTTP connection pool shared by the Teamwork and Harvest clients
+# (per process). HTTP_POOL_CONNECTIONS is the number of hosts to keep pools
+# for, HTTP_POOL_MAXSIZE the keep-alive connections kept per host.
+HTTP_POOL_CONNECTIONS = 4
+HTTP_POOL_MAXSIZE = 10
+
+# (connect, read) timeout in seconds for Teamwork and Harvest API requests
+HTTP_TIMEOUT = (5, 30)
+
+# maximum concurrent requests per API host (per process), and the maximum
+# number of threads used to fan out independent API calls
+HTTP_HOST_CONCURRENCY = 4
+API_MAX_WORKERS = 8
+
+# number of API responses kept with their ETag/Last-Modified validators to
+# make repeated GET requests conditional
+HTTP_VALIDATOR_CACHE_SIZE = 512
+
+# optional directory persisting those responses across worker restarts
+HTTP_VALIDATOR_CACHE_DIR = None
+
+# (requests per second, burst) allowed per API host, with overrides keyed by
+# host name, e.g. {'foo.harvestapp.com': (6, 100)}
+API_RATE_LIMIT = (2.5, 20)
+API_HOST_RATE_LIMITS = {}
+
+# retries of GET requests that were rate limited (429/503) or failed to
+# connect, with a jittered exponential backoff starting at
+# API_RETRY_BACKOFF seconds unless the API sends Retry-After
+API_RETRY_ATTEMPTS = 4
+API_RETRY_BACKOFF = 1
+
+# process-wide Harvest cache: maximum entries and TTL in seconds per resource
+HARVEST_CACHE_SIZE = 256
+HARVEST_CACHE_TTL = {
+    'clients': 300,
+    'people': 300,
+    'projects': 60
+}
+# a client or person missing from the cache reloads the cached clients or
+# people at most once per HARVEST_CACHE_REFRESH_INTERVAL seconds
+HARVEST_CACHE_REFRESH_INTERVAL = 60
+
+# process-wide Teamwork cache TTL in seconds per resource
+TEAMWORK_CACHE_TTL = {
+    'projects': 60
+}
+
+# webhook events are queued in tw_event and handled by background workers.
+# WEBHOOK_WORKERS is the number of worker threads per process (0 leaves the
+# queue to ``python manage.py process_events``), failing events are retried
+# WEBHOOK_MAX_ATTEMPTS times with a WEBHOOK_RETRY_BACKOFF second base delay
+# doubled per attempt before moving to tw_event_dead.
+WEBHOOK_WORKERS = 2
+WEBHOOK_POLL_INTERVAL = 1
+WEBHOOK_MAX_ATTEMPTS = 5
+WEBHOOK_RETRY_BACKOFF = 30
+WEBHOOK_STALE_AFTER = 600
+
+# events for the same (event type, object ID) arriving within
+# WEBHOOK_COALESCE_WINDOW seconds are handled once. A PROJECT.UPDATED event
+# caused by our own rename is skipped if it is handled within
+# WEBHOOK_ECHO_TTL seconds and the project still has the name we set.
+WEBHOOK_COALESCE_WINDOW = 5
+WEBHOOK_ECHO_TTL = 30
+
+# API calls and response bytes one webhook event may use before its trace
+# (one JSON log line per event) is logged as a warning, None for no limit
+TRACE_MAX_CALLS = 40
+TRACE_MAX_BYTES = 5 * 1024 * 1024
+
+# time entries spent up to TIME_SYNC_LOOKBACK_DAYS days before the last sync
+# are picked up when they are edited in Harvest
+TIME_SYNC_LOOKBACK_DAYS = 31
+
+# time entries are pushed by API_MAX_WORKERS workers and recorded as synced
+# every API_MAX_WORKERS * TIME_SYNC_CHUNK_FACTOR entries
+TIME_SYNC_CHUNK_FACTOR = 4
+
+# rows per batched INSERT when ``manage.py setup_db`` backfills tw_project
+PROJECT_BACKFILL_CHUNK_SIZE = 500
+
+# company_job_id values reserved per database round-trip by each process.
+# Values left in a block when a process stops are skipped, use 1 to keep the
+# numbering gapless
+COMPANY_JOB_ID_BLOCK_SIZE = 5
+
+# maximum number of API calls of one "manage.py reconcile" run
+RECONCILE_API_BUDGET = 10000
+
+# API calls made concurrently per reconciliation batch
+RECONCILE_BATCH_SIZE = 50
+
+# Teamwork project name format, "YYMM-ABBR-NNN title". The named groups let
+# projectname.parse decompose a name in the same match
+TEAMWORK_PROJECT_NAME_SCHEME = '^(?P<date>[0-9]{4})-(?P<abbr>[A-Z]+)-(?P<job_id>[0-9]+) (?P<title>.*)$'
 
 # Teamwork database config
 DATABASE = {
@@ -31,5 +125,14 @@ DATABASE = {
     'port': '',
     'username': '',
     'password': '',
-    'database': ''
+    'database': '',
+    # connections kept open per process, and extra ones allowed under load
+    'pool_size': 5,
+    'max_overflow': 10,
+    # seconds to wait for a free connection before failing
+    'pool_timeout': 10,
+    # seconds before a connection is replaced (keep below MySQL's wait_timeout)
+    'pool_recycle': 3600,
+    # test connections on checkout and replace the stale ones
+    'pool_pre_ping': True
 }
@@ -1,9 +1,18 @@
+from cache import TTLCache
+import connection
 import datetime
 from requests.auth import HTTPBasicAuth
+import httpcache
 import httplib
+from index import build_index
 import json
 import logging
-import requests
+from parallel import parallel_map
+import settings
+
+
+class IncompleteListingError(Exception):
+    """A page of a paged listing could not be retrieved."""
 
 
 class Teamwork(object):
@@ -14,6 +23,8 @@ class Teamwork(object):
     PROJECT_COPIED = 'PROJECT.COPIED'
     COMPANY_CREATED = 'COMPANY.CREATED'
     COMPANY_UPDATED = 'COMPANY.UPDATED'
+    EVENTS = (PROJECT_CREATED, PROJECT_UPDATED, PROJECT_COPIED,
+              COMPANY_CREATED, COMPANY_UPDATED)
 
     EVENT = 'event'
     OBJECT_ID = 'objectId'
@@ -30,12 +41,17 @@ class Teamwork(object):
     PROJECTS_URL = '/projects'
     PROJECT = 'project'
     PROJECTS = 'projects'
+    LAST_CHANGED_ON = 'last-changed-on'
+    STATUS = 'status'
+    ACTIVE = 'active'
 
     COMPANIES_URL = '/companies'
     COMPANY = 'company'
+    COMPANIES = 'companies'
     PHONE = 'phone'
     COMPANY_ABBR = 'address_one'
 
+    PEOPLE_URL = '/people'
     PEOPLE = 'people'
     PERSON = 'person'
     PERSON_DASH_ID = 'person-id'
@@ -47,6 +63,13 @@ class Teamwork(object):
     HOURS = 'hours'
     ISBILLABLE = 'isbillable'
 
+    # Cached resources
+    PROJECTS_CACHE = 'projects'
+    BY_NAME = 'by_name'
+
+    # Process-wide cache shared by every instance
+    cache = TTLCache(16, settings.TEAMWORK_CACHE_TTL)
+
     def __init__(self, base_url, username, password):
         """Initializes the handler.
 
@@ -57,15 +80,40 @@ class Teamwork(object):
         self.base_url = base_url
         self.auth = HTTPBasicAuth(username, password)
         self.headers = {'Content-Type': 'application/json'}
+        self.session = connection.get_session()
+        self.validators = httpcache.get_cache()
 
-    def get_projects(self):
+    def get_projects(self, include_people=False):
         """Retrieves projects based on the ID
 
+        :param include_people: Include the IDs of the people assigned to
+            each project
         :return: The project
         :rtype: dict
         """
-        return self.get_request(self.base_url + Teamwork.PROJECTS_URL +
-                                Teamwork.REQ_TYPE + '?status=ALL', True, Teamwork.PROJECTS)
+        url = self.base_url + Teamwork.PROJECTS_URL + Teamwork.REQ_TYPE + '?status=ALL'
+        if include_people:
+            url += '&includePeople=true'
+        return self.get_request(url, True, Teamwork.PROJECTS)
+
+    def iter_project_pages(self):
+        """Retrieves all projects one page at a time
+
+        :return: Projects of each page
+        :rtype: generator
+        """
+        return self.iter_pages(self.base_url + Teamwork.PROJECTS_URL +
+                               Teamwork.REQ_TYPE + '?status=ALL', Teamwork.PROJECTS)
+
+    def iter_projects(self):
+        """Iterates over all projects, holding at most one page in memory
+
+        :return: Projects
+        :rtype: generator
+        """
+        for projects in self.iter_project_pages():
+            for project in projects:
+                yield project
 
     def get_project(self, id):
         """Retrieves project based on the ID
@@ -83,13 +131,38 @@ class Teamwork(object):
         :param name: Name of project
         :return: Project
         :rtype: dict
+        :raises IncompleteListingError: if the projects could not be
+            searched
         """
-        projects = self.get_projects()
-        for project in projects[Teamwork.PROJECTS]:
+        index = Teamwork.cache.get((Teamwork.PROJECTS_CACHE, Teamwork.BY_NAME))
+        if index is not None:
+            return index.get(name)
+
+        # Without a warm index stream the pages and stop at the first match
+        for project in self.iter_projects():
             if project[Teamwork.NAME] == name:
                 return project
         return None
 
+    def get_project_index(self):
+        """Retrieves all projects indexed by name
+
+        The index is shared by every instance of the process until it
+        expires or a project is renamed.
+
+        :return: Projects by name
+        :rtype: dict
+        """
+        def build():
+            projects = self.get_projects()
+            if projects is None:
+                return None
+            return build_index(projects[Teamwork.PROJECTS],
+                               lambda project: project[Teamwork.NAME])
+
+        return Teamwork.cache.get_or_load(
+            (Teamwork.PROJECTS_CACHE, Teamwork.BY_NAME), build) or {}
+
     def update_project(self, project_name, id):
         """Updates the project name based on the ID
 
@@ -97,8 +170,10 @@ class Teamwork(object):
         :param id: Project ID
         """
         data = {Teamwork.PROJECT: {Teamwork.NAME: project_name}}
-        return self.put_request(
+        headers = self.put_request(
             self.base_url + Teamwork.PROJECTS_URL + '/' + id + Teamwork.REQ_TYPE, data)
+        Teamwork.cache.invalidate(Teamwork.PROJECTS_CACHE)
+        return headers
 
     def get_company(self, id):
         """Retrieves the company based on the ID
@@ -110,6 +185,15 @@ class Teamwork(object):
         return self.get_request(
             self.base_url + Teamwork.COMPANIES_URL + '/' + id + Teamwork.REQ_TYPE)
 
+    def get_companies(self):
+        """Retrieves all companies
+
+        :return: Companies
+        :rtype: dict
+        """
+        return self.get_request(
+            self.base_url + Teamwork.COMPANIES_URL + Teamwork.REQ_TYPE)
+
     def get_project_people(self, project_id):
         """Get people assigned to a project
 
@@ -120,18 +204,30 @@ class Teamwork(object):
         return self.get_request(self.base_url + Teamwork.PROJECTS_URL + '/' + project_id +
                                 '/' + Teamwork.PEOPLE + Teamwork.REQ_TYPE)
 
-    def add_time_entry(self, project_id, person_id, hours, billable=False):
+    def get_people(self):
+        """Retrieves all people
+
+        :return: People
+        :rtype: dict
+        """
+        return self.get_request(self.base_url + Teamwork.PEOPLE_URL +
+                                Teamwork.REQ_TYPE, True, Teamwork.PEOPLE)
+
+    def add_time_entry(self, project_id, person_id, hours, billable=False,
+                       date=None):
         """Addes hours to a person for a project.
 
         :param project_id: Project ID
         :param person_id: Person ID
         :param hours: Hours to add to project
+        :param date: Day the hours were spent, defaults to today
         :return: Entry ID
         :rtype: str
         """
-        now = datetime.datetime.now()
+        if date is None:
+            date = datetime.datetime.now()
         data = {Teamwork.TIME_DASH_ENTRY: {Teamwork.PERSON_DASH_ID: person_id,
-                                           Teamwork.DATE: now.strftime("%Y%m%d"),
+                                           Teamwork.DATE: date.strftime("%Y%m%d"),
                                            Teamwork.HOURS: hours}}
         if billable:
             data[Teamwork.TIME_DASH_ENTRY][Teamwork.ISBILLABLE] = 'yes'
@@ -142,64 +238,112 @@ class Teamwork(object):
     def get_request(self, url, paged=False, array_name=None):
         """Performs a GET request with the given url
 
+        For paged requests the first page is fetched to learn the page count
+        from ``X-Pages``, the remaining pages are fetched concurrently and
+        their ``array_name`` records are merged in page order.
+
         :param url: URL to make the request against
+        :param paged: True if the resource is paged
+        :param array_name: Name of the paged array in the response
         :return: Response
         :rtype: dict
         """
+        # Check for array name to store values since
+        # we are getting paged data
+        if paged and not isinstance(array_name, str):
+            return None
 
-        json = None
-        is_more_pages = True
-
-        # do-while loop
-        while is_more_pages:
+        req = self.get_page(url)
+        if req is None:
+            return None
 
-            # Not paged so only run once
-            is_more_pages = paged
+        data = req.json()
+        if not paged:
+            return data
 
-            req = requests.get(url=url,
-                               auth=self.auth,
-                               headers=self.headers)
+        total_pages = self.get_total_pages(req)
+        if total_pages is None:
+            return None
 
+        pages = parallel_map(lambda page: self.get_page(url, page),
+                             range(2, total_pages + 1))
+        # Page bodies may be cached, merge them into a new list
+        records = list(data[array_name])
+        for page in pages:
             # Do not return anything if any of the requests are not OK
-            if req.status_code != httplib.OK:
-                logging.error('Could not make GET request using url: ' + url +
-                              ' Response headers: ' + str(req.headers))
+            if page is None:
                 return None
+            records.extend(page.json()[array_name])
+
+        data = dict(data)
+        data[array_name] = records
+        return data
+
+    def iter_pages(self, url, array_name):
+        """Yields the records of a paged resource one page at a time
+
+        Pages are fetched lazily, so callers can stop early or start working
+        before the last page arrives.
+
+        :param url: URL to make the request against
+        :param array_name: Name of the paged array in the response
+        :return: Records of each page
+        :rtype: generator
+        :raises IncompleteListingError: at the first page that could not be
+            retrieved, so a partial listing is never taken for a complete one
+        """
+        page = 1
+        total_pages = 1
+        while page <= total_pages:
+            req = self.get_page(url, page)
+            if req is None:
+                raise IncompleteListingError(
+                    'Could not retrieve page ' + str(page) + ' of ' + url)
+            if page == 1:
+                total_pages = self.get_total_pages(req)
+                if total_pages is None:
+                    raise IncompleteListingError(
+                        'Could not read the page count of ' + url)
+            yield req.json()[array_name]
+            page += 1
+
+    def get_page(self, url, page=None):
+        """Performs a conditional GET request for one page of the given url
+
+        An unchanged page is served from the validator cache.
+
+        :param url: URL to make the request against
+        :param page: Page number, or None for the first/only page
+        :return: Response or None if the request failed
+        :rtype: httpcache.CachedResponse
+        """
+        params = {'page': page} if page is not None else None
+        req = self.validators.get(self.session,
+                                  url,
+                                  params=params,
+                                  auth=self.auth,
+                                  headers=self.headers)
+
+        if req.status_code != httplib.OK:
+            logging.error('Could not make GET request using url: ' + req.url +
+                          ' Response headers: ' + str(req.headers))
+            return None
 
-            if json is None:
-                json = req.json()
-
-            if paged:
-                # Check for array name to store values since
-                # we are getting paged data
-                if not isinstance(array_name, str):
-                    return None
-
-                try:
-                    page = int(req.headers['X-Page'])
-                    total_pages = int(req.headers['X-Pages'])
-
-                    if page != 1:
-                        json[array_name].extend(req.json()[array_name])
-
-                    if page == total_pages:
-                        # check if we got the last page
-                        is_more_pages = False
-                    else:
-                        # Get the next page url
-                        url = (
-                            url.replace(
-                                '&page=%d' %
-                                page,
-                                '')) if 'page' in url else url
-                        url = url + '&page=' + str(page + 1)
-
-                except KeyError:
-                    logging.error(
-                        'Could not find X-Page or X-Pages in the response headers')
-                    return None
-
-        return json
+        return req
+
+    def get_total_pages(self, req):
+        """Reads the page count of a paged response
+
+        :param req: Response
+        :return: Number of pages or None if missing
+        :rtype: int
+        """
+        try:
+            return int(req.headers['X-Pages'])
+        except KeyError:
+            logging.error(
+                'Could not find X-Page or X-Pages in the response headers')
+            return None
 
     def post_request(self, url, data):
         """Performs a POST request with the given url and data
@@ -209,10 +353,10 @@ class Teamwork(object):
         :return: ID
         :rtype: str
         """
-        req = requests.post(url=url,
-                            auth=self.auth,
-                            data=json.dumps(data),
-                            headers=self.headers)
+        req = self.session.post(url=url,
+                                auth=self.auth,
+                                data=json.dumps(data),
+                                headers=self.headers)
 
         if req.status_code != httplib.CREATED:
             logging.error("Could not make POST request using url: " + url + " with data: " + json.dumps(data) +
@@ -229,10 +373,10 @@ class Teamwork(object):
         :return: headers
         :rtype: str
         """
-        req = requests.put(url=url,
-                           auth=self.auth,
-                           data=json.dumps(data),
-                           headers=self.headers)
+        req = self.session.put(url=url,
+                               auth=self.auth,
+                               data=json.dumps(data),
+                               headers=self.headers)
 
         if req.status_code != httplib.OK:
             logging.error("Could not make PUT request using url: " + url + " with data: " + json.dumps(data) +
@@ -1,15 +1,33 @@
 from harvest import Harvest
+
+from jobs.identity import IdentityMap
+from jobs.models import connect_to_database
+from jobs.models import HSyncedEntry
+from jobs.models import SyncWatermark
+
+from sqlalchemy.orm import sessionmaker
+
+import datetime
+import logging
+from parallel import parallel_map
+from parallel import run_parallel
 import settings
 from teamwork import Teamwork
 import time
 
+Session = sessionmaker(bind=connect_to_database())
+
 
 def main():
     time_entries = TimeImport()
+    time_entries.run()
 
 
 class TimeImport():
 
+    # Name of the sync watermark row
+    WATERMARK = 'harvest_time_entries'
+
     def __init__(self):
         self.teamwork = Teamwork(
             settings.TEAMWORK_BASE_URL,
@@ -20,46 +38,200 @@ class TimeImport():
             settings.HARVEST_USER,
             settings.HARVEST_PASS)
 
-        updated_projects = self.harvest.get_todays_updated_projects()
+    def run(self):
+        """Pushes the Harvest time entries updated since the last successful
+        run to Teamwork, skipping entries that were already pushed.
 
-        for project in updated_projects:
-            h_project_id = project[Harvest.PROJECT][Harvest.ID]
-            time_entries = self.harvest.get_todays_proj_time_entries(
-                h_project_id)
+        All Harvest projects are resolved against one snapshot of the
+        Teamwork projects, their entries are fetched concurrently and then
+        pushed, grouped per project, by a bounded pool of workers paced by
+        the API rate limiter.
 
-            project_name = project[Harvest.PROJECT][Harvest.NAME]
-            tw_project = self.teamwork.get_project_by_name(project_name)
-            tw_project_id = tw_project[Teamwork.ID]
-            tw_project_emails = self.get_tw_project_emails(tw_project_id)
-
-            for entry in time_entries:
-                h_user_id = entry[Harvest.DAY_ENTRY][Harvest.USER_ID]
-                h_user = self.harvest.get_person(h_user_id)
-                user_email = h_user[Harvest.USER][Harvest.EMAIL]
+        :return: Number of pushed entries, seconds spent pushing them and
+            throughput in entries per second
+        :rtype: dict
+        """
+        session = Session()
+        try:
+            started = datetime.datetime.utcnow()
+            since = self.get_watermark(session)
+            first_day = since - datetime.timedelta(
+                days=settings.TIME_SYNC_LOOKBACK_DAYS)
+
+            updated_projects = self.harvest.get_updated_projects(since)
+            if updated_projects is None:
+                logging.error('Could not retrieve updated Harvest projects')
+                return None
+
+            identities = IdentityMap(self.teamwork, self.harvest)
+            identities.refresh(session)
+
+            tw_projects = self.teamwork.get_project_index()
+            matched = []
+            for project in updated_projects:
+                project_name = project[Harvest.PROJECT][Harvest.NAME]
+                tw_project = tw_projects.get(project_name)
+                if tw_project is None:
+                    logging.warning(
+                        'No Teamwork project named "' + project_name + '"')
+                    continue
+                matched.append((project[Harvest.PROJECT][Harvest.ID],
+                                tw_project[Teamwork.ID]))
+
+            fetched = run_parallel(
+                [(self.fetch_project, (h_project_id, tw_project_id,
+                                       first_day, started, since))
+                 for h_project_id, tw_project_id in matched])
+
+            complete = True
+            jobs = []
+            for (h_project_id, tw_project_id), (time_entries, tw_person_ids) in zip(
+                    matched, fetched):
+                if time_entries is None:
+                    complete = False
+                    continue
+                for entry in self.get_unsynced_entries(session, time_entries):
+                    tw_person_id = identities.get_tw_person_id(
+                        entry[Harvest.DAY_ENTRY][Harvest.USER_ID])
+                    if tw_person_id in tw_person_ids:
+                        jobs.append((tw_project_id, tw_person_id, entry))
+
+            pushed, seconds = self.push_entries(session, jobs)
+            if pushed < len(jobs):
+                complete = False
+            if complete:
+                self.set_watermark(session, started)
+
+            rate = pushed / seconds if seconds else 0.0
+            logging.info(
+                'Pushed {0} of {1} time entries from {2} project(s) in {3:.1f}s ({4:.2f} entries/s)'.format(
+                    pushed, len(jobs), len(matched), seconds, rate))
+            return {'entries': pushed, 'seconds': seconds, 'rate': rate}
+        finally:
+            session.close()
+
+    def fetch_project(self, h_project_id, tw_project_id, first_day, last_day,
+                      since):
+        """Get a project's updated time entries and assigned Teamwork people
+
+        :param h_project_id: Harvest project ID
+        :param tw_project_id: Teamwork project ID
+        :param first_day: First day of the entries
+        :param last_day: Last day of the entries
+        :param since: UTC time the entries were updated after
+        :return: Time entries and assigned person IDs
+        :rtype: tuple
+        """
+        return (self.harvest.get_updated_proj_time_entries(
+            h_project_id, first_day, last_day, since),
+            self.get_tw_project_person_ids(tw_project_id))
+
+    def push_entries(self, session, jobs):
+        """Adds time entries to Teamwork in parallel and records them as
+        synced after every chunk, so an interrupted run does not push them
+        again
+
+        :param session: Database session
+        :param jobs: List of (Teamwork project ID, Teamwork person ID,
+            Harvest time entry), grouped per project
+        :return: Number of pushed entries and seconds spent
+        :rtype: tuple
+        """
+        pushed = 0
+        clock = time.time()
+        chunk_size = settings.API_MAX_WORKERS * settings.TIME_SYNC_CHUNK_FACTOR
+        for offset in range(0, len(jobs), chunk_size):
+            chunk = jobs[offset:offset + chunk_size]
+            # push_entry does not raise, so every successful push of the
+            # chunk is recorded below
+            tw_entry_ids = parallel_map(lambda job: self.push_entry(*job),
+                                        chunk)
+            for (tw_project_id, tw_person_id, entry), tw_entry_id in zip(
+                    chunk, tw_entry_ids):
+                if tw_entry_id is not None:
+                    session.add(HSyncedEntry(
+                        h_entry_id=str(entry[Harvest.DAY_ENTRY][Harvest.ID]),
+                        tw_entry_id=str(tw_entry_id)))
+                    pushed += 1
+            session.commit()
+        return pushed, time.time() - clock
+
+    def push_entry(self, tw_project_id, tw_person_id, entry):
+        """Adds a Harvest time entry to Teamwork
+
+        Failures are logged and reported as None rather than raised, so the
+        entries pushed in the same chunk are still recorded as synced.
+
+        :param tw_project_id: Teamwork project ID
+        :param tw_person_id: Teamwork person ID
+        :param entry: Harvest time entry
+        :return: Teamwork time entry ID or None
+        :rtype: str
+        """
+        day_entry = entry[Harvest.DAY_ENTRY]
+        try:
+            return self.teamwork.add_time_entry(
+                tw_project_id, tw_person_id, day_entry[Harvest.HOURS], True,
+                datetime.datetime.strptime(day_entry[Harvest.SPENT_AT], '%Y-%m-%d'))
+        except Exception:
+            logging.exception('Could not push Harvest time entry ' +
+                              str(day_entry[Harvest.ID]) + ' to Teamwork project ' +
+                              str(tw_project_id))
+            return None
+
+    def get_unsynced_entries(self, session, time_entries):
+        """Filters out the time entries that were already pushed
+
+        :param session: Database session
+        :param time_entries: Harvest time entries
+        :return: Entries not pushed yet
+        :rtype: list
+        """
+        entry_ids = [str(entry[Harvest.DAY_ENTRY][Harvest.ID])
+                     for entry in time_entries]
+        if not entry_ids:
+            return []
+
+        synced = set(entry_id for (entry_id,) in session.query(
+            HSyncedEntry.h_entry_id).filter(
+            HSyncedEntry.h_entry_id.in_(entry_ids)))
+        return [entry for entry_id, entry in zip(entry_ids, time_entries)
+                if entry_id not in synced]
+
+    def get_watermark(self, session):
+        """Retrieves the time the last successful sync started, or the start
+        of today for the first run
+
+        :param session: Database session
+        :return: UTC time
+        :rtype: datetime.datetime
+        """
+        watermark = session.query(SyncWatermark).get(TimeImport.WATERMARK)
+        if watermark is None:
+            return datetime.datetime.combine(datetime.date.today(),
+                                             datetime.time())
+        return watermark.synced_until
 
-                for tw_id, tw_email in tw_project_emails.iteritems():
-                    if user_email.lower() == tw_email.lower():
-                        self.teamwork.add_time_entry(
-                            tw_project_id, tw_id, entry[
-                                Harvest.DAY_ENTRY][
-                                Harvest.HOURS], True)
-                        break
+    def set_watermark(self, session, synced_until):
+        """Records the start of a successful sync
 
-                time.sleep(1)
+        :param session: Database session
+        :param synced_until: UTC time
+        """
+        session.merge(SyncWatermark(name=TimeImport.WATERMARK,
+                                    synced_until=synced_until))
+        session.commit()
 
-    def get_tw_project_emails(self, project_id):
-        """Get a list of assigned emails to the given project
+    def get_tw_project_person_ids(self, project_id):
+        """Get the IDs of the people assigned to the given project
 
         :param project_id: Project ID
-        :return: Assigned email list
-        :rtype: list
+        :return: Assigned person IDs
+        :rtype: set
         """
         people = self.teamwork.get_project_people(project_id)
-        emails = {}
-        for person in people[Teamwork.PEOPLE]:
-            emails[person[Teamwork.ID]] = person[Teamwork.EMAIL_DASH_ADDRESS]
-
-        return emails
+        return set(str(person[Teamwork.ID])
+                   for person in people[Teamwork.PEOPLE])
 
     def get_h_project_emails(self, project_id):
         """Get a list of assigned emails to the given project
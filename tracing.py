@@ -0,0 +1,120 @@
+import metrics
+import threading
+import time
+
+_local = threading.local()
+
+
+class Trace(object):
+    """Outbound API calls made while handling one unit of work.
+
+    Traces are bound to the current thread and handed to the worker
+    threads of ``parallel.run_parallel``, so calls fanned out by a handler
+    are recorded in the handler's trace.
+    """
+
+    def __init__(self, name, max_calls=None, max_bytes=None, **fields):
+        """Initializes the trace.
+
+        :param name: Name of the traced work, e.g. the webhook event
+        :param max_calls: Call budget, None for no limit
+        :param max_bytes: Response size budget, None for no limit
+        :param fields: Extra fields written with the trace
+        """
+        self.name = name
+        self.max_calls = max_calls
+        self.max_bytes = max_bytes
+        self.fields = fields
+        self.started = time.time()
+        self.calls = []
+        self.bytes = 0
+        self._lock = threading.Lock()
+
+    def record(self, method, url, status, seconds, size):
+        """Records one call
+
+        :param method: HTTP method
+        :param url: Request URL
+        :param status: Response status code, or 'error'
+        :param seconds: Duration
+        :param size: Response size in bytes
+        """
+        service, endpoint = metrics.get_endpoint(url)
+        call = dict(method=method.upper(),
+                    service=service,
+                    endpoint=endpoint,
+                    status=status,
+                    ms=int(seconds * 1000),
+                    bytes=size)
+        with self._lock:
+            self.calls.append(call)
+            self.bytes += size
+
+    def is_over_budget(self):
+        """Checks the calls against the budget
+
+        :return: True if the calls or bytes exceed the budget
+        :rtype: bool
+        """
+        return (self.max_calls is not None and len(self.calls) > self.max_calls) or \
+            (self.max_bytes is not None and self.bytes > self.max_bytes)
+
+    def summary(self):
+        """Builds the structured record of the trace
+
+        :return: Trace name and fields, duration, call count, bytes, budget
+            flag and every call in order
+        :rtype: dict
+        """
+        with self._lock:
+            calls = list(self.calls)
+        record = dict(self.fields)
+        record.update(trace=self.name,
+                      seconds=round(time.time() - self.started, 3),
+                      calls=len(calls),
+                      bytes=self.bytes,
+                      over_budget=self.is_over_budget(),
+                      log=calls)
+        return record
+
+
+def start(name, max_calls=None, max_bytes=None, **fields):
+    """Starts a trace on the current thread
+
+    :param name: Name of the traced work
+    :param max_calls: Call budget
+    :param max_bytes: Response size budget
+    :param fields: Extra fields written with the trace
+    :return: Trace
+    :rtype: Trace
+    """
+    context = Trace(name, max_calls, max_bytes, **fields)
+    attach(context)
+    return context
+
+
+def current():
+    """Retrieves the trace of the current thread
+
+    :return: Trace or None
+    :rtype: Trace
+    """
+    return getattr(_local, 'trace', None)
+
+
+def attach(context):
+    """Binds a trace to the current thread
+
+    :param context: Trace or None to unbind
+    """
+    _local.trace = context
+
+
+def record(method, url, status, seconds, size):
+    """Records a call in the trace of the current thread, if any
+
+    See ``Trace.record``.
+    """
+    context = current()
+    if context is not None:
+        context.record(method, url, status, seconds, size)
@@ -1,25 +1,41 @@
+from assignments import diff_assignments
+
 from flask import abort
 from flask import Flask
 from flask import request
+from flask import Response
 
 from logging import handlers
 from logging import Formatter
 
 from harvest import Harvest
 
+from jobs.events import EventQueue
+from jobs.events import EventWorkerPool
+from jobs.mirror import TWProjectMirror
 from jobs.models import connect_to_database
+from jobs.models import get_pool_stats
 from jobs.models import TWProject
 
+from parallel import parallel_map
+from parallel import run_parallel
+
+from sqlalchemy.orm import scoped_session
 from sqlalchemy.orm import sessionmaker
 from sqlalchemy.exc import SQLAlchemyError
 
 from teamwork import Teamwork
 
 import datetime
+import httpcache
+import json
 import logging
-import re
+import metrics
+import projectname
 import settings
 import sys
+import time
+import tracing
 
 application = Flask(__name__)
 
@@ -39,14 +55,101 @@ application.logger.setLevel(settings.LOG_LVL)
 application.logger.addHandler(log_handler)
 
 Engine = connect_to_database()
-Session = sessionmaker(bind=Engine)
+session_factory = sessionmaker(bind=Engine)
+# Session of the current request or event, released when it ends
+Session = scoped_session(session_factory)
+
+project_mirror = TWProjectMirror()
+
+# The queue commits in its own short transactions, apart from the handler's
+event_queue = EventQueue(session_factory,
+                         settings.WEBHOOK_MAX_ATTEMPTS,
+                         settings.WEBHOOK_RETRY_BACKOFF,
+                         settings.WEBHOOK_STALE_AFTER,
+                         settings.WEBHOOK_COALESCE_WINDOW,
+                         settings.WEBHOOK_ECHO_TTL,
+                         application.logger)
+
+
+def handle_event(event, object_id):
+    """Handles a queued webhook event
+
+    :param event: Webhook event type
+    :param object_id: Teamwork object ID
+    """
+    teamwork_handler = TeamworkHandler()
+    teamwork_handler.process_event(event, object_id)
+
+
+event_workers = EventWorkerPool(event_queue,
+                                handle_event,
+                                settings.WEBHOOK_WORKERS,
+                                settings.WEBHOOK_POLL_INTERVAL,
+                                application.logger)
+
+
+@application.before_first_request
+def start_event_workers():
+    if settings.WEBHOOK_WORKERS:
+        event_workers.start()
+
+
+@application.teardown_appcontext
+def remove_session(exception=None):
+    Session.remove()
+
+
+def collect_stats():
+    """Reads the connection pool and API cache statistics
+
+    :return: Gauge samples, see ``metrics.Registry``
+    :rtype: list
+    """
+    samples = []
+    for key, value in sorted((get_pool_stats(Engine) or {}).items()):
+        samples.append(('db_pool_' + key,
+                        'Database connection pool ' + key.replace('_', ' '),
+                        {}, value))
+    for name, stats in (('harvest', Harvest.cache.stats()),
+                        ('teamwork', Teamwork.cache.stats()),
+                        ('validators', httpcache.get_cache().stats())):
+        for key, value in sorted(stats.items()):
+            samples.append(('api_cache_' + key,
+                            'API response cache ' + key.replace('_', ' '),
+                            {'cache': name}, value))
+    return samples
+
+
+metrics.registry.register(collect_stats)
+
+
+@application.route("/metrics", methods=['GET'])
+def get_metrics():
+    return Response(metrics.registry.render(),
+                    mimetype='text/plain; version=0.0.4')
 
 
 @application.route("/", methods=['POST'])
 def post():
     application.logger.debug('Retrieved webhook')
-    teamwork_handler = TeamworkHandler()
-    teamwork_handler.process_request(request)
+    event = request.form.get(Teamwork.EVENT)
+    object_id = request.form.get(Teamwork.OBJECT_ID)
+    if event not in Teamwork.EVENTS or not object_id:
+        application.logger.warning(
+            'Rejected webhook with event ' + str(event) +
+            ' and object ID ' + str(object_id))
+        abort(400)
+
+    try:
+        event_id = event_queue.enqueue(event, object_id)
+    except SQLAlchemyError as error:
+        application.logger.critical(
+            'Failed to queue webhook event: {0}'.format(str(error)))
+        abort(503)
+
+    event_workers.notify()
+    application.logger.debug('Queued event {0} {1} for {2}'.format(
+        event_id, event, object_id))
     return "Thank you!"
 
 
@@ -65,6 +168,10 @@ class TeamworkHandler(object):
             settings.HARVEST_BASE_URL,
             settings.HARVEST_USER,
             settings.HARVEST_PASS)
+        # Unit of work of the event being processed, see process_event
+        self.session = None
+        self.project_date = datetime.datetime.now().strftime('%y%m')
+        self.project_numbers = {}
         application.logger.debug('Finished Initialization')
 
     def process_request(self, request):
@@ -79,31 +186,80 @@ class TeamworkHandler(object):
             application.logger.debug('key: ' + key)
             application.logger.debug('val: ' + val)
 
-        event = post_values[Teamwork.EVENT]
-        application.logger.info('Received event type: ' + event)
+        self.process_event(post_values[Teamwork.EVENT],
+                           post_values[Teamwork.OBJECT_ID])
+
+    def process_event(self, event, object_id):
+        """
+        Process a Teamwork webhook event
 
-        if event == Teamwork.PROJECT_CREATED or event == Teamwork.PROJECT_UPDATED or event == Teamwork.PROJECT_COPIED:
-            self.set_project_code(post_values[Teamwork.OBJECT_ID])
-        elif event == Teamwork.COMPANY_CREATED:
-            self.create_company(post_values[Teamwork.OBJECT_ID])
-        elif event == Teamwork.COMPANY_UPDATED:
-            self.update_company(post_values[Teamwork.OBJECT_ID])
+        :param event: Webhook event type
+        :param object_id: Teamwork object ID
+        """
+        application.logger.info('Received event type: ' + event)
+        started = time.time()
+        context = tracing.start('webhook',
+                                settings.TRACE_MAX_CALLS,
+                                settings.TRACE_MAX_BYTES,
+                                event=event,
+                                object_id=object_id)
+
+        # Project numbers are committed as soon as they are assigned, before
+        # the names carrying them go out to Teamwork and Harvest
+        self.session = Session()
+        self.project_numbers = {}
+        try:
+            if event == Teamwork.PROJECT_CREATED or event == Teamwork.PROJECT_UPDATED or event == Teamwork.PROJECT_COPIED:
+                self.set_project_code(object_id, event)
+            elif event == Teamwork.COMPANY_CREATED:
+                self.create_company(object_id)
+            elif event == Teamwork.COMPANY_UPDATED:
+                self.update_company(object_id)
+            self.session.commit()
+        except Exception:
+            self.session.rollback()
+            raise
+        finally:
+            Session.remove()
+            self.session = None
+            metrics.event_seconds.observe(time.time() - started, event=event)
+            tracing.attach(None)
+            self.log_trace(context)
 
         application.logger.debug('Finished processing request')
 
-    def set_project_code(self, tw_project_id):
+    def log_trace(self, context):
+        """Writes the API calls of an event as one JSON line, as a warning
+        if the event went over the trace budget
+
+        :param context: Trace of the event
+        """
+        summary = context.summary()
+        if summary['over_budget']:
+            application.logger.warning('Event over API budget: ' +
+                                       json.dumps(summary))
+        else:
+            application.logger.info(json.dumps(summary))
+
+    def set_project_code(self, tw_project_id, event=None):
         """Prepends the project code to the project name.
 
         :param tw_project_id: The ID of the project
+        :param event: Webhook event type, used to skip echoes of our renames
         """
-        session = Session()
         try:
             tw_project = self.teamwork.get_project(tw_project_id)
             if tw_project is not None:
                 project_name = tw_project[Teamwork.PROJECT][Teamwork.NAME]
-                q = session.query(TWProject).filter(
-                    TWProject.tw_project_id == tw_project_id)
-                if not session.query(q.exists()).scalar():
+                if event == Teamwork.PROJECT_UPDATED and event_queue.consume_echo(
+                        event, tw_project_id, project_name):
+                    application.logger.debug(
+                        'Skipped echo of our own rename to ' + project_name)
+                    return
+                with metrics.timed(metrics.db_seconds,
+                                   operation='set_project_code'):
+                    known = project_mirror.get(self.session, tw_project_id)
+                if known is None:
                     application.logger.debug('Webhook project create or copied')
                     self.create_project(tw_project)
                 else:
@@ -118,8 +274,6 @@ class TeamworkHandler(object):
             application.logger.exception(
                 'Could not update project with TeamworkPM ID of ' +
                 tw_project_id)
-        finally:
-            session.close()
 
     def update_project(self, tw_project):
         """Updates the project in TeamworkPM and Harvest
@@ -141,16 +295,15 @@ class TeamworkHandler(object):
                 Teamwork.COMPANY][
                 Teamwork.COMPANY_ABBR]
             tw_project_id = tw_project[Teamwork.PROJECT][Teamwork.ID]
-            if not re.match(
-                    settings.TEAMWORK_PROJECT_NAME_SCHEME, project_name):
+            parsed_name = projectname.parse(project_name)
+            if parsed_name is None:
                 application.logger.debug(
                     'Project name does not match schema ' +
                     project_name)
-                new_project_name = self.add_project_prefix(project_name, new_company_abbr,
-                                                           tw_project_id)
-                # Update Teamwork project
-                self.update_project_name(
-                    new_project_name, new_company_abbr, tw_project_id)
+                # Update Teamwork project, passing the name Teamwork has so
+                # that the rename is not taken for a no-op
+                new_project_name = self.update_project_name(
+                    project_name, new_company_abbr, tw_project_id)
                 application.logger.debug(
                     'Project schema appended to name ' +
                     new_project_name)
@@ -158,14 +311,15 @@ class TeamworkHandler(object):
                 self.update_project_users(new_company_abbr, tw_project_id)
             else:
                 new_project_name = project_name
-                company_abbr = re.sub("^[0-9]{4}-", "", project_name)
-                company_abbr = re.sub("-[0-9]+ .*$", "", company_abbr)
+                company_abbr = parsed_name.abbr
                 if new_company_abbr != company_abbr:
                     new_project_name = self.update_project_name(project_name, new_company_abbr,
                                                                 tw_project_id)
-                    # Update Harvest project
+                    # Update Harvest project, still named with the number
+                    # the project had under its previous company
                     project_prefix = self.get_project_prefix(
-                        company_abbr, tw_project_id)
+                        company_abbr, tw_project_id, parsed_name.date,
+                        parsed_name.job_id)
                     new_h_client = self.harvest.get_client_by_name(new_company_abbr)
                     h_project = self.harvest.get_project_by_prefix(
                         project_prefix, company_abbr)
@@ -197,9 +351,13 @@ class TeamworkHandler(object):
         :param company_abbr: Company abbreviation
         :param tw_project_id: TeamworkPM project ID
         """
-        project_date = re.sub("-[A-Z]+-[0-9]+ .*$", "", project_name)
-        postfix_project_name = re.sub(
-            "^[0-9]{4}-[A-Z]+-[0-9]+ ", "", project_name)
+        parsed_name = projectname.parse(project_name)
+        if parsed_name is not None:
+            project_date = parsed_name.date
+            postfix_project_name = parsed_name.title
+        else:
+            project_date = None
+            postfix_project_name = project_name
 
         new_project_name = self.add_project_prefix(
             postfix_project_name, company_abbr, tw_project_id, project_date)
@@ -210,7 +368,7 @@ class TeamworkHandler(object):
             new_project_name)
 
         # Update Teamwork project
-        self.teamwork.update_project(new_project_name, tw_project_id)
+        self.rename_tw_project(project_name, new_project_name, tw_project_id)
 
         # Update Harvest project
         project_prefix = self.get_project_prefix(company_abbr, tw_project_id)
@@ -233,68 +391,72 @@ class TeamworkHandler(object):
 
         return new_project_name
 
+    def rename_tw_project(self, project_name, new_project_name, tw_project_id):
+        """Renames the TeamworkPM project, registering the PROJECT.UPDATED
+        webhook the rename triggers so its handling can be skipped
+
+        :param project_name: Current project name
+        :param new_project_name: New project name
+        :param tw_project_id: TeamworkPM project ID
+        """
+        if project_name == new_project_name:
+            return
+
+        echo_id = event_queue.expect_echo(Teamwork.PROJECT_UPDATED,
+                                          tw_project_id, new_project_name)
+        if self.teamwork.update_project(new_project_name,
+                                        tw_project_id) is None:
+            event_queue.discard_echo(echo_id)
+
     def update_project_users(self, company_abbr, tw_project_id):
         """Update the project users
 
         :param company_abbr: Company Appreviation
         :param tw_project_id: TeamworkPM project ID
         """
-        tw_emails = self.get_tw_project_emails(tw_project_id)
-        application.logger.debug('Teamwork assigned people: ' + str(tw_emails))
-
         try:
             project_prefix = self.get_project_prefix(
                 company_abbr, tw_project_id)
-            h_project = self.harvest.get_project_by_prefix(
-                project_prefix, company_abbr)
+            tw_emails, (h_project, h_emails) = run_parallel([
+                (self.get_tw_project_emails, (tw_project_id,)),
+                (self.get_h_project_with_emails, (project_prefix, company_abbr))])
+            application.logger.debug('Teamwork assigned people: ' + str(tw_emails))
             if h_project is not None:
                 h_project_id = h_project[Harvest.PROJECT][Harvest.ID]
                 h_project_name = h_project[Harvest.PROJECT][Harvest.NAME]
-                h_emails = self.get_h_project_emails(h_project_id)
                 application.logger.debug('Harvest assigned people: ' + str(h_emails))
 
-                add_people = []
-                remove_people = []
-
-                if not tw_emails:
-                    remove_people.extend(h_emails.keys())
-                else:
-                    for h_id, h_email in h_emails.iteritems():
-                        if h_email not in tw_emails.values():
-                            remove_people.append(h_id)
-
-                    for tw_email in tw_emails.values():
-                        match = False
-                        for h_email in h_emails.values():
-                            if tw_email.lower() == h_email.lower():
-                                match = True
-                        if not match:
-                            h_person = self.harvest.get_person_by_email(
-                                tw_email)
-                            if h_person:
-                                add_people.append(
-                                    h_person[
-                                        Harvest.USER][
-                                        Harvest.ID])
-                            else:
-                                application.logger.warning(
-                                    'No user with this email "' + tw_email + '" exists in Harvest.')
+                diff = diff_assignments(tw_emails.values(), h_emails,
+                                        self.harvest.get_people_index() or {})
+                if diff.unresolved:
+                    # People added to Harvest after this process cached them
+                    diff = diff_assignments(
+                        tw_emails.values(), h_emails,
+                        self.harvest.get_people_index(refresh=True) or {})
+                for email in diff.unresolved:
+                    application.logger.warning(
+                        'No user with this email "' + email + '" exists in Harvest.')
+                add_people = list(diff.add)
+                remove_people = list(diff.remove)
 
                 application.logger.debug(
                     'Adding people to project "' +
                     h_project_name +
                     '" ' +
                     str(add_people))
-                for person_id in add_people:
-                    self.harvest.add_user_assignment(h_project_id, person_id)
+                parallel_map(
+                    lambda person_id: self.harvest.add_user_assignment(
+                        h_project_id, person_id),
+                    add_people)
                 application.logger.debug(
                     'Removing people from project "' +
                     h_project_name +
                     '" ' +
                     str(remove_people))
-                for person_id in remove_people:
-                    self.harvest.remove_user_assignment(
-                        h_project_id, person_id)
+                parallel_map(
+                    lambda person_id: self.harvest.remove_user_assignment(
+                        h_project_id, person_id),
+                    remove_people)
             else:
                 application.logger.error(
                     'Harvest project does not exist ' +
@@ -326,14 +488,30 @@ class TeamworkHandler(object):
         :rtype: list
         """
         people = self.harvest.get_project_people(project_id)
+        user_ids = [assigned_user[Harvest.USER_ASSIGNMENT][Harvest.USER_ID]
+                    for assigned_user in people]
+        persons = parallel_map(self.harvest.get_person, user_ids)
         emails = {}
-        for assigned_user in people:
-            user_id = assigned_user[Harvest.USER_ASSIGNMENT][Harvest.USER_ID]
-            person = self.harvest.get_person(user_id)
+        for user_id, person in zip(user_ids, persons):
             emails[user_id] = person[Harvest.USER][Harvest.EMAIL]
 
         return emails
 
+    def get_h_project_with_emails(self, project_prefix, company_abbr):
+        """Get the Harvest project matching a prefix and its assigned emails
+
+        :param project_prefix: Project prefix
+        :param company_abbr: Company abbreviation
+        :return: Harvest project and assigned email list
+        :rtype: tuple
+        """
+        h_project = self.harvest.get_project_by_prefix(
+            project_prefix, company_abbr)
+        if h_project is None:
+            return None, {}
+        return h_project, self.get_h_project_emails(
+            h_project[Harvest.PROJECT][Harvest.ID])
+
     def create_project(self, tw_project):
         """Create the project with the appropriate name
 
@@ -358,18 +536,15 @@ class TeamworkHandler(object):
                 ' for client ' +
                 company_abbr)
             # Remove Teamwork project name prefix if it exists
-            if re.match(
-                    settings.TEAMWORK_PROJECT_NAME_SCHEME, project_name):
-                project_name = re.sub(
-                    r'^[0-9]{4}-[A-Z]+-[0-9]+',
-                    '',
-                    project_name,
-                    count=1).lstrip()
+            parsed_name = projectname.parse(project_name)
+            if parsed_name is not None:
+                project_name = parsed_name.title.lstrip()
 
             # Update Teamwork project with new name
             new_project_name = self.add_project_prefix(
                 project_name, company_abbr, tw_project_id)
-            self.teamwork.update_project(new_project_name, tw_project_id)
+            self.rename_tw_project(tw_project[Teamwork.PROJECT][Teamwork.NAME],
+                                   new_project_name, tw_project_id)
 
             # Check to see if Harvest project already exists first.
             project_prefix = self.get_project_prefix(
@@ -408,15 +583,14 @@ class TeamworkHandler(object):
         :rtype: str
         """
         if project_date is None:
-            project_date = datetime.datetime.now().strftime('%y%m')
+            project_date = self.project_date
 
         if project_number is None:
             project_number = self.get_project_number(
                 company_abbr, tw_project_id)
 
-        project_name = project_date + "-" + company_abbr + \
-            "-" + str(project_number) + " " + project_name
-        return project_name
+        return projectname.format_name(project_date, company_abbr,
+                                       project_number, project_name)
 
     def get_project_prefix(self, company_abbr,
                            tw_project_id, project_date=None, project_number=None):
@@ -430,15 +604,14 @@ class TeamworkHandler(object):
         :rtype: str
         """
         if project_date is None:
-            project_date = datetime.datetime.now().strftime('%y%m')
+            project_date = self.project_date
 
         if project_number is None:
             project_number = self.get_project_number(
                 company_abbr, tw_project_id)
 
-        project_prefix = project_date + "-" + company_abbr + \
-            "-" + str(project_number)
-        return project_prefix
+        return projectname.format_prefix(project_date, company_abbr,
+                                         project_number)
 
     def get_project_number(self, company_abbr, tw_project_id):
         """Assigns a company_job_id for the Teamwork project
@@ -448,30 +621,55 @@ class TeamworkHandler(object):
         :return: The assigned company_job_id for the project
         :rtype: int
         """
-        session = Session()
+        key = (company_abbr, tw_project_id)
+        project_number = self.project_numbers.get(key)
+        if project_number is None:
+            with metrics.timed(metrics.db_seconds,
+                               operation='get_project_number'):
+                project_number = self.assign_project_number(company_abbr,
+                                                            tw_project_id)
+            self.project_numbers[key] = project_number
+        return project_number
+
+    def assign_project_number(self, company_abbr, tw_project_id):
+        """Looks up or writes the tw_project row of the Teamwork project
+
+        A written row is committed right away, so a retry of an event that
+        failed after renaming the project finds the number it already used.
+
+        :param company_abbr: Company abbreviation
+        :param tw_project_id: Project ID
+        :return: The assigned company_job_id for the project
+        :rtype: int
+        """
+        # Every process writes tw_project, so the mirror may hold an
+        # abbreviation another worker has since changed; the row is read in
+        # the event's session before deciding whether to write it
+        record = self.session.query(TWProject).get(str(tw_project_id))
+        if record is not None and record.company_abbr == company_abbr:
+            project_number = int(record.company_job_id)
+            project_mirror.put(tw_project_id, company_abbr, project_number)
+            return project_number
+
         data = dict(tw_project_id=tw_project_id,
                     company_abbr=company_abbr)
-        record = TWProject(**data)
-        session.merge(record)
+        record = self.session.merge(TWProject(**data))
 
         try:
-            session.commit()
+            self.session.flush()
+            application.logger.debug(
+                'Successfully flushed record: {0}'.format(str(record)))
+            project_number = int(record.company_job_id)
+            self.session.commit()
         except SQLAlchemyError as error:
-            session.rollback()
+            self.session.rollback()
             application.logger.critical(
-                'Failed to commit TW project to database: {0}'.format(
+                'Failed to write TW project to database: {0}'.format(
                     str(error)))
             abort(404)
 
-        fetched = session.query(TWProject).filter(
-            TWProject.tw_project_id == tw_project_id).one()
-        project_number = fetched.company_job_id
-
-        application.logger.debug(
-            'Successfully committed record: {0}'.format(
-                str(fetched)))
-        session.close()
-        return int(project_number)
+        project_mirror.put(tw_project_id, company_abbr, project_number)
+        return project_number
 
     def create_company(self, company_id):
         """Create a company in Harvest